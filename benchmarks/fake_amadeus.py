@@ -0,0 +1,306 @@
+# The `fake_amadeus` server stands in for the Amadeus API during load tests, so the service can be
+# benchmarked without spending the Amadeus quota or depending on the latency of the test environment.
+# It serves the two endpoints the service calls:
+#
+#     POST /v1/security/oauth2/token          client credentials, returns a bearer token
+#     GET  /v2/shopping/flight-offers         returns `max` offers with multi-segment itineraries
+#
+# The latency of each flight-offers call is drawn from a log-normal distribution with the given median
+# and p99, a share of the calls fail with a 500, and calls above `--rate-limit` per second per client
+# ID get a 429 with a `Retry-After` header, like the real quota of each account. Offers are generated
+# from the route and date, so the same search always returns the same prices. The counters are
+# available at `GET /__stats`.
+#
+# Point the service at it with `AMADEUS_BASE_URL` and run it from the repository root:
+#
+#     python benchmarks/fake_amadeus.py --port 8081 --latency-p50 300 --latency-p99 1500
+import argparse
+import json
+import math
+import random
+import secrets
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+CARRIERS = ['AA', 'BA', 'DL', 'UA', 'LH', 'AF', 'KL', 'IB', 'AY', 'EI']
+HUBS = ['ORD', 'ATL', 'DFW', 'LHR', 'FRA', 'CDG', 'AMS', 'MAD', 'HEL', 'DUB']
+
+
+class TokenBucket:
+    """
+    The `TokenBucket` class limits the flight-offers calls to `rate` per second with bursts of up to
+    `burst` calls. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        The function `take` takes one token.
+        :return: 0 if the call may proceed, or the number of seconds until the next token otherwise.
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FakeAmadeus:
+    """
+    The `FakeAmadeus` class holds the configuration and counters of the server, and builds the
+    responses of both endpoints.
+    """
+    def __init__(self, options):
+        self.options = options
+        # One bucket per client ID, each account has its own quota
+        self.buckets = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.counters = {'token': 0, 'offers': 0, 'ok': 0, 'errors': 0, 'rate_limited': 0, 'unauthorized': 0}
+        # The log-normal distribution with the given median and p99, 2.326 is the z-score of the p99
+        self.mu = math.log(options.latency_p50)
+        self.sigma = max(0.0, math.log(options.latency_p99 / options.latency_p50) / 2.326)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def latency(self):
+        # The simulated latency of one flight-offers call, in seconds
+        return random.lognormvariate(self.mu, self.sigma) / 1000
+
+    def issue_token(self, client_id):
+        token = secrets.token_urlsafe(24)
+        with self.lock:
+            self.tokens[token] = (time.time() + self.options.token_ttl, client_id)
+        return {
+            'type': 'amadeusOAuth2Token',
+            'username': 'benchmark@example.com',
+            'application_name': 'fake_amadeus',
+            'client_id': client_id,
+            'token_type': 'Bearer',
+            'access_token': token,
+            'expires_in': self.options.token_ttl,
+            'state': 'approved',
+            'scope': '',
+        }
+
+    def client_of(self, header):
+        # The client ID the bearer token was issued to, or `None` if the token is unknown or expired
+        token = header[len('Bearer '):] if header and header.startswith('Bearer ') else None
+        with self.lock:
+            expires_at, client_id = self.tokens.get(token, (0, None))
+        return client_id if expires_at > time.time() else None
+
+    def bucket(self, client_id):
+        with self.lock:
+            if client_id not in self.buckets:
+                self.buckets[client_id] = TokenBucket(self.options.rate_limit, self.options.rate_limit_burst)
+            return self.buckets[client_id]
+
+    def offers(self, origin, destination, date, adults, maximum, currency='EUR'):
+        """
+        The function `offers` builds a flight-offers response for a search. Each offer has one
+        itinerary of one to three segments, connecting through a hub, with a price and a traveler
+        pricing per adult, like the Amadeus test environment returns. Prices are the same numbers in
+        every currency.
+        """
+        # Seed the generator with the search, so repeated searches return the same offers
+        rng = random.Random(zlib.crc32(f"{origin}{destination}{date}".encode()))
+        departure_day = datetime.strptime(date, '%Y-%m-%d')
+        data = []
+        for number in range(1, maximum + 1):
+            carrier = rng.choice(CARRIERS)
+            stops = rng.choice([0, 0, 1, 1, 2])
+            hubs = [hub for hub in rng.sample(HUBS, 3) if hub not in (origin, destination)][:stops]
+            airports = [origin] + hubs + [destination]
+            departure = departure_day + timedelta(hours=rng.randint(6, 21), minutes=rng.choice([0, 15, 30, 45]))
+            segments = []
+            for index, (start, end) in enumerate(zip(airports, airports[1:]), start=1):
+                flight_minutes = rng.randint(60, 600)
+                arrival = departure + timedelta(minutes=flight_minutes)
+                segments.append({
+                    'departure': {'iataCode': start, 'terminal': str(rng.randint(1, 8)), 'at': departure.isoformat()},
+                    'arrival': {'iataCode': end, 'terminal': str(rng.randint(1, 8)), 'at': arrival.isoformat()},
+                    'carrierCode': carrier,
+                    'number': str(rng.randint(10, 9999)),
+                    'aircraft': {'code': rng.choice(['320', '321', '738', '77W', '789', '359'])},
+                    'operating': {'carrierCode': carrier},
+                    'duration': f"PT{flight_minutes // 60}H{flight_minutes % 60}M",
+                    'id': str(index),
+                    'numberOfStops': 0,
+                    'blacklistedInEU': False,
+                })
+                # Connect after a layover of 45 minutes to 4 hours
+                departure = arrival + timedelta(minutes=rng.randint(45, 240))
+            total_minutes = int((datetime.fromisoformat(segments[-1]['arrival']['at'])
+                                 - datetime.fromisoformat(segments[0]['departure']['at'])).total_seconds() // 60)
+            base = round(rng.uniform(80, 1200), 2)
+            per_adult = round(base * rng.uniform(1.08, 1.25), 2)
+            total = f"{per_adult * adults:.2f}"
+            data.append({
+                'type': 'flight-offer',
+                'id': str(number),
+                'source': 'GDS',
+                'instantTicketingRequired': False,
+                'nonHomogeneous': False,
+                'oneWay': False,
+                'lastTicketingDate': date,
+                'numberOfBookableSeats': rng.randint(1, 9),
+                'itineraries': [{
+                    'duration': f"PT{total_minutes // 60}H{total_minutes % 60}M",
+                    'segments': segments,
+                }],
+                'price': {
+                    'currency': currency,
+                    'total': total,
+                    'base': f"{base * adults:.2f}",
+                    'fees': [{'amount': '0.00', 'type': 'SUPPLIER'}, {'amount': '0.00', 'type': 'TICKETING'}],
+                    'grandTotal': total,
+                },
+                'pricingOptions': {'fareType': ['PUBLISHED'], 'includedCheckedBagsOnly': True},
+                'validatingAirlineCodes': [carrier],
+                'travelerPricings': [{
+                    'travelerId': str(traveler),
+                    'fareOption': 'STANDARD',
+                    'travelerType': 'ADULT',
+                    'price': {'currency': currency, 'total': f"{per_adult:.2f}", 'base': f"{base:.2f}"},
+                    'fareDetailsBySegment': [
+                        {'segmentId': segment['id'], 'cabin': 'ECONOMY', 'fareBasis': 'KLX8AS', 'class': 'K',
+                         'includedCheckedBags': {'quantity': 1}}
+                        for segment in segments
+                    ],
+                } for traveler in range(1, adults + 1)],
+            })
+        # Amadeus returns the offers sorted by price
+        data.sort(key=lambda offer: float(offer['price']['grandTotal']))
+        for number, offer in enumerate(data, start=1):
+            offer['id'] = str(number)
+        return {
+            'meta': {'count': len(data)},
+            'data': data,
+            'dictionaries': {
+                'carriers': {carrier: carrier for carrier in {offer['validatingAirlineCodes'][0] for offer in data}},
+                'currencies': {currency: currency},
+            },
+        }
+
+
+def error_body(status, code, title, detail):
+    return {'errors': [{'status': status, 'code': code, 'title': title, 'detail': detail}]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the service's pooled connections alive between calls
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeAmadeus/1.0'
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.amadeus+json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        if urlparse(self.path).path != '/v1/security/oauth2/token':
+            return self.send_json(404, error_body(404, 38196, 'Resource not found', self.path))
+        if form.get('grant_type') != ['client_credentials'] or not form.get('client_id'):
+            return self.send_json(401, {'error': 'invalid_client', 'error_description': 'Client credentials are invalid'})
+        self.fake.count('token')
+        self.send_json(200, self.fake.issue_token(form['client_id'][0]))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/__stats':
+            with self.fake.lock:
+                return self.send_json(200, dict(self.fake.counters))
+        if url.path != '/v2/shopping/flight-offers':
+            return self.send_json(404, error_body(404, 38196, 'Resource not found', self.path))
+        self.fake.count('offers')
+        client_id = self.fake.client_of(self.headers.get('Authorization'))
+        if client_id is None:
+            self.fake.count('unauthorized')
+            return self.send_json(401, error_body(401, 38190, 'Invalid access token', 'The access token provided in the Authorization header is invalid'))
+        wait = self.fake.bucket(client_id).take()
+        if wait:
+            self.fake.count('rate_limited')
+            return self.send_json(429, error_body(429, 38194, 'Too many requests', 'The network rate limit is exceeded, please try again later'),
+                                  headers={'Retry-After': str(max(1, math.ceil(wait)))})
+
+        time.sleep(self.fake.latency())
+        if random.random() < self.fake.options.error_rate:
+            self.fake.count('errors')
+            return self.send_json(500, error_body(500, 141, 'SYSTEM ERROR HAS OCCURRED', ''))
+
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        try:
+            origin = query['originLocationCode']
+            destination = query['destinationLocationCode']
+            date = query['departureDate']
+            datetime.strptime(date, '%Y-%m-%d')
+            adults = int(query.get('adults', 1))
+            maximum = int(query.get('max', self.fake.options.offers))
+            currency = query.get('currencyCode', 'EUR')
+        except (KeyError, ValueError):
+            return self.send_json(400, error_body(400, 477, 'INVALID FORMAT', 'Invalid search parameters'))
+        self.fake.count('ok')
+        self.send_json(200, self.fake.offers(origin, destination, date, adults, min(maximum, 250), currency))
+
+    def log_message(self, format, *args):
+        if self.server.fake.options.verbose:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Amadeus token and flight-offers endpoints")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-p50', type=float, default=300, help="Median flight-offers latency, in milliseconds.")
+    parser.add_argument('--latency-p99', type=float, default=1500, help="99th percentile flight-offers latency, in milliseconds.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of flight-offers calls that fail with a 500.")
+    parser.add_argument('--rate-limit', type=float, default=0, help="Flight-offers calls allowed per second per client ID, 0 for no limit.")
+    parser.add_argument('--rate-limit-burst', type=float, default=0, help="Burst allowed above the rate, defaults to the rate.")
+    parser.add_argument('--token-ttl', type=int, default=1799, help="Lifetime of the issued tokens, in seconds.")
+    parser.add_argument('--offers', type=int, default=5, help="Offers returned when the search has no max parameter.")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+    options = parser.parse_args()
+    if options.latency_p50 <= 0 or options.latency_p99 < options.latency_p50:
+        parser.error("--latency-p50 must be positive and no greater than --latency-p99")
+
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    server.fake = FakeAmadeus(options)
+    print(f"Fake Amadeus listening on http://{options.host}:{options.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# The `load_test` benchmark drives `/flights/price/` of a running server at set concurrency levels and
+# cache hit ratios, and reports the throughput and the p50/p95/p99 latency of each level. Results are
+# saved as JSON, and a previous result can be passed with `--compare` to flag regressions.
+#
+# Each level first warms a small set of hot searches. Every request then asks for a hot search with
+# probability `--hit-ratio`, or for a search that was not asked before in the run, which misses the
+# cache. The observed ratio, counted from the `X-Cache` headers, is reported next to the target.
+#
+# Run the server against the local Amadeus stand-in, so misses never spend the real quota:
+#
+#     python benchmarks/fake_amadeus.py --port 8081
+#     AMADEUS_BASE_URL=http://127.0.0.1:8081 python manage.py runserver --noreload 8000
+#     python benchmarks/load_test.py --concurrency 1,16,64 --hit-ratio 0,0.9,1 --amadeus-url http://127.0.0.1:8081
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+CODES = ['JFK', 'LAX', 'SFO', 'ORD', 'ATL', 'DFW', 'SEA', 'BOS', 'MIA', 'DEN', 'LHR', 'CDG',
+         'FRA', 'AMS', 'MAD', 'FCO', 'NRT', 'HND', 'SYD', 'DXB', 'SIN', 'HKG', 'YYZ', 'MEX']
+# A rise in the share of failed requests above this is a regression, whatever the latency
+ERROR_SHARE_TOLERANCE = 0.01
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class Searches:
+    """
+    The `Searches` class hands out the searches of a run: a fixed set of hot searches, and cold searches
+    that are never repeated within the run. Cold dates start at a random offset, so consecutive runs
+    against the same Redis do not hit each other's entries.
+    """
+    def __init__(self, hot_count, seed):
+        routes = [(origin, destination) for origin in CODES for destination in CODES if origin != destination]
+        random.Random(seed).shuffle(routes)
+        today = datetime.date.today()
+        offset = random.Random(seed).randrange(330)
+        # Dates 30 to 360 days ahead, walked route by route
+        dates = [(today + datetime.timedelta(days=30 + (offset + day) % 330)).isoformat() for day in range(330)]
+        self.hot = [(origin, destination, dates[0]) for origin, destination in routes[:hot_count]]
+        self._cold = ((origin, destination, date) for date in dates[1:] for origin, destination in routes)
+        self._lock = threading.Lock()
+
+    def cold(self):
+        with self._lock:
+            return next(self._cold)
+
+
+def percentile(sorted_values, fraction):
+    # The nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def price_url(base_url, search):
+    origin, destination, date = search
+    return f"{base_url}/flights/price/?origin={origin}&destination={destination}&date={date}"
+
+
+def amadeus_stats(amadeus_url):
+    # The counters of benchmarks/fake_amadeus.py, used to report the upstream calls of each level
+    if not amadeus_url:
+        return None
+    try:
+        return requests.get(f"{amadeus_url}/__stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def run_level(options, searches, concurrency, hit_ratio):
+    """
+    The function `run_level` sends `options.requests` requests with `concurrency` clients, each of
+    which waits for its response before sending the next request.
+    :return: The result of the level, as saved in the JSON file.
+    """
+    # Warm the hot searches, so they are hits for the whole level
+    with requests.Session() as session:
+        for search in searches.hot:
+            session.get(price_url(options.url, search), timeout=options.timeout)
+
+    latencies = []
+    statuses = Counter()
+    cache_results = Counter()
+    remaining = itertools.count()
+    lock = threading.Lock()
+    before = amadeus_stats(options.amadeus_url)
+
+    def client(number):
+        rng = random.Random(options.seed * 1000 + number)
+        local_latencies, local_statuses, local_results = [], Counter(), Counter()
+        with requests.Session() as session:
+            while next(remaining) < options.requests:
+                search = rng.choice(searches.hot) if rng.random() < hit_ratio else searches.cold()
+                started = time.perf_counter()
+                try:
+                    response = session.get(price_url(options.url, search), timeout=options.timeout)
+                    status, cache_result = response.status_code, response.headers.get('X-Cache', 'NONE')
+                except requests.RequestException:
+                    status, cache_result = 'failed', 'NONE'
+                local_latencies.append((time.perf_counter() - started) * 1000)
+                local_statuses[str(status)] += 1
+                local_results[cache_result] += 1
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+            cache_results.update(local_results)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    after = amadeus_stats(options.amadeus_url)
+
+    latencies.sort()
+    total = len(latencies)
+    errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+    return {
+        'concurrency': concurrency,
+        'target_hit_ratio': hit_ratio,
+        'observed_hit_ratio': round(cache_results['HIT'] / total, 4) if total else None,
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2),
+            'mean': round(sum(latencies) / total, 2),
+            'max': round(latencies[-1], 2),
+        },
+        'statuses': dict(statuses),
+        'x_cache': dict(cache_results),
+        'upstream_calls': after['offers'] - before['offers'] if before and after else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_level(level):
+    latency = level['latency_ms']
+    print(f"c={level['concurrency']:<4} hit={level['target_hit_ratio']:<4} "
+          f"(observed {level['observed_hit_ratio']})  {level['throughput_rps']:>9} req/s  "
+          f"p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  p99 {latency['p99']:>8} ms  "
+          f"errors {level['errors']}" + (f"  upstream {level['upstream_calls']}" if level['upstream_calls'] is not None else ''))
+
+
+def compare(result, baseline, threshold):
+    """
+    The function `compare` prints the change of each level against the level with the same concurrency
+    and hit ratio in `baseline`. A drop in throughput or a rise in p99 latency larger than `threshold`
+    is a regression, and so is a rise in the share of failed requests, since failing fast looks fast.
+    :return: The number of regressions.
+    """
+    previous = {(level['concurrency'], level['target_hit_ratio']): level for level in baseline['levels']}
+    regressions = 0
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} from {baseline.get('started_at')}:")
+    for level in result['levels']:
+        old = previous.get((level['concurrency'], level['target_hit_ratio']))
+        if not old:
+            continue
+        throughput = level['throughput_rps'] / old['throughput_rps'] - 1
+        p99 = level['latency_ms']['p99'] / old['latency_ms']['p99'] - 1
+        errors = level['errors'] / level['requests'] - old['errors'] / old['requests']
+        regressed = throughput < -threshold or p99 > threshold or errors > ERROR_SHARE_TOLERANCE
+        regressions += regressed
+        print(f"c={level['concurrency']:<4} hit={level['target_hit_ratio']:<4} throughput {throughput:+7.1%}  "
+              f"p99 {p99:+7.1%}  errors {errors:+7.1%}" + ("  REGRESSION" if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /flights/price/ at set concurrency levels and cache hit ratios")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="The base URL of the service.")
+    parser.add_argument('--concurrency', default='1,8,32', help="Comma-separated numbers of concurrent clients.")
+    parser.add_argument('--hit-ratio', default='0,0.9,1', help="Comma-separated shares of requests for hot searches.")
+    parser.add_argument('--requests', type=int, default=500, help="Requests sent at each level.")
+    parser.add_argument('--hot-searches', type=int, default=20, help="Number of hot searches warmed before each level.")
+    parser.add_argument('--timeout', type=float, default=30, help="Timeout of each request, in seconds.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the search mix, random by default.")
+    parser.add_argument('--amadeus-url', default=None, help="The URL of fake_amadeus.py, to report upstream calls.")
+    parser.add_argument('--output', default=None, help="Where to save the results, defaults to benchmarks/results/.")
+    parser.add_argument('--compare', default=None, help="A previous result file to compare with.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change reported as a regression.")
+    options = parser.parse_args()
+    options.url = options.url.rstrip('/')
+    options.seed = options.seed if options.seed is not None else random.randrange(1 << 30)
+
+    searches = Searches(options.hot_searches, options.seed)
+    result = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'url': options.url,
+        'requests_per_level': options.requests,
+        'seed': options.seed,
+        'levels': [],
+    }
+    for concurrency in (int(value) for value in options.concurrency.split(',')):
+        for hit_ratio in (float(value) for value in options.hit_ratio.split(',')):
+            level = run_level(options, searches, concurrency, hit_ratio)
+            print_level(level)
+            result['levels'].append(level)
+
+    output = options.output or os.path.join(RESULTS_DIR, f"load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as result_file:
+        json.dump(result, result_file, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            if compare(result, json.load(baseline_file), options.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# The `price_hit` benchmark measures the cost of serving a cached price. It compares the previous hit
+# path, which wrapped the cached dict in a DRF `Response` and ran content negotiation and the JSON
+# renderer, with the current one, which returns the body rendered when the price was fetched. It also
+# compares building a `FlightOfferSerializer` with calling `flight_offer_summary` on a miss.
+#
+# The cache entry is put straight into the in-process L1, so no Redis server is needed. Run it from
+# the repository root:
+#
+#     python benchmarks/price_hit.py [--iterations 20000]
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The settings only need these to import, the benchmark never talks to Redis or Amadeus
+for name, value in {
+    'SECRET_KEY': 'benchmark', 'ALLOWED_HOSTS': 'testserver', 'AMADEUS_CLIENT_ID': 'benchmark',
+    'AMADEUS_CLIENT_SECRET': 'benchmark', 'REDIS_URL': 'redis://127.0.0.1:6379/15', 'DEBUG': 'False',
+}.items():
+    os.environ.setdefault(name, value)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flight_app.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from rest_framework import status  # noqa: E402
+from rest_framework.response import Response  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+from rest_framework.views import APIView  # noqa: E402
+
+from flights.serializers import FlightOfferSerializer, flight_offer_summary  # noqa: E402
+from flights.services.price_service import build_price_entry, price_cache, price_cache_key, read_price_entry  # noqa: E402
+from flights.views import FlightPriceView  # noqa: E402
+
+
+OFFER = {
+    'itineraries': [{
+        'duration': 'PT5H30M',
+        'segments': [{
+            'departure': {'iataCode': 'JFK', 'at': '2024-12-01T08:00:00'},
+            'arrival': {'iataCode': 'LAX', 'at': '2024-12-01T11:30:00'},
+            'carrierCode': 'AA',
+        }],
+    }],
+    'price': {'total': '250.00', 'currency': 'USD', 'grandTotal': '250.00'},
+}
+URL = '/flights/price/?origin=JFK&destination=LAX&date=2024-12-01'
+
+
+class LegacyFlightPriceView(APIView):
+    # The hit path before pre-rendered bodies: the cached dict goes through DRF's `Response`
+    def get(self, request):
+        entry = read_price_entry('JFK', 'LAX', '2024-12-01')
+        return Response({"data": entry['data']}, status=status.HTTP_200_OK, headers={'X-Cache': 'HIT'})
+
+
+def serve(view, request):
+    response = view(request)
+    # DRF responses are rendered lazily, render them like the handler would
+    if hasattr(response, 'render'):
+        response.render()
+    return response.content
+
+
+def report(name, seconds, iterations, baseline=None):
+    per_request = seconds / iterations * 1e6
+    line = f"{name:<32} {per_request:9.2f} us/op"
+    if baseline:
+        line += f"   {baseline / seconds:5.2f}x faster"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cached price hit path")
+    parser.add_argument('--iterations', type=int, default=20000)
+    iterations = parser.parse_args().iterations
+
+    # Keep the entry in L1 for the whole run
+    entry = build_price_entry([OFFER])
+    price_cache.local.set(price_cache_key('JFK', 'LAX', '2024-12-01'), entry, ttl=3600)
+
+    request = APIRequestFactory().get(URL, HTTP_ACCEPT='application/json')
+    legacy_view = LegacyFlightPriceView.as_view()
+    view = FlightPriceView.as_view()
+
+    legacy_body = serve(legacy_view, request)
+    body = serve(view, request)
+    if legacy_body != body:
+        sys.exit(f"Response bodies differ:\n  legacy:  {legacy_body!r}\n  current: {body!r}")
+    print(f"Response bodies are identical ({len(body)} bytes)\n")
+
+    print("Cache hit, full view")
+    legacy = timeit.timeit(lambda: serve(legacy_view, request), number=iterations)
+    current = timeit.timeit(lambda: serve(view, request), number=iterations)
+    report('DRF Response + JSONRenderer', legacy, iterations)
+    report('pre-rendered HttpResponse', current, iterations, legacy)
+
+    print("\nCache miss, offer extraction")
+    legacy = timeit.timeit(lambda: FlightOfferSerializer(OFFER).data, number=iterations)
+    current = timeit.timeit(lambda: flight_offer_summary(OFFER), number=iterations)
+    report('FlightOfferSerializer', legacy, iterations)
+    report('flight_offer_summary', current, iterations, legacy)
+
+
+if __name__ == '__main__':
+    main()
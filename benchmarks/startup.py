@@ -0,0 +1,200 @@
+# The `startup` benchmark measures the cold start of a worker, the cost paid by every new process when
+# the service scales out. Each run starts a fresh interpreter that loads Django with a settings
+# profile, builds the WSGI application and serves its first and second request, and reports how long
+# each step took:
+#
+#     interpreter    from spawning the process to the first line of the benchmark
+#     setup          `django.setup()`: the settings, every installed app and its models
+#     application    `get_wsgi_application()`: the middleware chain
+#     first_request  the first request, which imports the URLconf and the views
+#     second_request the same request again, once everything is loaded
+#     cold_start     from spawning the process to the end of the first response
+#
+# The median of each step over `--runs` runs is reported per profile. Results are saved as JSON, and a
+# previous result can be passed with `--compare` to flag regressions. No Redis server is needed, the
+# default path `/flights/ping/` does not touch the cache. Run it from the repository root:
+#
+#     python benchmarks/startup.py --settings flight_app.settings,flight_app.settings_api --runs 10
+import argparse
+import time
+
+STARTED = time.time()
+
+import datetime  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import re  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+from wsgiref.util import setup_testing_defaults  # noqa: E402
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+STEPS = ['interpreter', 'setup', 'application', 'first_request', 'second_request', 'cold_start']
+# The settings only need these to import, the benchmark never talks to Redis or Amadeus
+ENVIRONMENT = {
+    'SECRET_KEY': 'benchmark', 'ALLOWED_HOSTS': '127.0.0.1,localhost,testserver', 'AMADEUS_CLIENT_ID': 'benchmark',
+    'AMADEUS_CLIENT_SECRET': 'benchmark', 'REDIS_URL': 'redis://127.0.0.1:6379/15', 'DEBUG': 'False',
+}
+
+
+def child(path, spawned_at):
+    # Runs in the spawned process: times each step of the start and prints them as JSON
+    sys.path.insert(0, ROOT)
+    timings = {'interpreter': STARTED - spawned_at}
+
+    started = time.perf_counter()
+    import django
+    django.setup()
+    timings['setup'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    timings['application'] = time.perf_counter() - started
+
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    for step in ('first_request', 'second_request'):
+        environ = {'PATH_INFO': path.split('?')[0], 'QUERY_STRING': path.partition('?')[2], 'HTTP_ACCEPT': 'application/json'}
+        setup_testing_defaults(environ)
+        started = time.perf_counter()
+        response = application(environ, start_response)
+        b''.join(response)
+        response.close()
+        timings[step] = time.perf_counter() - started
+        if step == 'first_request':
+            timings['cold_start'] = time.time() - spawned_at
+
+    print(json.dumps({'timings': timings, 'status': statuses[0]}))
+
+
+def run_once(settings_module, path, importtime=False):
+    """
+    The function `run_once` starts one worker process with `settings_module` and collects its timings.
+    :return: The dict printed by the child, and its stderr (the `-X importtime` report, if asked for).
+    """
+    environment = {**ENVIRONMENT, **os.environ, 'DJANGO_SETTINGS_MODULE': settings_module}
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [
+        os.path.abspath(__file__), '--child', '--path', path, '--spawned-at', repr(time.time()),
+    ]
+    process = subprocess.run(command, capture_output=True, text=True, env=environment, cwd=ROOT)
+    if process.returncode != 0:
+        sys.exit(f"The worker with {settings_module} failed:\n{process.stderr}")
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def top_imports(report, count):
+    """
+    The function `top_imports` picks the slowest top-level imports from a `-X importtime` report.
+    :return: A list of `(module, cumulative milliseconds)` tuples, slowest first.
+    """
+    imports = []
+    for line in report.splitlines():
+        # import time: self [us] | cumulative | imported package, nested imports are indented
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            imports.append((match.group(2), int(match.group(1)) / 1000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def run_profile(options, settings_module):
+    runs = [run_once(settings_module, options.path)[0] for _ in range(options.runs)]
+    profile = {
+        'settings': settings_module,
+        'status': runs[0]['status'],
+        'runs': options.runs,
+        'median_ms': {step: round(statistics.median(run['timings'][step] for run in runs) * 1000, 1) for step in STEPS},
+        'max_ms': {step: round(max(run['timings'][step] for run in runs) * 1000, 1) for step in STEPS},
+    }
+    if options.top_imports:
+        profile['top_imports'] = top_imports(run_once(settings_module, options.path, importtime=True)[1], options.top_imports)
+    return profile
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_profile(profile):
+    print(f"{profile['settings']} ({profile['runs']} runs, first response {profile['status']}), median:")
+    for step in STEPS:
+        print(f"  {step:<15} {profile['median_ms'][step]:>9} ms   (max {profile['max_ms'][step]} ms)")
+    for module, cumulative in profile.get('top_imports', []):
+        print(f"  import {module:<40} {cumulative:>9.1f} ms")
+
+
+def compare(result, baseline, threshold):
+    """
+    The function `compare` prints the change of the median cold start and first request of each profile
+    against the same profile in `baseline`. A rise larger than `threshold` is a regression.
+    :return: The number of regressions.
+    """
+    previous = {profile['settings']: profile for profile in baseline['profiles']}
+    regressions = 0
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} from {baseline.get('started_at')}:")
+    for profile in result['profiles']:
+        old = previous.get(profile['settings'])
+        if not old:
+            continue
+        changes = {step: profile['median_ms'][step] / old['median_ms'][step] - 1 for step in ('cold_start', 'first_request')}
+        regressed = any(change > threshold for change in changes.values())
+        regressions += regressed
+        print(f"{profile['settings']:<28} cold start {changes['cold_start']:+7.1%}  "
+              f"first request {changes['first_request']:+7.1%}" + ("  REGRESSION" if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start of a worker with each settings profile")
+    parser.add_argument('--settings', default='flight_app.settings,flight_app.settings_api',
+                        help="Comma-separated settings modules to compare.")
+    parser.add_argument('--runs', type=int, default=5, help="Cold starts measured per settings module.")
+    parser.add_argument('--path', default='/flights/ping/', help="The path requested by each worker.")
+    parser.add_argument('--top-imports', type=int, default=0, help="Also list this many of the slowest imports.")
+    parser.add_argument('--output', default=None, help="Where to save the results, defaults to benchmarks/results/.")
+    parser.add_argument('--compare', default=None, help="A previous result file to compare with.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change reported as a regression.")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--spawned-at', type=float, default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        child(options.path, options.spawned_at)
+        return
+
+    result = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': sys.version.split()[0],
+        'path': options.path,
+        'profiles': [],
+    }
+    for settings_module in options.settings.split(','):
+        profile = run_profile(options, settings_module.strip())
+        print_profile(profile)
+        result['profiles'].append(profile)
+
+    output = options.output or os.path.join(RESULTS_DIR, f"startup-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as result_file:
+        json.dump(result, result_file, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            if compare(result, json.load(baseline_file), options.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
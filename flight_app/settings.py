@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Times the whole request, so it comes first
+    'flights.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -129,12 +131,21 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Define the Amadeus API settings
-AMADEUS_CLIENT_ID = config('AMADEUS_CLIENT_ID')
-AMADEUS_CLIENT_SECRET = config('AMADEUS_CLIENT_SECRET')
+AMADEUS_CLIENT_ID = config('AMADEUS_CLIENT_ID', default='')
+AMADEUS_CLIENT_SECRET = config('AMADEUS_CLIENT_SECRET', default='')
+# A comma-separated list of client_id:client_secret pairs. Calls are spread over every credential, each
+# with its own token and rate limit. When empty, AMADEUS_CLIENT_ID and AMADEUS_CLIENT_SECRET are used.
+AMADEUS_CREDENTIALS = config('AMADEUS_CREDENTIALS', default='', cast=Csv())
+# The Amadeus environment to call, e.g. https://api.amadeus.com in production or a local stand-in such
+# as benchmarks/fake_amadeus.py for load tests
+AMADEUS_BASE_URL = config('AMADEUS_BASE_URL', default='https://test.api.amadeus.com').rstrip('/')
 
 # Define the Redis URL
 REDIS_URL = config('REDIS_URL')
 
+# Define the maximum number of Redis connections held by the async request path of each process
+REDIS_ASYNC_MAX_CONNECTIONS = config('REDIS_ASYNC_MAX_CONNECTIONS', default=100, cast=int)
+
 # Define the cache settings
 CACHES = {
     'default': {
@@ -146,3 +157,154 @@ CACHES = {
     }
 }
 
+# Define the outbound HTTP settings used by the shared Amadeus session
+AMADEUS_HTTP_POOL_CONNECTIONS = config('AMADEUS_HTTP_POOL_CONNECTIONS', default=4, cast=int)
+AMADEUS_HTTP_POOL_MAXSIZE = config('AMADEUS_HTTP_POOL_MAXSIZE', default=32, cast=int)
+AMADEUS_HTTP_MAX_RETRIES = config('AMADEUS_HTTP_MAX_RETRIES', default=2, cast=int)
+AMADEUS_HTTP_BACKOFF_FACTOR = config('AMADEUS_HTTP_BACKOFF_FACTOR', default=0.2, cast=float)
+AMADEUS_HTTP_CONNECT_TIMEOUT = config('AMADEUS_HTTP_CONNECT_TIMEOUT', default=3.05, cast=float)
+AMADEUS_HTTP_READ_TIMEOUT = config('AMADEUS_HTTP_READ_TIMEOUT', default=10, cast=float)
+# Retries of a call stop once RETRY_BUDGET seconds have passed since its first failure, and never more
+# than PRICE_REQUEST_DEADLINE, so retrying does not keep a request past its deadline
+AMADEUS_HTTP_RETRY_BUDGET = config('AMADEUS_HTTP_RETRY_BUDGET', default=2, cast=float)
+# The async client is shared by every request of an ASGI process, so it can hold many more connections
+AMADEUS_ASYNC_MAX_CONNECTIONS = config('AMADEUS_ASYNC_MAX_CONNECTIONS', default=200, cast=int)
+
+# Define the upstream rate limit settings. The flight-offers calls of each credential share a
+# cluster-wide budget of PER_SECOND calls (with bursts of up to BURST), each process keeps at most
+# MAX_CONCURRENCY calls per credential in flight, and callers queue for up to MAX_WAIT seconds before
+# getting a 429. After a 429 without a Retry-After header every worker pauses that credential for
+# DEFAULT_BACKOFF seconds.
+AMADEUS_RATE_LIMIT_PER_SECOND = config('AMADEUS_RATE_LIMIT_PER_SECOND', default=10, cast=float)
+AMADEUS_RATE_LIMIT_BURST = config('AMADEUS_RATE_LIMIT_BURST', default=10, cast=float)
+AMADEUS_RATE_LIMIT_MAX_WAIT = config('AMADEUS_RATE_LIMIT_MAX_WAIT', default=5, cast=float)
+AMADEUS_RATE_LIMIT_DEFAULT_BACKOFF = config('AMADEUS_RATE_LIMIT_DEFAULT_BACKOFF', default=1, cast=float)
+AMADEUS_MAX_CONCURRENCY = config('AMADEUS_MAX_CONCURRENCY', default=16, cast=int)
+
+# Define how long a credential is taken out of rotation when it has other credentials to fall back on:
+# THROTTLE_COOLDOWN seconds (or the Retry-After delay if longer) after a 429, and AUTH_COOLDOWN
+# seconds when no token can be fetched for it or Amadeus rejects a freshly fetched one.
+AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN = config('AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN', default=2, cast=float)
+AMADEUS_CREDENTIAL_AUTH_COOLDOWN = config('AMADEUS_CREDENTIAL_AUTH_COOLDOWN', default=60, cast=float)
+
+# Define the OAuth token settings. The token is treated as expired EXPIRY_MARGIN seconds before the
+# server says it expires, and is refreshed in the background once it is within REFRESH_AHEAD seconds.
+AMADEUS_TOKEN_EXPIRY_MARGIN = config('AMADEUS_TOKEN_EXPIRY_MARGIN', default=30, cast=int)
+AMADEUS_TOKEN_REFRESH_AHEAD = config('AMADEUS_TOKEN_REFRESH_AHEAD', default=300, cast=int)
+AMADEUS_TOKEN_DEFAULT_EXPIRES_IN = config('AMADEUS_TOKEN_DEFAULT_EXPIRES_IN', default=1799, cast=int)
+AMADEUS_TOKEN_LOCK_TIMEOUT = config('AMADEUS_TOKEN_LOCK_TIMEOUT', default=15, cast=int)
+AMADEUS_TOKEN_LOCK_WAIT = config('AMADEUS_TOKEN_LOCK_WAIT', default=12, cast=float)
+
+# Define the request coalescing settings. The lease must outlive one upstream call, and followers
+# wait at most MAX_WAIT seconds for the leader before fetching themselves.
+SINGLE_FLIGHT_LEASE_TIMEOUT = config('SINGLE_FLIGHT_LEASE_TIMEOUT', default=15, cast=int)
+SINGLE_FLIGHT_MAX_WAIT = config('SINGLE_FLIGHT_MAX_WAIT', default=12, cast=float)
+SINGLE_FLIGHT_POLL_INTERVAL = config('SINGLE_FLIGHT_POLL_INTERVAL', default=0.05, cast=float)
+
+# Define the price cache settings. Entries are served directly for SOFT_TTL seconds, served stale
+# while a background refresh runs until HARD_TTL seconds, and fetched synchronously after that.
+PRICE_CACHE_SOFT_TTL = config('PRICE_CACHE_SOFT_TTL', default=60 * 10, cast=int)
+PRICE_CACHE_HARD_TTL = config('PRICE_CACHE_HARD_TTL', default=60 * 30, cast=int)
+PRICE_REFRESH_WORKERS = config('PRICE_REFRESH_WORKERS', default=4, cast=int)
+
+# Define the in-process L1 cache in front of Redis. Hot price entries are kept in memory for at most
+# PRICE_L1_TTL seconds, bounded by entry count and total size. Entries refreshed or bypassed by one
+# worker are dropped from every other worker's L1 through the invalidation channel.
+PRICE_L1_TTL = config('PRICE_L1_TTL', default=30, cast=int)
+PRICE_L1_MAX_ENTRIES = config('PRICE_L1_MAX_ENTRIES', default=5000, cast=int)
+PRICE_L1_MAX_BYTES = config('PRICE_L1_MAX_BYTES', default=16 * 1024 * 1024, cast=int)
+L1_INVALIDATION_CHANNEL = config('L1_INVALIDATION_CHANNEL', default='flights:l1:invalidate')
+
+# Define the batch price settings. A batch may hold at most MAX_SIZE searches and must finish within
+# DEADLINE seconds.
+PRICE_BATCH_MAX_SIZE = config('PRICE_BATCH_MAX_SIZE', default=50, cast=int)
+PRICE_BATCH_DEADLINE = config('PRICE_BATCH_DEADLINE', default=8, cast=float)
+
+# Define the date range settings. A window may span at most MAX_DAYS days, and at most
+# MAX_CONCURRENCY of its uncached days are fetched at the same time.
+PRICE_RANGE_MAX_DAYS = config('PRICE_RANGE_MAX_DAYS', default=31, cast=int)
+PRICE_RANGE_MAX_CONCURRENCY = config('PRICE_RANGE_MAX_CONCURRENCY', default=6, cast=int)
+
+# Define the number of threads per process that fetch the misses of batch and date range lookups
+PRICE_FANOUT_WORKERS = config('PRICE_FANOUT_WORKERS', default=16, cast=int)
+
+# Define the negative cache settings. Searches that Amadeus answered without an offer (no service on
+# that date, unknown location) are cached for NEGATIVE_CACHE_TTL seconds. The last price fetched for
+# each search is kept for LAST_GOOD_TTL seconds, to be served while the circuit breaker is open.
+PRICE_NEGATIVE_CACHE_TTL = config('PRICE_NEGATIVE_CACHE_TTL', default=60, cast=int)
+PRICE_LAST_GOOD_TTL = config('PRICE_LAST_GOOD_TTL', default=60 * 60 * 24, cast=int)
+
+# Define the circuit breaker settings. After FAILURE_THRESHOLD failures, timeouts or 5xx responses
+# within WINDOW seconds, every worker stops calling Amadeus for OPEN_SECONDS seconds. After that one
+# probe request at a time is let through, and a probe holds its slot for at most PROBE_TIMEOUT seconds.
+AMADEUS_BREAKER_FAILURE_THRESHOLD = config('AMADEUS_BREAKER_FAILURE_THRESHOLD', default=5, cast=int)
+AMADEUS_BREAKER_WINDOW = config('AMADEUS_BREAKER_WINDOW', default=30, cast=int)
+AMADEUS_BREAKER_OPEN_SECONDS = config('AMADEUS_BREAKER_OPEN_SECONDS', default=30, cast=int)
+AMADEUS_BREAKER_PROBE_TIMEOUT = config('AMADEUS_BREAKER_PROBE_TIMEOUT', default=15, cast=int)
+
+# Define the location index used to validate IATA codes and resolve airports to their city. The index
+# file is rebuilt from the CSV with `manage.py refresh_location_index`.
+LOCATION_CSV_PATH = config('LOCATION_CSV_PATH', default=str(BASE_DIR / 'flights' / 'data' / 'locations.csv'))
+LOCATION_INDEX_PATH = config('LOCATION_INDEX_PATH', default=str(BASE_DIR / 'flights' / 'data' / 'locations.idx'))
+
+# Define the metrics settings. Each process adds its stage timings and counters to the METRICS_REDIS_KEY
+# hash every METRICS_FLUSH_INTERVAL seconds, and /flights/metrics/ renders the totals of all workers.
+METRICS_REDIS_KEY = config('METRICS_REDIS_KEY', default='flights:metrics')
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=10, cast=float)
+
+# Define the popularity settings. Each price request adds to a search's score, which halves every
+# HALF_LIFE seconds. Processes add their counts to Redis every FLUSH_INTERVAL seconds, and at most
+# MAX_MEMBERS searches are ranked.
+POPULARITY_REDIS_KEY = config('POPULARITY_REDIS_KEY', default='flights:popular')
+POPULARITY_HALF_LIFE = config('POPULARITY_HALF_LIFE', default=60 * 60, cast=int)
+POPULARITY_FLUSH_INTERVAL = config('POPULARITY_FLUSH_INTERVAL', default=5, cast=float)
+POPULARITY_MAX_MEMBERS = config('POPULARITY_MAX_MEMBERS', default=10000, cast=int)
+
+# Define the cache warming settings of `manage.py warm_price_cache`. Each run refreshes the TOP most
+# popular searches that are missing or within LEAD seconds of going stale, fetching at most BUDGET of
+# them, CONCURRENCY at a time. With --loop a run starts every INTERVAL seconds.
+PRICE_WARM_TOP = config('PRICE_WARM_TOP', default=500, cast=int)
+PRICE_WARM_BUDGET = config('PRICE_WARM_BUDGET', default=100, cast=int)
+PRICE_WARM_CONCURRENCY = config('PRICE_WARM_CONCURRENCY', default=4, cast=int)
+PRICE_WARM_LEAD = config('PRICE_WARM_LEAD', default=120, cast=int)
+PRICE_WARM_INTERVAL = config('PRICE_WARM_INTERVAL', default=60, cast=float)
+
+# Define how many offers the price endpoints return at most, when a client asks for more than the
+# cheapest offer with `max`
+AMADEUS_OFFERS_MAX = config('AMADEUS_OFFERS_MAX', default=20, cast=int)
+# Define how many offers a flight-offers search asks Amadeus for (250 at most) once a client asks for
+# more than one offer or filters or sorts them; other searches only ask for the cheapest offer. They
+# are cached with the search, and `nonStop`, `maxPrice` and `sort` are applied to them locally, so the
+# window must be wide enough to hold the offers that match a filter, not only the cheapest ones
+AMADEUS_OFFERS_WINDOW = config('AMADEUS_OFFERS_WINDOW', default=250, cast=int)
+
+# Define the price history settings. Every price fetched is buffered in memory and written to the
+# database in batches of up to BATCH_SIZE rows, at least every FLUSH_INTERVAL seconds. At most
+# MAX_PENDING rows are buffered while the database is slow or down, newer prices are dropped beyond.
+PRICE_HISTORY_FLUSH_INTERVAL = config('PRICE_HISTORY_FLUSH_INTERVAL', default=2, cast=float)
+PRICE_HISTORY_BATCH_SIZE = config('PRICE_HISTORY_BATCH_SIZE', default=500, cast=int)
+PRICE_HISTORY_MAX_PENDING = config('PRICE_HISTORY_MAX_PENDING', default=10000, cast=int)
+
+# Define the latency budget of a price request. A cache miss waits at most DEADLINE seconds for
+# Amadeus, then gets the last known price while the fetch completes in the background and fills the
+# cache. Set it to 0 to wait for Amadeus however long it takes. The sync view runs its fetches on
+# a pool of DEADLINE_WORKERS threads. At most MAX_PENDING fetches per process may be running, queued
+# or left running by a request that gave up; past that, requests get the last known price at once.
+PRICE_REQUEST_DEADLINE = config('PRICE_REQUEST_DEADLINE', default=3, cast=float)
+PRICE_DEADLINE_WORKERS = config('PRICE_DEADLINE_WORKERS', default=32, cast=int)
+PRICE_DEADLINE_MAX_PENDING = config('PRICE_DEADLINE_MAX_PENDING', default=64, cast=int)
+
+# Define the logging settings. Messages of the flights app go to the console at LOG_LEVEL and above.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'flights': {'handlers': ['console'], 'level': config('LOG_LEVEL', default='INFO'), 'propagate': False},
+    },
+}
@@ -1,10 +1,15 @@
+import threading
+
+from django.http import HttpResponse
 from django.urls import path, include
 from rest_framework import permissions
+from rest_framework.response import Response
+from drf_yasg.renderers import OpenAPIRenderer, SwaggerJSONRenderer, SwaggerYAMLRenderer
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
 # Define the schema view for the Swagger UI
-schema_view = get_schema_view(
+BaseSchemaView = get_schema_view(
     openapi.Info(
         title="Flight Price API",
         default_version='v1',
@@ -16,9 +21,48 @@ schema_view = get_schema_view(
     permission_classes=(permissions.AllowAny,),
 )
 
+
+# The renderers of the OpenAPI document itself, as opposed to the Swagger UI and ReDoc pages
+SCHEMA_RENDERERS = (OpenAPIRenderer, SwaggerJSONRenderer, SwaggerYAMLRenderer)
+
+
+class SchemaView(BaseSchemaView):
+    """
+    The `SchemaView` class serves the OpenAPI document from memory. drf_yasg walks the URLconf and
+    inspects every view to build it, so it is built on the first request and the rendered bytes are
+    kept for the life of the process. The schema is public and the URLconf does not change at runtime,
+    so the only inputs are the format, the API version and the host and scheme it is served from.
+    The Swagger UI and ReDoc pages are cheap and still rendered on every request.
+    """
+    _rendered = {}
+    _lock = threading.Lock()
+
+    def schema_key(self, request, version):
+        return (request.accepted_renderer.format, request.version or version or '', request.scheme, request.get_host())
+
+    def get(self, request, version='', format=None):
+        if isinstance(request.accepted_renderer, SCHEMA_RENDERERS):
+            rendered = self._rendered.get(self.schema_key(request, version))
+            if rendered is not None:
+                content, content_type = rendered
+                return HttpResponse(content, content_type=content_type)
+        return super().get(request, version, format)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # Schemas served from memory are plain `HttpResponse`s, only a freshly built one is kept
+        if (isinstance(response, Response) and response.status_code == 200
+                and isinstance(request.accepted_renderer, SCHEMA_RENDERERS)):
+            # Render now instead of in the handler, so the bytes can be kept
+            response.render()
+            with self._lock:
+                self._rendered[self.schema_key(request, kwargs.get('version', ''))] = (response.content, response['Content-Type'])
+        return response
+
+
 # Define the URL patterns for the API
 urlpatterns = [
     path('flights/', include('flights.urls')), # Include the flights URLs
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),  # Swagger UI
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),  # ReDoc
+    path('swagger/', SchemaView.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),  # Swagger UI
+    path('redoc/', SchemaView.with_ui('redoc', cache_timeout=0), name='schema-redoc'),  # ReDoc
 ]
@@ -0,0 +1,6 @@
+from django.urls import path, include
+
+# Define the URL patterns of the lean API profile, see `settings_api`
+urlpatterns = [
+    path('flights/', include('flights.urls')), # Include the flights URLs
+]
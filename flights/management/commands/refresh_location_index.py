@@ -0,0 +1,30 @@
+# The `refresh_location_index` command rebuilds the binary location index from the locations CSV, e.g.
+# after adding airports to `flights/data/locations.csv` or pointing it at a newer export. With
+# `--ourairports`, the airports of an OurAirports `airports.csv` export are first added to the CSV.
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.services.locations import merge_ourairports, read_locations_csv, write_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the IATA location index file from a CSV with iata_code, city_code, sub_type and name columns."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', default=settings.LOCATION_CSV_PATH, help="The CSV to read the locations from.")
+        parser.add_argument('--ourairports', help="An OurAirports airports.csv (or .csv.gz) export whose airports are added to the CSV first.")
+        parser.add_argument('--output', default=settings.LOCATION_INDEX_PATH, help="The index file to write.")
+
+    def handle(self, *args, **options):
+        if options['ourairports']:
+            try:
+                added = merge_ourairports(options['csv'], options['ourairports'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not merge {options['ourairports']}: {e}")
+            self.stdout.write(f"Added {added} airports from {options['ourairports']} to {options['csv']}.")
+        try:
+            rows = read_locations_csv(options['csv'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {options['csv']}: {e}")
+        count = write_index(rows, options['output'])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} locations to {options['output']}."))
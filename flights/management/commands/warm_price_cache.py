@@ -0,0 +1,48 @@
+# The `warm_price_cache` command refreshes the prices of the most requested searches shortly before
+# they go stale, so hot routes are always served from the cache. Run it once, e.g. from cron, or keep
+# it running with `--loop`. Its upstream calls go through the same rate limiter as user traffic.
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.services.popularity import warm_popular_prices
+
+
+class Command(BaseCommand):
+    help = "Refresh the cached prices of the most popular searches before they go stale."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=settings.PRICE_WARM_TOP,
+                            help="How many of the most popular searches to keep warm.")
+        parser.add_argument('--budget', type=int, default=settings.PRICE_WARM_BUDGET,
+                            help="The most searches fetched from Amadeus per run.")
+        parser.add_argument('--concurrency', type=int, default=settings.PRICE_WARM_CONCURRENCY,
+                            help="How many searches are fetched at the same time.")
+        parser.add_argument('--lead', type=int, default=settings.PRICE_WARM_LEAD,
+                            help="Refresh prices this many seconds before they go stale.")
+        parser.add_argument('--loop', action='store_true', help="Keep running, one run every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=settings.PRICE_WARM_INTERVAL,
+                            help="The seconds between the start of two runs with --loop.")
+
+    def handle(self, *args, **options):
+        if min(options['top'], options['budget'], options['concurrency']) < 1:
+            raise CommandError("--top, --budget and --concurrency must be at least 1.")
+        # A run must come round again before the prices it skipped go stale
+        if options['loop'] and options['interval'] >= options['lead']:
+            self.stderr.write(self.style.WARNING(
+                f"--interval ({options['interval']:g}s) is not shorter than --lead ({options['lead']}s), "
+                "some hot prices will go stale between runs."
+            ))
+
+        while True:
+            started = time.monotonic()
+            stats = warm_popular_prices(options['top'], options['budget'], options['concurrency'], options['lead'])
+            self.stdout.write(
+                f"Warmed {stats['warmed']} of {stats['due']} due searches in {time.monotonic() - started:.1f}s "
+                f"({stats['ranked']} ranked, {stats['failed']} failed, {stats['skipped']} skipped, "
+                f"{stats['over_budget']} over budget, {stats['expired']} expired)"
+            )
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
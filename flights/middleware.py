@@ -0,0 +1,45 @@
+# The `ServerTimingMiddleware` class adds a `Server-Timing` header to every response, with the time
+# spent in each stage timed during the request (cache, token, amadeus, serialize) and in total, so
+# slow requests can be broken down from the browser's network panel or any HTTP client. Streaming
+# responses get no header: their stages run while the body is sent, after the headers.
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .services.metrics import finish_request, start_request
+
+
+class ServerTimingMiddleware:
+    """
+    The `ServerTimingMiddleware` class supports both sync and async views, so the async price endpoint
+    is timed without being switched to a thread. It should be the first middleware, so the total
+    covers the others too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            server_timing = finish_request(token)
+        # The stages of a streaming response run while its body is consumed, after the header is sent
+        if not response.streaming:
+            response['Server-Timing'] = server_timing
+        return response
+
+    async def __acall__(self, request):
+        token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            server_timing = finish_request(token)
+        if not response.streaming:
+            response['Server-Timing'] = server_timing
+        return response
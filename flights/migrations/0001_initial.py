@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(max_length=3)),
+                ('destination', models.CharField(max_length=3)),
+                ('departure_date', models.DateField()),
+                ('adults', models.PositiveSmallIntegerField(default=1)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12, null=True)),
+                ('currency', models.CharField(blank=True, max_length=3)),
+                ('data', models.JSONField()),
+                ('observed_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['origin', 'destination', 'departure_date', 'adults', '-observed_at'], name='price_observation_search_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='priceobservation',
+            name='requested_currency',
+            field=models.CharField(max_length=3, null=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='priceobservation',
+            name='price_observation_search_idx',
+        ),
+        migrations.AddIndex(
+            model_name='priceobservation',
+            index=models.Index(fields=['origin', 'destination', 'departure_date', 'adults', 'requested_currency', '-observed_at'], name='price_observation_search_idx'),
+        ),
+    ]
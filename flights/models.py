@@ -1,3 +1,39 @@
 from django.db import models
 
-# Create your models here.
+
+# The `requested_currency` of observations fetched in the Amadeus default currency. It is not a letter,
+# so it cannot be mistaken for an ISO 4217 code
+DEFAULT_CURRENCY_MARKER = '-'
+
+
+class PriceObservation(models.Model):
+    """
+    The `PriceObservation` model keeps every price fetched from the Amadeus API, so a price outlives
+    its cache entry. The most recent observation of a search is served when Amadeus cannot answer in
+    time, and the history can be used to follow how the price of a route moves.
+    """
+    origin = models.CharField(max_length=3)
+    destination = models.CharField(max_length=3)
+    departure_date = models.DateField()
+    adults = models.PositiveSmallIntegerField(default=1)
+    # The total of the offer and its currency, split out of `data` so prices can be queried
+    price = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    currency = models.CharField(max_length=3, blank=True)
+    # The currency the search asked for, or `DEFAULT_CURRENCY_MARKER` if it used the Amadeus default.
+    # Rows written before it was kept are `NULL` and never served as a fallback price
+    requested_currency = models.CharField(max_length=3, null=True)
+    # The serialized flight offer, as returned by the price endpoints
+    data = models.JSONField()
+    observed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Serves the latest observation of a search, and the history of a route and date
+            models.Index(
+                fields=['origin', 'destination', 'departure_date', 'adults', 'requested_currency', '-observed_at'],
+                name='price_observation_search_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.origin}-{self.destination} {self.departure_date}: {self.price} {self.currency}"
@@ -2,6 +2,46 @@
 # origin, destination, departure date, and return date.
 from rest_framework import serializers
 
+from .services.locations import get_location_index
+
+
+def flight_offer_summary(instance, location_dict=None):
+    """
+    The function `flight_offer_summary` extracts the origin, destination, departure date and price of a
+    flight offer returned by the Amadeus API. It is what `FlightOfferSerializer` returns, without
+    building a serializer instance, so the price endpoints call it directly.
+
+    :param instance: One flight offer from the `data` list of the Amadeus response.
+    :param location_dict: An optional dictionary mapping airport codes to location information, used to
+    replace the destination airport with its city code. Defaults to the bundled location index.
+    :return: A dict with the `origin`, `destination`, `departure_date` and `price` of the offer.
+    """
+    # Extract the departure and arrival information from the first and last segments of the first
+    # itinerary of the flight offer
+    itinerary = instance['itineraries'][0] if 'itineraries' in instance and instance['itineraries'] else {}
+    departure = itinerary['segments'][0]['departure'] if 'segments' in itinerary and itinerary['segments'] else {}
+    arrival = itinerary['segments'][-1]['arrival'] if 'segments' in itinerary and itinerary['segments'] else {}
+    price_data = instance['price']
+
+    # This line of code retrieves the destination airport code from the arrival segment of the
+    # flight offer. It then uses the location dictionary to retrieve the city name for the
+    # destination airport.
+    destination_iata = arrival.get('iataCode', 'N/A')
+    if location_dict is None:
+        location_dict = get_location_index()
+    destination_city = location_dict.get(destination_iata, {}).get('cityCode', destination_iata)
+
+    # This line of code returns a dictionary containing the origin, destination, departure date,
+    # and price information for the flight offer. It also includes the destination city name
+    # retrieved from the location dictionary.
+    return {
+        'origin': departure.get('iataCode', 'N/A'),
+        'destination': destination_city,
+        'departure_date': departure.get('at', '').split('T')[0],
+        'price': f"{price_data.get('total', 'N/A')} {price_data.get('currency', 'N/A')}"
+    }
+
+
 class FlightOfferSerializer(serializers.Serializer):
     # These lines of code are defining the fields for the FlightOfferSerializer class. Each field
     # corresponds to a specific attribute of a flight offer object. Here's a breakdown of each field:
@@ -13,32 +53,8 @@ class FlightOfferSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
         # This method is responsible for converting the flight offer object into a dictionary
-        # representation. It iterates through the itineraries and segments of the flight offer,
-        # extracting the departure and arrival information, and then formats the data into a
-        # dictionary with the necessary fields. 
-        itinerary = instance['itineraries'][0] if 'itineraries' in instance and instance['itineraries'] else {}
-        departure = itinerary['segments'][0]['departure'] if 'segments' in itinerary and itinerary['segments'] else {}
-        arrival = itinerary['segments'][-1]['arrival'] if 'segments' in itinerary and itinerary['segments'] else {}
-        price_data = instance['price']
-
-        # This line of code retrieves the location dictionary from the context, which is a dictionary
-        # containing information about the locations in the flight offer. It uses the destination
-        # airport code to retrieve the city name.
-        location_dict = self.context.get('location_dict', {})
-
-        # This line of code retrieves the destination airport code from the arrival segment of the
-        # flight offer. It then uses the location dictionary to retrieve the city name for the
-        # destination airport.
-        destination_iata = arrival.get('iataCode', 'N/A')
-        destination_city = location_dict.get(destination_iata, {}).get('cityCode', destination_iata)
-
-        # This line of code returns a dictionary containing the origin, destination, departure date,
-        # and price information for the flight offer. It also includes the destination city name
-        # retrieved from the location dictionary.
-        return {
-            'origin': departure.get('iataCode', 'N/A'),
-            'destination': destination_city,
-            'departure_date': departure.get('at', '').split('T')[0],
-            'price': f"{price_data.get('total', 'N/A')} {price_data.get('currency', 'N/A')}"
-        }
-
+        # representation. The extraction lives in `flight_offer_summary`, so the price endpoints can
+        # use it without building a serializer. The location dictionary from the context, or the
+        # bundled location index if none is given, is used to replace the destination airport with
+        # its city code.
+        return flight_offer_summary(instance, self.context.get('location_dict'))
@@ -1,56 +1,110 @@
 # The `AmadeusAPI` class in Python handles authentication and fetching flight offers from the Amadeus
 # API with error handling and caching.
-import requests
+import logging
+import time
+
+import httpx
 from requests.exceptions import RequestException, Timeout, HTTPError
 from django.conf import settings
-from django.core.cache import cache
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .http_client import aget, get_session, get_timeout
+from .metrics import metrics, timed
+from .credentials import get_credential_pool
+
+
+logger = logging.getLogger(__name__)
+
+# The error returned when no credential has a valid access token
+ACCESS_TOKEN_ERROR = "Could not fetch access token."
+
+# The error returned when the Amadeus quota stayed exhausted for longer than callers may queue
+RATE_LIMITED_ERROR = "Amadeus rate limit reached, try again later."
+
+# The error returned without calling Amadeus while the circuit breaker is open
+CIRCUIT_OPEN_ERROR = "Amadeus is unavailable, try again later."
+
+# The error returned when the call to Amadeus failed, e.g. a network error or a 5xx response
+FETCH_ERROR = "Failed to fetch flight offers due to an error."
 
+# The error returned when a price was not fetched within the time the caller could wait
+DEADLINE_ERROR = "Timed out fetching flight offers."
+
+# The errors returned when Amadeus answered, but has no offer for the search
+NO_FLIGHT_DATA_ERROR = "No flight data found in API response."
+NO_FLIGHTS_ERROR = "No flight offers found for this route and date."
+INVALID_SEARCH_ERROR = "Amadeus rejected the search, check the route and date."
+
+# Maps the errors that are not plain upstream failures to the HTTP status the views respond with
+ERROR_STATUSES = {
+    RATE_LIMITED_ERROR: 429,
+    CIRCUIT_OPEN_ERROR: 503,
+    DEADLINE_ERROR: 504,
+    NO_FLIGHTS_ERROR: 404,
+    INVALID_SEARCH_ERROR: 400,
+}
+
+# Stops every worker from calling Amadeus while it keeps failing or timing out
+amadeus_breaker = CircuitBreaker('amadeus')
+
+
+def error_status(error):
+    """
+    The function `error_status` returns the HTTP status for an error returned by `AmadeusAPI`.
+    """
+    return ERROR_STATUSES.get(error, 500)
 
 
 class AmadeusAPI:
     """
     The `AmadeusAPI` class is responsible for handling authentication and fetching flight offers from
     the Amadeus API. It provides methods for retrieving access tokens, fetching flight offers, and
-    handling errors and caching.
+    handling errors and caching. Each call goes to the least loaded credential of the pool, and moves
+    to another one if its credential is throttled or rejected.
     """
     def __init__(self):
-       
-        self.client_id = settings.AMADEUS_CLIENT_ID
-        self.client_secret = settings.AMADEUS_CLIENT_SECRET
-        self.token_url = "https://test.api.amadeus.com/v1/security/oauth2/token"
-        self.api_url = "https://test.api.amadeus.com/v2/shopping/flight-offers"
+        self.api_url = f"{settings.AMADEUS_BASE_URL}/v2/shopping/flight-offers"
+        # Share the process-wide session so connections are pooled and kept alive between calls
+        self.session = get_session()
+        # Share the process-wide credentials, so each token is refreshed once for every request and each
+        # rate limit is shared by every call
+        self.pool = get_credential_pool()
 
-    def get_access_token(self):
+    def get_access_token(self, credential):
         """
-        The function `get_access_token` retrieves an access token using client credentials and caches it
-        for future use, handling potential errors gracefully.
+        The function `get_access_token` retrieves an access token for a credential from its shared token
+        manager, which caches it for as long as the server says it is valid and refreshes it shortly
+        before expiry.
         :return: The `get_access_token` method returns the access token retrieved from the token URL. If
         there is an error during the process of fetching the token, it returns `None`.
         """
-        try:
-            # Check if the token URL is in the cache
-            cached_data = cache.get(self.token_url)
-            if cached_data:
-                return cached_data
-
-            # Create the payload for the token request
-            payload = {
-                'grant_type': 'client_credentials',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret
-            }
-            # Send the token request and handle potential errors    
-            response = requests.post(self.token_url, data=payload, timeout=10)  # Add timeout for the request
-            response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
-            # Cache the access token for 30 minutes
-            cache.set(self.token_url, response.json().get('access_token'), timeout=60 * 30)
-            # Return the access token
-            return response.json().get('access_token')
-        except (RequestException, Timeout, HTTPError) as e:
-            print(f"Failed to retrieve access token: {e}")
-            return None  # Return None if there's an error fetching the token
+        with timed('token'):
+            return credential.token_manager.get_token()
+
+    async def aget_access_token(self, credential):
+        """
+        The function `aget_access_token` is the async version of `get_access_token`.
+        """
+        with timed('token'):
+            return await credential.token_manager.aget_token()
+
+    def offer_params(self, origin, destination, departure_date, adults, currency=None, max_offers=1):
+        """
+        The function `offer_params` builds the query parameters of a flight-offers search.
+        :param max_offers: How many offers to ask for, the cheapest first. Only searches whose offers are
+        filtered and sorted locally need more than one.
+        """
+        params = {
+            'originLocationCode': origin,
+            'destinationLocationCode': destination,
+            'departureDate': departure_date,
+            'adults': adults,
+            'max': max_offers
+        }
+        if currency:
+            params['currencyCode'] = currency
+        return params
 
-    def fetch_flight_offers(self, origin, destination, departure_date, adults=1):
+    def fetch_flight_offers(self, origin, destination, departure_date, adults=1, currency=None, max_offers=1):
         """
         The function fetches flight offers using an API, handling errors and returning relevant data or
         error messages.
@@ -68,36 +122,188 @@ class AmadeusAPI:
         number of adult passengers for whom flight offers are being fetched. By default, it is set to 1,
         but you can specify a different number if needed. This parameter allows the function to
         customize the flight search based, defaults to 1 (optional)
+        :param currency: The ISO 4217 code of the currency the prices are quoted in, or `None` for the
+        Amadeus default (optional)
+        :param max_offers: How many offers to ask for, the cheapest first, defaults to 1 (optional)
         :return: The `fetch_flight_offers` method returns flight data if available in the API response,
         or an error message if there was an issue during the process of fetching flight offers.
         """
-        # Get the access token
-        token = self.get_access_token()
-        # Check if the access token is available
-        if not token:
-            return {"error": "Could not fetch access token."}  # Early exit if token retrieval fails
-        # Create the headers and parameters for the API request
-        headers = {'Authorization': f'Bearer {token}'}
-        params = {
-            'originLocationCode': origin,
-            'destinationLocationCode': destination,
-            'departureDate': departure_date,
-            'adults': adults,
-            'max': 1
-        }
+        # Create the parameters for the API request
+        params = self.offer_params(origin, destination, departure_date, adults, currency, max_offers)
+        # Every credential tried for this search shares the time the caller may queue
+        deadline = time.monotonic() + settings.AMADEUS_RATE_LIMIT_MAX_WAIT
+        tried = []
+        error = RATE_LIMITED_ERROR
         try:
-            # Send the API request and handle potential errors
-            response = requests.get(self.api_url, headers=headers, params=params, timeout=10)
-            # Raises an HTTPError for 4xx or 5xx responses
-            response.raise_for_status()
-            # Check if the response contains flight data
-            data = response.json()
-            # Check if the response contains flight data
-            if 'data' not in data:
-                return {"error": "No flight data found in API response."}
-            # Return the flight data
-            return data['data']
+            while True:
+                credential = self.pool.choose(exclude=tried)
+                if credential is None:
+                    return {"error": error}
+                tried.append(credential)
+                # Get the access token, and try another credential if there is none
+                token = self.get_access_token(credential)
+                if not token:
+                    credential.cool_down(settings.AMADEUS_CREDENTIAL_AUTH_COOLDOWN)
+                    error = ACCESS_TOKEN_ERROR
+                    continue
+                # Send the API request and handle potential errors
+                response = self.get_offers(credential, token, params, deadline)
+                # The token was rejected, force one coordinated refresh and retry once with the new token
+                if response is not None and response.status_code == 401:
+                    token = credential.token_manager.force_refresh(token)
+                    response = self.get_offers(credential, token, params, deadline) if token else None
+                    if response is None or response.status_code == 401:
+                        credential.cool_down(settings.AMADEUS_CREDENTIAL_AUTH_COOLDOWN)
+                        error = ACCESS_TOKEN_ERROR
+                        continue
+                # The credential is throttled and another one is in rotation
+                if response is not None and response.status_code == 429:
+                    error = RATE_LIMITED_ERROR
+                    continue
+                return self.parse_offers(response)
+        # Amadeus kept failing, fail fast instead of waiting for another timeout
+        except CircuitOpenError:
+            return {"error": CIRCUIT_OPEN_ERROR}
         # Handle errors
         except (RequestException, Timeout, HTTPError) as e:
-            print(f"Failed to fetch flight offers: {e}")
-            return {"error": "Failed to fetch flight offers due to an error."}
+            logger.warning("Failed to fetch flight offers: %s", e)
+            return {"error": FETCH_ERROR}
+
+    def parse_offers(self, response):
+        """
+        The function `parse_offers` reads the flight offers from a flight-offers response of either
+        HTTP client.
+        :return: The list of flight offers, or a dict with the `error` message.
+        :raises: The HTTP client's error for other 4xx and 5xx responses and invalid JSON.
+        """
+        # The quota stayed exhausted for longer than we may queue
+        if response is None:
+            return {"error": RATE_LIMITED_ERROR}
+        # Amadeus rejects unknown locations and invalid dates with a 400
+        if response.status_code == 400:
+            return {"error": INVALID_SEARCH_ERROR}
+        # Raises an HTTPError for 4xx or 5xx responses
+        response.raise_for_status()
+        # Check if the response contains flight data
+        data = response.json()
+        # Check if the response contains flight data
+        if 'data' not in data:
+            return {"error": NO_FLIGHT_DATA_ERROR}
+        # The route has no service on that date
+        if not data['data']:
+            return {"error": NO_FLIGHTS_ERROR}
+        # Return the flight data
+        return data['data']
+
+    def get_offers(self, credential, token, params, deadline):
+        """
+        The function `get_offers` sends the flight-offers request through the circuit breaker and the
+        upstream limiter of `credential`. After a 429 the credential is paused in the whole cluster. The
+        response is returned so the caller can move to another credential, or, if there is none, the
+        request is sent again once the limiter allows, until `deadline`. Failures, timeouts and 5xx
+        responses are reported to the circuit breaker.
+        :return: The `requests.Response`, or `None` if no request could be sent before `deadline`.
+        :raises CircuitOpenError: If the circuit is open and no request was sent.
+        """
+        permit = amadeus_breaker.allow()
+        if permit is None:
+            raise CircuitOpenError()
+        headers = {'Authorization': f'Bearer {token}'}
+        limiter = credential.limiter
+        # Stays `None` if the limiter never let a request through
+        healthy = None
+        try:
+            while limiter.acquire(deadline):
+                response = None
+                try:
+                    with timed('amadeus'):
+                        response = self.session.get(self.api_url, headers=headers, params=params, timeout=get_timeout())
+                finally:
+                    metrics.incr('upstream_responses', response.status_code if response is not None else 'error')
+                    if response is None:
+                        limiter.release()
+                    else:
+                        limiter.release(response.status_code, response.headers.get('Retry-After'))
+                credential.record(response.status_code, response.headers.get('Retry-After'))
+                healthy = response.status_code < 500
+                if response.status_code != 429 or self.pool.has_alternative(credential):
+                    return response
+            return None
+        except RequestException:
+            healthy = False
+            raise
+        finally:
+            amadeus_breaker.record(permit, healthy)
+
+    async def aget_offers(self, credential, token, params, deadline):
+        """
+        The function `aget_offers` is the async version of `get_offers`.
+        """
+        permit = await amadeus_breaker.aallow()
+        if permit is None:
+            raise CircuitOpenError()
+        headers = {'Authorization': f'Bearer {token}'}
+        limiter = credential.limiter
+        healthy = None
+        try:
+            while await limiter.aacquire(deadline):
+                response = None
+                try:
+                    with timed('amadeus'):
+                        response = await aget(self.api_url, headers=headers, params=params)
+                finally:
+                    metrics.incr('upstream_responses', response.status_code if response is not None else 'error')
+                    if response is None:
+                        await limiter.arelease()
+                    else:
+                        await limiter.arelease(response.status_code, response.headers.get('Retry-After'))
+                await credential.arecord(response.status_code, response.headers.get('Retry-After'))
+                healthy = response.status_code < 500
+                if response.status_code != 429 or self.pool.has_alternative(credential):
+                    return response
+            return None
+        except httpx.HTTPError:
+            healthy = False
+            raise
+        finally:
+            await amadeus_breaker.arecord(permit, healthy)
+
+    async def afetch_flight_offers(self, origin, destination, departure_date, adults=1, currency=None, max_offers=1):
+        """
+        The function `afetch_flight_offers` is the async version of `fetch_flight_offers`. It uses the
+        shared async HTTP client, so the calling event loop is free while the request is in flight.
+        :return: Flight data if available in the API response, or an error message, exactly like
+        `fetch_flight_offers`.
+        """
+        params = self.offer_params(origin, destination, departure_date, adults, currency, max_offers)
+        deadline = time.monotonic() + settings.AMADEUS_RATE_LIMIT_MAX_WAIT
+        tried = []
+        error = RATE_LIMITED_ERROR
+        try:
+            while True:
+                credential = await self.pool.achoose(exclude=tried)
+                if credential is None:
+                    return {"error": error}
+                tried.append(credential)
+                token = await self.aget_access_token(credential)
+                if not token:
+                    await credential.acool_down(settings.AMADEUS_CREDENTIAL_AUTH_COOLDOWN)
+                    error = ACCESS_TOKEN_ERROR
+                    continue
+                response = await self.aget_offers(credential, token, params, deadline)
+                if response is not None and response.status_code == 401:
+                    token = await credential.token_manager.aforce_refresh(token)
+                    response = await self.aget_offers(credential, token, params, deadline) if token else None
+                    if response is None or response.status_code == 401:
+                        await credential.acool_down(settings.AMADEUS_CREDENTIAL_AUTH_COOLDOWN)
+                        error = ACCESS_TOKEN_ERROR
+                        continue
+                if response is not None and response.status_code == 429:
+                    error = RATE_LIMITED_ERROR
+                    continue
+                return self.parse_offers(response)
+        except CircuitOpenError:
+            return {"error": CIRCUIT_OPEN_ERROR}
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("Failed to fetch flight offers: %s", e)
+            return {"error": FETCH_ERROR}
@@ -0,0 +1,73 @@
+# The `async_cache` module gives the async request path non-blocking access to the same Redis cache
+# that the sync views use through `django.core.cache`. Keys are built with the cache's `make_key` and
+# values are encoded with the django-redis client's serializer, so both paths read and write the same
+# entries.
+import asyncio
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Async Redis clients are bound to the event loop they were created on, so there is one per running loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """
+    The function `get_client` returns the async Redis client for the running event loop, creating it
+    on first use.
+    :return: A `redis.asyncio.Redis` client backed by a connection pool.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(settings.REDIS_URL, max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS)
+        _clients[loop] = client
+    return client
+
+
+def make_key(key):
+    return cache.make_key(key)
+
+
+async def get(key, default=None):
+    """
+    The function `get` reads a value from the cache.
+    :return: The decoded value, or `default` if the key is not cached.
+    """
+    value = await get_client().get(make_key(key))
+    if value is None:
+        return default
+    return cache.client.decode(value)
+
+
+async def set(key, value, timeout):
+    """
+    The function `set` writes a value to the cache for `timeout` seconds.
+    """
+    await get_client().set(make_key(key), cache.client.encode(value), ex=int(timeout))
+
+
+async def add(key, value, timeout):
+    """
+    The function `add` writes a value to the cache only if the key does not exist yet.
+    :return: `True` if the value was written.
+    """
+    return bool(await get_client().set(make_key(key), cache.client.encode(value), ex=int(timeout), nx=True))
+
+
+async def delete(key):
+    """
+    The function `delete` removes a key from the cache.
+    """
+    await get_client().delete(make_key(key))
+
+
+def lock(key, timeout, blocking_timeout):
+    """
+    The function `lock` returns an async Redis lock on the same key as `cache.lock(key)`, so sync and
+    async callers exclude each other.
+    """
+    return get_client().lock(make_key(key), timeout=timeout, blocking_timeout=blocking_timeout)
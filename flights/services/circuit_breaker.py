@@ -0,0 +1,173 @@
+# The `CircuitBreaker` class stops sending requests to the Amadeus API while it is failing. After
+# `AMADEUS_BREAKER_FAILURE_THRESHOLD` failures or timeouts within `AMADEUS_BREAKER_WINDOW` seconds the
+# circuit opens and calls fail fast for `AMADEUS_BREAKER_OPEN_SECONDS`. It then lets one probe request
+# through at a time (half-open) and closes again once a probe succeeds. The state lives in Redis, so
+# every worker trips and recovers together.
+import threading
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import async_cache
+
+
+# The permits handed out by `allow`. A probe must report its outcome so the circuit can close or reopen.
+CLOSED = 'closed'
+PROBE = 'probe'
+
+
+class CircuitOpenError(Exception):
+    """
+    The `CircuitOpenError` exception is raised instead of sending a request while the circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    The `CircuitBreaker` class keeps the circuit state in three Redis keys: `open` holds the time the
+    circuit stays open until, `tripped` marks that the circuit has opened and not yet recovered, and
+    `failures` counts the failures of the current window. `probe` is held by the single half-open probe.
+    """
+    def __init__(self, name):
+        prefix = f"flights:breaker:{name}"
+        self.open_key = f"{prefix}:open"
+        self.tripped_key = f"{prefix}:tripped"
+        self.failures_key = f"{prefix}:failures"
+        self.probe_key = f"{prefix}:probe"
+        # The time this process knows the circuit is open until, so open checks skip Redis
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'rejected': 0, 'opened': 0, 'probes': 0, 'recovered': 0}
+
+    def _incr(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _decide(self, open_until, tripped):
+        # Returns whether a half-open probe is needed, or `None` if the call must be rejected
+        now = time.time()
+        if open_until is not None and now < float(open_until):
+            self._open_until = float(open_until)
+            self._incr('rejected')
+            return None
+        return tripped is not None
+
+    def allow(self):
+        """
+        The function `allow` checks whether a request may be sent to the Amadeus API.
+        :return: `CLOSED` or `PROBE` if the request may be sent, in which case its outcome must be
+        reported with `record`, or `None` if the circuit is open and the request must fail fast.
+        """
+        if time.time() < self._open_until:
+            self._incr('rejected')
+            return None
+        redis = get_redis_connection('default')
+        needs_probe = self._decide(*redis.mget(self.open_key, self.tripped_key))
+        if needs_probe is None:
+            return None
+        if not needs_probe:
+            return CLOSED
+        # Half-open: only the caller that takes the probe key may send a request
+        if redis.set(self.probe_key, 1, nx=True, ex=settings.AMADEUS_BREAKER_PROBE_TIMEOUT):
+            self._incr('probes')
+            return PROBE
+        self._incr('rejected')
+        return None
+
+    async def aallow(self):
+        """
+        The function `aallow` is the async version of `allow`.
+        """
+        if time.time() < self._open_until:
+            self._incr('rejected')
+            return None
+        redis = async_cache.get_client()
+        needs_probe = self._decide(*await redis.mget(self.open_key, self.tripped_key))
+        if needs_probe is None:
+            return None
+        if not needs_probe:
+            return CLOSED
+        if await redis.set(self.probe_key, 1, nx=True, ex=settings.AMADEUS_BREAKER_PROBE_TIMEOUT):
+            self._incr('probes')
+            return PROBE
+        self._incr('rejected')
+        return None
+
+    def record(self, permit, healthy):
+        """
+        The function `record` reports the outcome of a request that `allow` let through. A failed probe
+        reopens the circuit, a successful one closes it, and a failure while closed counts towards the
+        threshold.
+
+        :param permit: The permit returned by `allow`.
+        :param healthy: `False` if the request failed or timed out, or Amadeus answered with a 5xx.
+        `None` if no request was sent, e.g. because the rate limit queue timed out, which frees the
+        probe without deciding anything.
+        """
+        redis = get_redis_connection('default')
+        if permit == PROBE:
+            if healthy is None:
+                redis.delete(self.probe_key)
+            elif healthy:
+                redis.delete(self.tripped_key, self.failures_key, self.probe_key)
+                self._recovered()
+            else:
+                self._open(redis.pipeline())
+            return
+        if healthy is not False:
+            return
+        failures, _ = self._count_failure(redis.pipeline(transaction=True))
+        if failures >= settings.AMADEUS_BREAKER_FAILURE_THRESHOLD:
+            self._open(redis.pipeline())
+
+    async def arecord(self, permit, healthy):
+        """
+        The function `arecord` is the async version of `record`.
+        """
+        redis = async_cache.get_client()
+        if permit == PROBE:
+            if healthy is None:
+                await redis.delete(self.probe_key)
+            elif healthy:
+                await redis.delete(self.tripped_key, self.failures_key, self.probe_key)
+                self._recovered()
+            else:
+                await self._open(redis.pipeline())
+            return
+        if healthy is not False:
+            return
+        failures, _ = await self._count_failure(redis.pipeline(transaction=True))
+        if failures >= settings.AMADEUS_BREAKER_FAILURE_THRESHOLD:
+            await self._open(redis.pipeline())
+
+    def _count_failure(self, pipe):
+        # Count a failure and start the window on the first one in a single MULTI/EXEC, so a worker
+        # dying between the two commands cannot leave a failure counter without an expiry behind.
+        # Returns the pipeline result, which the async client needs awaited.
+        pipe.incr(self.failures_key)
+        pipe.expire(self.failures_key, settings.AMADEUS_BREAKER_WINDOW, nx=True)
+        return pipe.execute()
+
+    def _open(self, pipe):
+        # Open the circuit for every worker. The tripped marker outlives the open period so the next
+        # caller after it becomes the half-open probe. Returns the pipeline result, which the async
+        # client needs awaited.
+        open_seconds = settings.AMADEUS_BREAKER_OPEN_SECONDS
+        self._open_until = time.time() + open_seconds
+        self._incr('opened')
+        pipe.set(self.open_key, self._open_until, ex=open_seconds)
+        pipe.set(self.tripped_key, 1, ex=open_seconds * 10)
+        pipe.delete(self.failures_key, self.probe_key)
+        return pipe.execute()
+
+    def _recovered(self):
+        self._open_until = 0.0
+        self._incr('recovered')
+
+    def stats(self):
+        """
+        The function `stats` returns the breaker counters for this process.
+        """
+        with self._lock:
+            return dict(self._counters, open=time.time() < self._open_until)
@@ -0,0 +1,206 @@
+# The `SingleFlight` class coalesces identical concurrent lookups so that only one of them calls the
+# upstream API. Callers in the same process wait on an in-memory event, and callers in other
+# processes wait for a short Redis lease to be released and then read the result it filled. If the
+# lease is released without a result, the waiting processes race for it again, so only one of them
+# fetches next.
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from . import async_cache
+
+
+# Deletes the lease only if it still holds the owner's token, so a lease that expired during the fetch
+# and was taken by another process is left alone. The check and the delete run atomically in Redis.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class _Call:
+    """
+    The `_Call` class tracks one in-flight call within this process. Followers wait on `event` and
+    then read `result`, which the leader sets before releasing them.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    The `SingleFlight` class makes sure only one caller fetches a given key at a time, both within one
+    process and across processes, and counts how many calls were coalesced.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._calls = {}
+        self._lock = threading.Lock()
+        # In-flight async calls, one dict of futures per event loop
+        self._async_calls = weakref.WeakKeyDictionary()
+        self._counters = {
+            'leader': 0,
+            'coalesced_local': 0,
+            'coalesced_remote': 0,
+            'retaken': 0,
+            'fallback': 0,
+        }
+
+    def _incr(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        """
+        The function `stats` returns a snapshot of the coalescing counters for this process.
+        :return: A dict with the number of leader calls, calls coalesced within this process, calls
+        coalesced onto another process, waits that ended with the lease released without a result and
+        taken over by this process, and waits that timed out and fell back to fetching.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def do(self, key, fetch, read):
+        """
+        The function `do` returns the result for `key`, calling `fetch` only if no other caller is
+        already fetching the same key.
+
+        :param key: The key identifying the lookup, e.g. the price cache key.
+        :param fetch: A callable that performs the upstream call, fills the shared cache and returns
+        the result.
+        :param read: A callable that reads the result from the shared cache, returning `None` if it
+        is not there yet.
+        :return: The result of `fetch`, either from this caller or from the caller it waited on.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self._counters['coalesced_local'] += 1
+
+        if not leader:
+            # Another thread in this process is fetching, wait for it and share its result
+            if call.event.wait(timeout=settings.SINGLE_FLIGHT_MAX_WAIT):
+                return call.result
+            self._incr('fallback')
+            return fetch()
+
+        try:
+            call.result = self._do_shared(key, fetch, read)
+            return call.result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _do_shared(self, key, fetch, read):
+        """
+        The function `_do_shared` takes the Redis lease for `key` and fetches, or waits for the
+        process that holds the lease and reads the result it filled. If the lease is released without
+        a result (e.g. the fetch failed), it tries to take the lease again, so only one of the waiting
+        processes fetches next.
+        """
+        lease_key = f"{self.namespace}:lease:{key}"
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.SINGLE_FLIGHT_MAX_WAIT
+        waited = False
+        while True:
+            # `cache.add` only sets the key if it does not exist, so exactly one process gets the lease
+            if cache.add(lease_key, owner, timeout=settings.SINGLE_FLIGHT_LEASE_TIMEOUT):
+                self._incr('retaken' if waited else 'leader')
+                try:
+                    return fetch()
+                finally:
+                    self._release(lease_key, owner)
+
+            if not waited:
+                self._incr('coalesced_remote')
+                waited = True
+            while True:
+                if time.monotonic() >= deadline:
+                    self._incr('fallback')
+                    return fetch()
+                time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+                result = read()
+                if result is not None:
+                    return result
+                # The lease was released without a result, race for it again
+                if cache.get(lease_key) is None:
+                    break
+
+    def _release(self, lease_key, owner):
+        get_redis_connection('default').eval(RELEASE_SCRIPT, 1, cache.make_key(lease_key), cache.client.encode(owner))
+
+    async def ado(self, key, fetch, read):
+        """
+        The function `ado` is the async version of `do`. `fetch` and `read` are coroutine functions,
+        and callers on the same event loop wait on a future instead of an event.
+        """
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.setdefault(loop, {})
+        future = calls.get(key)
+        if future is not None:
+            self._incr('coalesced_local')
+            try:
+                # Shield the leader's future so a follower timing out does not cancel it
+                return await asyncio.wait_for(asyncio.shield(future), timeout=settings.SINGLE_FLIGHT_MAX_WAIT)
+            except asyncio.TimeoutError:
+                self._incr('fallback')
+                return await fetch()
+
+        future = calls[key] = loop.create_future()
+        try:
+            result = await self._ado_shared(key, fetch, read)
+            future.set_result(result)
+            return result
+        finally:
+            calls.pop(key, None)
+            if not future.done():
+                future.set_result(None)
+
+    async def _ado_shared(self, key, fetch, read):
+        """
+        The function `_ado_shared` is the async version of `_do_shared`, using the same Redis lease.
+        """
+        lease_key = f"{self.namespace}:lease:{key}"
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.SINGLE_FLIGHT_MAX_WAIT
+        waited = False
+        while True:
+            if await async_cache.add(lease_key, owner, timeout=settings.SINGLE_FLIGHT_LEASE_TIMEOUT):
+                self._incr('retaken' if waited else 'leader')
+                try:
+                    return await fetch()
+                finally:
+                    await self._arelease(lease_key, owner)
+
+            if not waited:
+                self._incr('coalesced_remote')
+                waited = True
+            while True:
+                if time.monotonic() >= deadline:
+                    self._incr('fallback')
+                    return await fetch()
+                await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+                result = await read()
+                if result is not None:
+                    return result
+                if await async_cache.get(lease_key) is None:
+                    break
+
+    async def _arelease(self, lease_key, owner):
+        await async_cache.get_client().eval(
+            RELEASE_SCRIPT, 1, async_cache.make_key(lease_key), cache.client.encode(owner),
+        )
@@ -0,0 +1,248 @@
+# The `credentials` module spreads the Amadeus calls over several sets of client credentials, so the
+# fleet is not capped at the quota of one account. Each credential has its own token manager and its
+# own upstream limiter (token bucket, pause after a 429 and adaptive concurrency), and each call goes
+# to the least loaded credential of this process.
+#
+# A credential that is throttled (429) or whose token is rejected (401) is taken out of rotation for a
+# while. The cooldown is stored in Redis so every worker skips it, and read back at most once per
+# `COOLDOWN_REFRESH_INTERVAL` seconds so choosing a credential costs no round trip. The async request
+# path uses the `a` variants, which talk to Redis without blocking the event loop.
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django_redis import get_redis_connection
+
+from . import async_cache
+from .rate_limiter import UpstreamLimiter, parse_retry_after
+from .token_manager import get_token_manager
+
+
+logger = logging.getLogger(__name__)
+
+# How often each process reads the cooldowns set by other workers, in seconds
+COOLDOWN_REFRESH_INTERVAL = 1.0
+
+
+class Credential:
+    """
+    The `Credential` class holds one Amadeus client ID and secret with the token manager and the
+    upstream limiter that belong to it.
+    """
+    def __init__(self, client_id, client_secret, token_url):
+        self.client_id = client_id
+        self.token_manager = get_token_manager(client_id, client_secret, token_url)
+        # Identifies the credential in Redis keys, the stats and logs without disclosing the client ID
+        self.label = self.token_manager.label
+        self.limiter = UpstreamLimiter(f"amadeus:{self.label}")
+        self.cooldown_key = f"flights:credential:{self.label}:cooldown"
+        # The time until which the credential is out of rotation, as far as this process knows
+        self.cooldown_until = 0.0
+        self.cooldowns = 0
+
+    def load(self):
+        """
+        The function `load` returns the share of this process's concurrency limit for the credential
+        that is in use.
+        """
+        return self.limiter.in_flight / max(1.0, self.limiter.limit)
+
+    def is_cooling_down(self, now):
+        return now < self.cooldown_until
+
+    def _start_cooldown(self, seconds):
+        # Applies the cooldown to this process, and returns the time it ends
+        until = time.time() + seconds
+        self.cooldown_until = max(self.cooldown_until, until)
+        self.cooldowns += 1
+        return until
+
+    def cool_down(self, seconds):
+        """
+        The function `cool_down` takes the credential out of rotation for `seconds` seconds in every
+        worker.
+        """
+        until = self._start_cooldown(seconds)
+        try:
+            get_redis_connection('default').set(self.cooldown_key, until, px=max(1, int(seconds * 1000)))
+        except Exception as e:
+            # The cooldown still applies to this process
+            logger.warning("Failed to share the cooldown of credential %s: %s", self.label, e)
+
+    async def acool_down(self, seconds):
+        """
+        The function `acool_down` is the async version of `cool_down`.
+        """
+        until = self._start_cooldown(seconds)
+        try:
+            await async_cache.get_client().set(self.cooldown_key, until, px=max(1, int(seconds * 1000)))
+        except Exception as e:
+            logger.warning("Failed to share the cooldown of credential %s: %s", self.label, e)
+
+    def throttle_cooldown(self, status_code, retry_after):
+        # The cooldown after a 429: the `Retry-After` delay or `AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN`
+        # seconds, whichever is longer. `None` for any other status
+        if status_code == 429:
+            return max(parse_retry_after(retry_after) or 0, settings.AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN)
+        return None
+
+    def record(self, status_code, retry_after=None):
+        """
+        The function `record` takes the credential out of rotation after a 429, for the `Retry-After`
+        delay or `AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN` seconds, whichever is longer.
+        """
+        seconds = self.throttle_cooldown(status_code, retry_after)
+        if seconds is not None:
+            self.cool_down(seconds)
+
+    async def arecord(self, status_code, retry_after=None):
+        """
+        The function `arecord` is the async version of `record`.
+        """
+        seconds = self.throttle_cooldown(status_code, retry_after)
+        if seconds is not None:
+            await self.acool_down(seconds)
+
+    def stats(self):
+        return {
+            'limiter': self.limiter.stats(),
+            'cooling_down_seconds': round(max(0.0, self.cooldown_until - time.time()), 1),
+            'cooldowns': self.cooldowns,
+        }
+
+
+class CredentialPool:
+    """
+    The `CredentialPool` class chooses the credential for each Amadeus call.
+    """
+    def __init__(self, credentials):
+        if not credentials:
+            raise ImproperlyConfigured("Set AMADEUS_CREDENTIALS, or AMADEUS_CLIENT_ID and AMADEUS_CLIENT_SECRET.")
+        self.credentials = credentials
+        self._lock = threading.Lock()
+        self._cooldowns_read_at = 0.0
+        # Breaks ties between equally loaded credentials in turn, so idle credentials share the load
+        self._turn = itertools.count()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def _refresh_due(self, now):
+        # Whether this process should read the cooldowns set by other workers, at most once per interval
+        if len(self.credentials) < 2:
+            return False
+        with self._lock:
+            if now - self._cooldowns_read_at < COOLDOWN_REFRESH_INTERVAL:
+                return False
+            self._cooldowns_read_at = now
+        return True
+
+    def _apply_cooldowns(self, values):
+        for credential, value in zip(self.credentials, values):
+            if value is not None:
+                credential.cooldown_until = max(credential.cooldown_until, float(value))
+
+    def _refresh_cooldowns(self, now):
+        # Picks up the cooldowns set by other workers
+        if not self._refresh_due(now):
+            return
+        try:
+            values = get_redis_connection('default').mget([credential.cooldown_key for credential in self.credentials])
+        except Exception:
+            # Keep the cooldowns known to this process until the next read
+            return
+        self._apply_cooldowns(values)
+
+    async def _arefresh_cooldowns(self, now):
+        if not self._refresh_due(now):
+            return
+        try:
+            values = await async_cache.get_client().mget([credential.cooldown_key for credential in self.credentials])
+        except Exception:
+            return
+        self._apply_cooldowns(values)
+
+    def choose(self, exclude=()):
+        """
+        The function `choose` returns the least loaded credential that is in rotation and not in
+        `exclude`. If every credential is cooling down, the first call of a request still gets the one
+        that comes back soonest, its limiter then waits for the end of the pause.
+        :param exclude: The credentials already tried for the current request.
+        :return: A `Credential`, or `None` if there is none left to try.
+        """
+        now = time.time()
+        self._refresh_cooldowns(now)
+        return self._pick(now, exclude)
+
+    async def achoose(self, exclude=()):
+        """
+        The function `achoose` is the async version of `choose`.
+        """
+        now = time.time()
+        await self._arefresh_cooldowns(now)
+        return self._pick(now, exclude)
+
+    def _pick(self, now, exclude):
+        candidates = [credential for credential in self.credentials if credential not in exclude]
+        available = [credential for credential in candidates if not credential.is_cooling_down(now)]
+        if available:
+            offset = next(self._turn)
+            return min(
+                available,
+                key=lambda credential: (credential.load(), (self.credentials.index(credential) - offset) % len(self.credentials)),
+            )
+        if candidates and not exclude:
+            return min(candidates, key=lambda credential: credential.cooldown_until)
+        return None
+
+    def has_alternative(self, credential):
+        """
+        The function `has_alternative` checks whether another credential is in rotation, so a throttled
+        call can move to it instead of waiting.
+        """
+        now = time.time()
+        return any(other is not credential and not other.is_cooling_down(now) for other in self.credentials)
+
+    def stats(self):
+        # Keyed by label, the stats endpoint is public
+        return {credential.label: credential.stats() for credential in self.credentials}
+
+
+def parse_credentials(values):
+    """
+    The function `parse_credentials` reads `AMADEUS_CREDENTIALS`, a list of `client_id:client_secret`
+    pairs.
+    :return: A list of `(client_id, client_secret)` tuples.
+    """
+    pairs = []
+    for value in values:
+        client_id, separator, client_secret = value.strip().partition(':')
+        if not separator or not client_id or not client_secret:
+            raise ImproperlyConfigured("AMADEUS_CREDENTIALS must be a comma-separated list of client_id:client_secret pairs.")
+        pairs.append((client_id, client_secret))
+    return pairs
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_credential_pool():
+    """
+    The function `get_credential_pool` returns the process-wide credential pool, built on first use from
+    `AMADEUS_CREDENTIALS`, or from `AMADEUS_CLIENT_ID` and `AMADEUS_CLIENT_SECRET` if it is empty.
+    :return: The `CredentialPool`.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pairs = parse_credentials(settings.AMADEUS_CREDENTIALS)
+                if not pairs and settings.AMADEUS_CLIENT_ID and settings.AMADEUS_CLIENT_SECRET:
+                    pairs = [(settings.AMADEUS_CLIENT_ID, settings.AMADEUS_CLIENT_SECRET)]
+                token_url = f"{settings.AMADEUS_BASE_URL}/v1/security/oauth2/token"
+                _pool = CredentialPool([Credential(client_id, client_secret, token_url) for client_id, client_secret in pairs])
+    return _pool
@@ -0,0 +1,172 @@
+# The `http_client` module owns the process-wide `requests.Session` used to talk to the Amadeus API,
+# so that every request reuses pooled keep-alive connections instead of paying a new TCP and TLS
+# handshake on each call. It also owns the shared `httpx.AsyncClient` used by the async request path.
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+
+_session = None
+_session_lock = threading.Lock()
+
+# Async clients are bound to the event loop they were created on, so there is one per running loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_retry_budget():
+    """
+    The function `get_retry_budget` returns how long the retries of one call may take, counted from its
+    first failure. It never exceeds the request deadline, when there is one.
+    :return: The retry budget in seconds.
+    """
+    if settings.PRICE_REQUEST_DEADLINE > 0:
+        return min(settings.AMADEUS_HTTP_RETRY_BUDGET, settings.PRICE_REQUEST_DEADLINE)
+    return settings.AMADEUS_HTTP_RETRY_BUDGET
+
+
+class BudgetRetry(Retry):
+    """
+    The `BudgetRetry` class is a `Retry` that stops retrying once the next attempt would start more
+    than `budget` seconds after the first failure, and that never retries a read that timed out: the
+    upstream was too slow, and another attempt would only make the call wait a read timeout again.
+    """
+    def __init__(self, *args, budget=None, first_failure=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+        self.first_failure = first_failure
+
+    def new(self, **kwargs):
+        # `increment` calls `new` after each failure, so the first call stamps the first failure
+        retry = super().new(**kwargs)
+        retry.budget = self.budget
+        retry.first_failure = self.first_failure if self.first_failure is not None else time.monotonic()
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+    def is_exhausted(self):
+        if self.budget is not None and self.first_failure is not None:
+            if time.monotonic() + self.get_backoff_time() - self.first_failure >= self.budget:
+                return True
+        return super().is_exhausted()
+
+
+def build_session():
+    """
+    The function `build_session` creates a `requests.Session` with a bounded connection pool and a
+    retry policy that only applies to idempotent methods.
+    :return: A new `requests.Session` configured from the `AMADEUS_HTTP_*` settings.
+    """
+    # Retry failed reads and 5xx statuses of idempotent requests (GET) only, with exponential backoff
+    # between attempts. Failed connection attempts are retried for every method, the OAuth POST too,
+    # since the request never reached the server. All retries of a call fit in the retry budget
+    retry = BudgetRetry(
+        total=settings.AMADEUS_HTTP_MAX_RETRIES,
+        connect=settings.AMADEUS_HTTP_MAX_RETRIES,
+        read=settings.AMADEUS_HTTP_MAX_RETRIES,
+        status=settings.AMADEUS_HTTP_MAX_RETRIES,
+        backoff_factor=settings.AMADEUS_HTTP_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+        # A 429 is returned as is, so the upstream limiter pauses the credential and the call can move
+        # to another credential, rather than urllib3 sleeping through the Retry-After delay
+        respect_retry_after_header=False,
+        budget=get_retry_budget(),
+    )
+    # Bound the number of kept-alive connections per host. Connections opened beyond the bound
+    # during a burst are closed after use rather than kept in the pool.
+    adapter = HTTPAdapter(
+        pool_connections=settings.AMADEUS_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.AMADEUS_HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    The function `get_session` returns the shared session for this process, creating it on first use.
+    The session and its connection pool are safe to share between worker threads.
+    :return: The process-wide `requests.Session`.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            # Check again under the lock in case another thread created it first
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def get_timeout():
+    """
+    The function `get_timeout` returns the (connect, read) timeout tuple used for outbound calls.
+    :return: A tuple of the connect and read timeouts in seconds.
+    """
+    return (settings.AMADEUS_HTTP_CONNECT_TIMEOUT, settings.AMADEUS_HTTP_READ_TIMEOUT)
+
+
+def get_async_client():
+    """
+    The function `get_async_client` returns the shared async client for the running event loop,
+    creating it on first use. Under ASGI there is one loop per process, so every async request shares
+    one connection pool.
+    :return: The `httpx.AsyncClient` for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.AMADEUS_HTTP_READ_TIMEOUT, connect=settings.AMADEUS_HTTP_CONNECT_TIMEOUT),
+            # The transport owns the pool, so the limits go to it: the client ignores its own `limits`
+            # once a transport is given. It only retries failed connection attempts, status retries
+            # happen in `aget`
+            transport=httpx.AsyncHTTPTransport(
+                retries=settings.AMADEUS_HTTP_MAX_RETRIES,
+                limits=httpx.Limits(
+                    max_connections=settings.AMADEUS_ASYNC_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.AMADEUS_HTTP_POOL_MAXSIZE,
+                ),
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def aget(url, **kwargs):
+    """
+    The function `aget` sends a GET request with the shared async client, retrying on the same
+    statuses, with the same backoff and within the same retry budget as the sync session.
+    :return: The last `httpx.Response` received.
+    """
+    client = get_async_client()
+    attempt = 0
+    first_failure = None
+    while True:
+        response = await client.get(url, **kwargs)
+        if response.status_code not in (502, 503, 504) or attempt >= settings.AMADEUS_HTTP_MAX_RETRIES:
+            return response
+        # Back off exponentially between attempts, like urllib3's Retry does for the sync session, and
+        # give up when the next attempt would start past the retry budget
+        backoff = settings.AMADEUS_HTTP_BACKOFF_FACTOR * (2 ** attempt)
+        now = time.monotonic()
+        first_failure = first_failure if first_failure is not None else now
+        if now + backoff - first_failure >= get_retry_budget():
+            return response
+        await asyncio.sleep(backoff)
+        attempt += 1
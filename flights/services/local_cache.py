@@ -0,0 +1,300 @@
+# The `local_cache` module provides the in-process L1 cache that sits in front of Redis. Hot keys are
+# served from memory without a network round trip or unpickling, and entries refreshed by one worker
+# are dropped from every other worker's L1 through Redis pub/sub. A value read from Redis is kept in L1
+# no longer than its remaining Redis TTL, so a short-lived entry never outlives its Redis copy.
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from . import async_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    The `LocalCache` class is a thread-safe LRU cache bounded both by entry count and by the total
+    size of its values. Every entry also has its own TTL, which should be shorter than the Redis TTL
+    so a missed invalidation only serves an outdated value for a short time.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Maps each key to a `(value, expires_at, size)` tuple, least recently used first
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """
+        The function `get` returns the value for `key`, or `None` if it is missing or expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._counters['misses'] += 1
+                return None
+            value, expires_at, size = item
+            if time.monotonic() >= expires_at:
+                self._remove(key)
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl, size=None):
+        """
+        The function `set` stores `value` for `ttl` seconds, evicting the least recently used entries
+        until the cache fits its bounds again.
+        :param size: The size of the value in bytes. It is estimated from the pickled value if omitted.
+        """
+        if size is None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        # A value larger than the whole cache would only evict everything else
+        if size > self.max_bytes or ttl <= 0:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic() + ttl, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self._counters['evictions'] += 1
+
+    def delete(self, key):
+        """
+        The function `delete` drops `key` from the cache, if it is there.
+        """
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+                self._counters['invalidations'] += 1
+
+    def _remove(self, key):
+        # Must be called with the lock held
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """
+        The function `stats` returns a snapshot of the counters, entry count and size of the cache.
+        """
+        with self._lock:
+            return dict(self._counters, entries=len(self._data), bytes=self._bytes)
+
+
+class TwoTierCache:
+    """
+    The `TwoTierCache` class reads through the in-process L1 to Redis and writes to both. Every write
+    or invalidation is published on the invalidation channel, so the other workers drop their L1 copy.
+    """
+    def __init__(self, name, local, local_ttl):
+        self.name = name
+        self.local = local
+        self.local_ttl = local_ttl
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+        _register(self)
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self._counters['hits'] += hits
+            self._counters['misses'] += misses
+
+    def _fill(self, key, raw, pttl):
+        # Decodes a value read from Redis with its remaining TTL in milliseconds, and keeps it in L1 for
+        # at most that long. A PTTL of -1 means the key never expires
+        value = cache.client.decode(raw)
+        ttl = self.local_ttl if pttl == -1 else min(self.local_ttl, pttl / 1000)
+        self.local.set(key, value, ttl, size=len(raw))
+        return value
+
+    def get(self, key):
+        """
+        The function `get` returns the value for `key` from L1, falling back to Redis and filling L1.
+        :return: The cached value, or `None` if it is in neither tier.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        _ensure_listener()
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        pipe.get(cache.make_key(key))
+        pipe.pttl(cache.make_key(key))
+        raw, pttl = pipe.execute()
+        self._count(raw is not None, raw is None)
+        return None if raw is None else self._fill(key, raw, pttl)
+
+    def get_many(self, keys):
+        """
+        The function `get_many` returns the values for `keys`, reading every L1 miss from Redis with one
+        MGET.
+        :return: A dict with the keys that were found in either tier.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            _ensure_listener()
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            pipe.mget([cache.make_key(key) for key in missing])
+            for key in missing:
+                pipe.pttl(cache.make_key(key))
+            raws, *pttls = pipe.execute()
+            hits = 0
+            for key, raw, pttl in zip(missing, raws, pttls):
+                if raw is not None:
+                    found[key] = self._fill(key, raw, pttl)
+                    hits += 1
+            self._count(hits, len(missing) - hits)
+        return found
+
+    def set(self, key, value, timeout):
+        """
+        The function `set` writes `value` to Redis and L1, and tells the other workers to drop their
+        copy. The write and the invalidation go out in one pipeline.
+        """
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, values, timeout):
+        """
+        The function `set_many` writes several values to Redis and L1 in one pipeline, and tells the
+        other workers to drop their copies.
+        """
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(cache.make_key(key), cache.client.encode(value), ex=int(timeout))
+            pipe.publish(settings.L1_INVALIDATION_CHANNEL, _message(self.name, key))
+        pipe.execute()
+        for key, value in values.items():
+            self.local.set(key, value, min(self.local_ttl, int(timeout)))
+
+    def invalidate(self, key):
+        """
+        The function `invalidate` drops `key` from the L1 of every worker, leaving Redis untouched.
+        """
+        self.local.delete(key)
+        get_redis_connection('default').publish(settings.L1_INVALIDATION_CHANNEL, _message(self.name, key))
+
+    async def aget(self, key):
+        """
+        The function `aget` is the async version of `get`. L1 is read directly, it never blocks.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        _ensure_listener()
+        async with async_cache.get_client().pipeline(transaction=False) as pipe:
+            pipe.get(async_cache.make_key(key))
+            pipe.pttl(async_cache.make_key(key))
+            raw, pttl = await pipe.execute()
+        self._count(raw is not None, raw is None)
+        return None if raw is None else self._fill(key, raw, pttl)
+
+    async def aset(self, key, value, timeout):
+        """
+        The function `aset` is the async version of `set`.
+        """
+        async with async_cache.get_client().pipeline(transaction=False) as pipe:
+            pipe.set(async_cache.make_key(key), cache.client.encode(value), ex=int(timeout))
+            pipe.publish(settings.L1_INVALIDATION_CHANNEL, _message(self.name, key))
+            await pipe.execute()
+        self.local.set(key, value, min(self.local_ttl, int(timeout)))
+
+    async def ainvalidate(self, key):
+        """
+        The function `ainvalidate` is the async version of `invalidate`.
+        """
+        self.local.delete(key)
+        await async_cache.get_client().publish(settings.L1_INVALIDATION_CHANNEL, _message(self.name, key))
+
+    def stats(self):
+        """
+        The function `stats` returns the counters of both tiers.
+        """
+        with self._lock:
+            redis_stats = dict(self._counters)
+        return {'l1': self.local.stats(), 'redis': redis_stats}
+
+
+# Identifies this process in invalidation messages, so it ignores the ones it published itself. Both
+# the ID and the listener thread belong to the process that created them: a worker forked from a
+# parent that already had them (e.g. with `--preload`) makes its own
+_process_id = None
+_process_id_pid = None
+_caches = {}
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _get_process_id():
+    global _process_id, _process_id_pid
+    pid = os.getpid()
+    if _process_id_pid != pid:
+        with _listener_lock:
+            if _process_id_pid != pid:
+                _process_id = uuid.uuid4().hex
+                _process_id_pid = pid
+    return _process_id
+
+
+def _message(name, key):
+    return f"{_get_process_id()}|{name}|{key}"
+
+
+def _register(two_tier_cache):
+    _caches[two_tier_cache.name] = two_tier_cache
+
+
+def _ensure_listener():
+    """
+    The function `_ensure_listener` starts the thread that applies invalidations published by other
+    workers, the first time this process reads from Redis.
+    """
+    global _listener, _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    process_id = _get_process_id()
+    with _listener_lock:
+        if _listener_pid != pid:
+            _listener = threading.Thread(target=_listen, args=(process_id,), name='l1-invalidation', daemon=True)
+            _listener.start()
+            _listener_pid = pid
+
+
+def _listen(process_id):
+    # Subscribe to the invalidation channel and drop the named keys, reconnecting if Redis goes away
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.L1_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                sender, name, key = message['data'].decode().split('|', 2)
+                if sender == process_id or name not in _caches:
+                    continue
+                _caches[name].local.delete(key)
+        except Exception as e:
+            # Entries published while we were disconnected expire on their own through the L1 TTL
+            logger.warning("L1 invalidation listener failed, reconnecting: %s", e)
+            time.sleep(1)
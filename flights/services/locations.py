@@ -0,0 +1,213 @@
+# The `locations` module holds the bundled index of airport and city IATA codes. It is used to reject
+# unknown codes before any cache or upstream work, and to resolve airports to their city code. The
+# bundled CSV holds a curated list of cities and their airports, followed by every other airport with
+# an IATA code from the public-domain OurAirports data (https://ourairports.com/data/).
+#
+# The index is built from `flights/data/locations.csv` into a compact binary file: an 8-byte header
+# followed by one fixed 7-byte record per code, sorted by code. Each record holds the 3-byte code, the
+# 3-byte city code and one byte for the sub type (`A` for airports, `C` for cities). The file is
+# memory-mapped once per process and searched with a binary search, so there is no dict per location
+# and every worker shares the same pages.
+import csv
+import gzip
+import logging
+import mmap
+import os
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'IATAIDX1'
+RECORD_SIZE = 7
+SUB_TYPES = {'AIRPORT': b'A', 'CITY': b'C'}
+SUB_TYPE_NAMES = {value: name for name, value in SUB_TYPES.items()}
+# The OurAirports types that are imported, best first when several airports share a code. Closed
+# airports keep their code in the data but can no longer be searched
+OURAIRPORTS_TYPES = ('large_airport', 'medium_airport', 'small_airport', 'seaplane_base', 'heliport')
+
+
+class LocationIndex:
+    """
+    The `LocationIndex` class looks codes up in a buffer laid out as described above, either a memory
+    map of the index file or bytes built from the CSV. It behaves like a read-only dict of
+    `{'iataCode', 'cityCode', 'subType'}` dicts, so it can be passed where a `location_dict` is
+    expected.
+    """
+    def __init__(self, buffer):
+        if buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("Not a location index file.")
+        self._buffer = buffer
+        self._count = (len(buffer) - len(INDEX_MAGIC)) // RECORD_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        # The code of the record at `position`, which lets `bisect` search the records directly
+        offset = len(INDEX_MAGIC) + position * RECORD_SIZE
+        return self._buffer[offset:offset + 3]
+
+    def _find(self, code):
+        # Returns the offset of the record for `code`, or `None` if it is not in the index
+        if not isinstance(code, str) or len(code) != 3 or not code.isascii():
+            return None
+        key = code.encode()
+        position = bisect_left(self, key)
+        if position < self._count and self[position] == key:
+            return len(INDEX_MAGIC) + position * RECORD_SIZE
+        return None
+
+    def __contains__(self, code):
+        return self._find(code) is not None
+
+    def get(self, code, default=None):
+        """
+        The function `get` returns the location for an IATA code.
+        :return: A dict with the `iataCode`, `cityCode` and `subType` of the location, or `default` if
+        the code is not in the index.
+        """
+        offset = self._find(code)
+        if offset is None:
+            return default
+        record = self._buffer[offset:offset + RECORD_SIZE]
+        return {
+            'iataCode': record[:3].decode(),
+            'cityCode': record[3:6].decode(),
+            'subType': SUB_TYPE_NAMES[record[6:7]],
+        }
+
+
+def read_locations_csv(path):
+    """
+    The function `read_locations_csv` reads the locations CSV, which has an `iata_code`, `city_code`,
+    `sub_type` (`AIRPORT` or `CITY`) and `name` column.
+    :return: A list of `(iata_code, city_code, sub_type)` tuples.
+    :raises ValueError: If a row does not hold two 3-letter codes and a known sub type.
+    """
+    rows = []
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        for line, row in enumerate(csv.DictReader(csv_file), start=2):
+            code = (row.get('iata_code') or '').strip().upper()
+            city_code = (row.get('city_code') or '').strip().upper() or code
+            sub_type = (row.get('sub_type') or 'AIRPORT').strip().upper()
+            for value in (code, city_code):
+                if len(value) != 3 or not value.isascii() or not value.isalpha():
+                    raise ValueError(f"{path}:{line}: invalid IATA code {value!r}")
+            if sub_type not in SUB_TYPES:
+                raise ValueError(f"{path}:{line}: unknown sub type {sub_type!r}")
+            rows.append((code, city_code, sub_type))
+    return rows
+
+
+def read_ourairports_csv(path):
+    """
+    The function `read_ourairports_csv` reads an OurAirports `airports.csv` export, plain or gzipped.
+    :return: A list of `(iata_code, name)` tuples for the open airports that have a 3-letter IATA code,
+    one per code.
+    """
+    opener = gzip.open if str(path).endswith('.gz') else open
+    airports = {}
+    with opener(path, 'rt', newline='', encoding='utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            code = (row.get('iata_code') or '').strip().upper()
+            airport_type = row.get('type')
+            if len(code) != 3 or not code.isascii() or not code.isalpha() or airport_type not in OURAIRPORTS_TYPES:
+                continue
+            rank = OURAIRPORTS_TYPES.index(airport_type)
+            if code not in airports or rank < airports[code][0]:
+                airports[code] = (rank, (row.get('name') or '').strip())
+    return [(code, name) for code, (rank, name) in sorted(airports.items())]
+
+
+def merge_ourairports(csv_path, ourairports_path):
+    """
+    The function `merge_ourairports` adds the airports of an OurAirports export to the locations CSV.
+    Codes already in the CSV keep their row, so curated city codes are not overwritten, and new
+    airports are their own city. The CSV is replaced atomically.
+    :return: The number of airports added.
+    """
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    known = {(row.get('iata_code') or '').strip().upper() for row in rows}
+    added = [
+        {'iata_code': code, 'city_code': code, 'sub_type': 'AIRPORT', 'name': name}
+        for code, name in read_ourairports_csv(ourairports_path) if code not in known
+    ]
+    temporary_path = f"{csv_path}.tmp"
+    with open(temporary_path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=['iata_code', 'city_code', 'sub_type', 'name'], extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows + added)
+    os.replace(temporary_path, csv_path)
+    return len(added)
+
+
+def build_index(rows):
+    """
+    The function `build_index` lays out the rows read by `read_locations_csv` as an index file.
+    Duplicate codes keep their first row.
+    :return: The index as bytes.
+    """
+    records = {}
+    for code, city_code, sub_type in rows:
+        records.setdefault(code, code.encode() + city_code.encode() + SUB_TYPES[sub_type])
+    return INDEX_MAGIC + b''.join(records[code] for code in sorted(records))
+
+
+def write_index(rows, path):
+    """
+    The function `write_index` writes the index file for `rows`. The file is replaced atomically, so
+    running workers keep reading the map of the previous file until they restart.
+    :return: The number of records written.
+    """
+    data = build_index(rows)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'wb') as index_file:
+        index_file.write(data)
+    os.replace(temporary_path, path)
+    return (len(data) - len(INDEX_MAGIC)) // RECORD_SIZE
+
+
+def load_index(path=None, csv_path=None):
+    """
+    The function `load_index` memory-maps the index file. If the file is missing, the index is built in
+    memory from the CSV instead.
+    :return: A `LocationIndex`.
+    """
+    path = path or settings.LOCATION_INDEX_PATH
+    try:
+        with open(path, 'rb') as index_file:
+            # The map stays valid after the file is closed
+            return LocationIndex(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+        logger.warning("Location index %s not found, building it from the CSV. Run `manage.py refresh_location_index`.", path)
+        return LocationIndex(build_index(read_locations_csv(csv_path or settings.LOCATION_CSV_PATH)))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_location_index():
+    """
+    The function `get_location_index` returns the process-wide location index, loading it on first use.
+    :return: The `LocationIndex`.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_index()
+    return _index
+
+
+def normalize_code(code):
+    """
+    The function `normalize_code` turns user input into the form used by the index and the cache keys,
+    e.g. ` jfk` into `JFK`.
+    """
+    return code.strip().upper() if isinstance(code, str) else code
@@ -0,0 +1,188 @@
+# The `metrics` module times the stages of a request and counts its outcome. Each stage measured
+# with `timed` is added to the `Server-Timing` header of the current request, and to a per-process
+# latency histogram. Histograms and counters are buffered in memory and periodically added to one
+# Redis hash shared by every worker, which `/flights/metrics/` renders in the Prometheus text format.
+#
+# Recording a sample takes a `perf_counter` call, a bisect and a short lock, so the instrumentation
+# can stay on in production.
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+# The upper bounds of the histogram buckets, in milliseconds. Samples above the last bound fall into
+# the `+Inf` bucket.
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# The stage durations of the current request, in milliseconds. Only set while `ServerTimingMiddleware`
+# handles a request, so stages timed elsewhere (e.g. in background threads) only feed the histograms.
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class Metrics:
+    """
+    The `Metrics` class buffers histogram samples and counter increments until they are flushed to
+    Redis. Fields in the Redis hash are `hist|<stage>|<bucket>`, `sum|<stage>` and
+    `count|<name>|<label>`, and every flush adds the deltas with HINCRBYFLOAT, so the hash holds the
+    totals of every worker.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)
+        self._flusher = None
+
+    def observe(self, stage, duration_ms):
+        """
+        The function `observe` records one sample of a stage duration.
+        """
+        bucket = bisect_left(BUCKETS_MS, duration_ms)
+        with self._lock:
+            self._pending[f"hist|{stage}|{bucket}"] += 1
+            self._pending[f"sum|{stage}"] += duration_ms
+        self._ensure_flusher()
+
+    def incr(self, name, label, amount=1):
+        """
+        The function `incr` increments the counter `name` for `label`, e.g. `price_requests` for `hit`.
+        """
+        with self._lock:
+            self._pending[f"count|{name}|{label}"] += amount
+        self._ensure_flusher()
+
+    def flush(self):
+        """
+        The function `flush` adds the buffered samples and increments to the shared Redis hash. If Redis
+        is unavailable they are kept for the next flush.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        if not pending:
+            return
+        try:
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            for field, value in pending.items():
+                pipe.hincrbyfloat(settings.METRICS_REDIS_KEY, field, value)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Failed to flush metrics, keeping them for the next flush: %s", e)
+            with self._lock:
+                for field, value in pending.items():
+                    self._pending[field] += value
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def render(self):
+        """
+        The function `render` flushes this process and renders the totals of every worker in the
+        Prometheus text format.
+        :return: The exposition text.
+        """
+        self.flush()
+        fields = get_redis_connection('default').hgetall(settings.METRICS_REDIS_KEY)
+        buckets = defaultdict(lambda: [0.0] * (len(BUCKETS_MS) + 1))
+        sums = defaultdict(float)
+        counters = defaultdict(dict)
+        for field, value in fields.items():
+            kind, name, label = (field.decode().split('|', 2) + [''])[:3]
+            value = float(value)
+            if kind == 'hist':
+                buckets[name][int(label)] = value
+            elif kind == 'sum':
+                sums[name] = value
+            elif kind == 'count':
+                counters[name][label] = value
+
+        lines = [
+            '# HELP flights_stage_duration_seconds Time spent in each stage of a request.',
+            '# TYPE flights_stage_duration_seconds histogram',
+        ]
+        for stage in sorted(buckets):
+            cumulative = 0.0
+            for bound, count in zip(BUCKETS_MS + (None,), buckets[stage]):
+                cumulative += count
+                le = '+Inf' if bound is None else repr(bound / 1000)
+                lines.append(f'flights_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative:g}')
+            lines.append(f'flights_stage_duration_seconds_sum{{stage="{stage}"}} {sums[stage] / 1000!r}')
+            lines.append(f'flights_stage_duration_seconds_count{{stage="{stage}"}} {cumulative:g}')
+        for name in sorted(counters):
+            lines.append(f'# TYPE flights_{name}_total counter')
+            label_name = COUNTER_LABELS.get(name, 'label')
+            for label, value in sorted(counters[name].items()):
+                lines.append(f'flights_{name}_total{{{label_name}="{label}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+# The label name each counter is exported with
+COUNTER_LABELS = {
+    'price_requests': 'result',
+    'upstream_responses': 'status',
+}
+
+# The metrics of this process
+metrics = Metrics()
+
+
+class timed:
+    """
+    The `timed` context manager measures a stage, e.g. `with timed('amadeus'):`. The duration is added
+    to the stage histogram and to the `Server-Timing` header of the current request. Stages that run
+    several times in one request, like two upstream calls after a token refresh, add up.
+    """
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        metrics.observe(self.stage, duration_ms)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[self.stage] = timings.get(self.stage, 0.0) + duration_ms
+        return False
+
+
+def start_request():
+    """
+    The function `start_request` starts collecting the stage timings of a request.
+    :return: A token for `finish_request`.
+    """
+    return _request_timings.set({}), time.perf_counter()
+
+
+def finish_request(token):
+    """
+    The function `finish_request` stops collecting the stage timings of a request.
+    :return: The value of the `Server-Timing` header, with each stage and the `total` in milliseconds.
+    """
+    context_token, started = token
+    timings = _request_timings.get() or {}
+    _request_timings.reset(context_token)
+    total_ms = (time.perf_counter() - started) * 1000
+    metrics.observe('total', total_ms)
+    entries = [f"{stage};dur={duration:.2f}" for stage, duration in timings.items()]
+    entries.append(f"total;dur={total_ms:.2f}")
+    return ', '.join(entries)
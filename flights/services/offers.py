@@ -0,0 +1,158 @@
+# The `offers` module keeps the full list of flight offers of a search in a compact form, so the price
+# endpoints can filter and sort it without calling Amadeus again.
+#
+# An Amadeus offer is a deeply nested dict of several kilobytes. Each one is parsed once, when the
+# search is fetched, into a `CompactOffer` tuple with the few fields the endpoints filter, sort and
+# return. The tuples are cached with the price entry of the search, less the offers that no filter and
+# sort could ever return.
+import heapq
+import re
+from collections import namedtuple
+
+
+# `amount` is the total price as a number, for filtering and sorting, and `total` the exact string
+# Amadeus returned. `duration` is in minutes and `stops` is the number of connections of the longest
+# itinerary.
+CompactOffer = namedtuple('CompactOffer', [
+    'amount', 'total', 'currency', 'duration', 'stops', 'departure_at', 'arrival_at', 'carriers', 'seats',
+])
+
+# The orders offers can be returned in. Each key breaks ties on price, then duration.
+SORT_KEYS = {
+    'price': lambda offer: (offer.amount, offer.duration),
+    'duration': lambda offer: (offer.duration, offer.amount),
+    'stops': lambda offer: (offer.stops, offer.amount, offer.duration),
+}
+
+ISO_DURATION = re.compile(r'^P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?')
+
+
+def parse_duration(value):
+    """
+    The function `parse_duration` reads an ISO 8601 duration as used by Amadeus, e.g. `PT5H30M`.
+    :return: The duration in minutes, `0` if it cannot be read.
+    """
+    match = ISO_DURATION.match(value or '')
+    if not match:
+        return 0
+    days, hours, minutes = (int(part or 0) for part in match.groups())
+    return days * 24 * 60 + hours * 60 + minutes
+
+
+def compact_offer(offer):
+    """
+    The function `compact_offer` extracts the fields of a `CompactOffer` from one flight offer of the
+    Amadeus response.
+    :return: A `CompactOffer`, or `None` if the offer has no readable price.
+    """
+    price = offer.get('price', {})
+    try:
+        total = price['total']
+        amount = float(total)
+    except (KeyError, TypeError, ValueError):
+        return None
+    itineraries = offer.get('itineraries') or []
+    segments = [itinerary.get('segments') or [] for itinerary in itineraries]
+    first = segments[0] if segments and segments[0] else [{}]
+    carriers = []
+    for segment in (segment for itinerary in segments for segment in itinerary):
+        if segment.get('carrierCode') and segment['carrierCode'] not in carriers:
+            carriers.append(segment['carrierCode'])
+    return CompactOffer(
+        amount=amount,
+        total=total,
+        currency=price.get('currency', ''),
+        duration=sum(parse_duration(itinerary.get('duration')) for itinerary in itineraries),
+        stops=max((len(itinerary) - 1 for itinerary in segments if itinerary), default=0),
+        departure_at=first[0].get('departure', {}).get('at', ''),
+        arrival_at=first[-1].get('arrival', {}).get('at', ''),
+        carriers=tuple(carriers),
+        seats=offer.get('numberOfBookableSeats'),
+    )
+
+
+def negated(key):
+    return tuple(-part for part in key)
+
+
+def selectable_offers(offers, max_offers, sort_key):
+    """
+    The function `selectable_offers` finds the offers that `select_offers` can return for a sort order
+    under some `maxPrice`. An offer is returned for the lowest `maxPrice` that keeps it unless
+    `max_offers` other offers at most as expensive come before it, and a higher `maxPrice` only adds
+    offers that could come before it.
+    :param offers: The offers, cheapest first.
+    :return: The set of the indexes of those offers in `offers`.
+    """
+    selectable = set()
+    # The keys of the `max_offers` first offers among those seen so far. They are negated, so the root
+    # of the heap is the last of them
+    best = []
+    start = 0
+    while start < len(offers):
+        # Offers of the same price are all kept by the same `maxPrice`
+        end = start
+        while end < len(offers) and offers[end].amount == offers[start].amount:
+            key = negated(sort_key(offers[end]))
+            if len(best) < max_offers:
+                heapq.heappush(best, key)
+            elif key > best[0]:
+                heapq.heapreplace(best, key)
+            end += 1
+        for index in range(start, end):
+            if len(best) < max_offers or negated(sort_key(offers[index])) >= best[0]:
+                selectable.add(index)
+        start = end
+    return selectable
+
+
+def compact_offers(flight_data, max_offers=None):
+    """
+    The function `compact_offers` parses every flight offer of an Amadeus response.
+    :param max_offers: The most offers `select_offers` will be asked for. If given, only the offers it
+    can return for some combination of filters and sort order are kept.
+    :return: A list of `CompactOffer`s, cheapest first.
+    """
+    offers = [offer for offer in map(compact_offer, flight_data) if offer is not None]
+    offers.sort(key=SORT_KEYS['price'])
+    if max_offers is None:
+        return offers
+    keep = set()
+    non_stop = [index for index, offer in enumerate(offers) if offer.stops == 0]
+    for sort_key in SORT_KEYS.values():
+        keep |= selectable_offers(offers, max_offers, sort_key)
+        keep.update(non_stop[index] for index in selectable_offers([offers[i] for i in non_stop], max_offers, sort_key))
+    return [offer for index, offer in enumerate(offers) if index in keep]
+
+
+def select_offers(offers, max_offers, non_stop=False, max_price=None, sort='price'):
+    """
+    The function `select_offers` filters and sorts the cached offers of a search.
+    :param max_offers: How many offers to return at most.
+    :param non_stop: Whether to keep only the offers without a connection. Like the Amadeus parameter,
+    `False` does not filter.
+    :param max_price: The highest total price to keep, or `None`.
+    :param sort: One of the keys of `SORT_KEYS`.
+    :return: A list of at most `max_offers` `CompactOffer`s.
+    """
+    selected = (
+        offer for offer in offers
+        if (not non_stop or offer.stops == 0) and (max_price is None or offer.amount <= max_price)
+    )
+    return heapq.nsmallest(max_offers, selected, key=SORT_KEYS[sort])
+
+
+def offer_representation(offer):
+    """
+    The function `offer_representation` returns the fields of a `CompactOffer` the price endpoints
+    respond with. The price is formatted like the `price` of `flight_offer_summary`.
+    """
+    return {
+        'price': f"{offer.total} {offer.currency}",
+        'duration_minutes': offer.duration,
+        'stops': offer.stops,
+        'departure_at': offer.departure_at,
+        'arrival_at': offer.arrival_at,
+        'carriers': list(offer.carriers),
+        'bookable_seats': offer.seats,
+    }
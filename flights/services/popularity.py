@@ -0,0 +1,210 @@
+# The `popularity` module keeps track of the most requested searches, so `manage.py warm_price_cache`
+# can refresh their prices before they expire.
+#
+# Each search has a score that decays exponentially over time with a half-life of
+# `POPULARITY_HALF_LIFE` seconds. Instead of decaying every score, each request adds a weight that
+# grows with time (forward decay): a request at time `t` adds `2 ** ((t - L) / half_life)`, where `L` is
+# a landmark, so the ranking is the same as if every older score had been decayed. To keep the weights
+# bounded, the landmark moves every `PERIOD_HALF_LIVES` half-lives and each period is scored in its own
+# sorted set. The ranking adds the current period to the previous one scaled down to the new landmark.
+#
+# Requests only update an in-memory counter, which is added to Redis every
+# `POPULARITY_FLUSH_INTERVAL` seconds, so recording a request costs no round trip.
+import datetime
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .price_service import has_offer_window, parse_price_cache_key, price_cache, price_cache_key, refresh_price
+
+
+logger = logging.getLogger(__name__)
+
+# The number of half-lives between two landmarks. The weights of one period stay between 1 and 2 ** 16.
+PERIOD_HALF_LIVES = 16
+
+
+def period_start(now):
+    """
+    The function `period_start` returns the landmark of the period `now` falls into.
+    """
+    period = settings.POPULARITY_HALF_LIFE * PERIOD_HALF_LIVES
+    return int(now // period * period)
+
+
+def period_key(landmark):
+    """
+    The function `period_key` builds the key of the sorted set that scores the period starting at
+    `landmark`.
+    """
+    return f"{settings.POPULARITY_REDIS_KEY}:{landmark}"
+
+
+class PopularityTracker:
+    """
+    The `PopularityTracker` class buffers the forward-decayed weights of the requests served by this
+    process, and periodically adds them to the sorted set of the current period.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)
+        self._landmark = None
+        self._flusher = None
+
+    def record(self, member, now=None):
+        """
+        The function `record` counts one request for `member`, a price cache key.
+        """
+        now = time.time() if now is None else now
+        landmark = period_start(now)
+        weight = 2 ** ((now - landmark) / settings.POPULARITY_HALF_LIFE)
+        with self._lock:
+            # Weights of different periods cannot be added up, flush the previous period first
+            if landmark != self._landmark and self._pending:
+                pending, self._pending = self._pending, defaultdict(float)
+                threading.Thread(target=self._write, args=(self._landmark, pending), daemon=True).start()
+            self._landmark = landmark
+            self._pending[member] += weight
+        self._ensure_flusher()
+
+    def flush(self):
+        """
+        The function `flush` adds the buffered weights to Redis. If Redis is unavailable they are dropped,
+        popularity only needs to be roughly right.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            landmark = self._landmark
+        if pending:
+            self._write(landmark, pending)
+
+    def _write(self, landmark, pending):
+        key = period_key(landmark)
+        try:
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            for member, weight in pending.items():
+                pipe.zincrby(key, weight, member)
+            # Keep only the most popular members, and drop the set once it is two periods old
+            pipe.zremrangebyrank(key, 0, -settings.POPULARITY_MAX_MEMBERS - 1)
+            pipe.expire(key, settings.POPULARITY_HALF_LIFE * PERIOD_HALF_LIVES * 2)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Failed to record search popularity: %s", e)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, name='popularity-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(settings.POPULARITY_FLUSH_INTERVAL)
+            self.flush()
+
+
+# The popularity buffer of this process
+popularity = PopularityTracker()
+
+
+def record_search(origin, destination, date, adults=1, currency=None):
+    """
+    The function `record_search` counts one request for a price search.
+    """
+    popularity.record(price_cache_key(origin, destination, date, adults, currency))
+
+
+def top_searches(count, now=None):
+    """
+    The function `top_searches` returns the most popular searches, most popular first.
+    :return: A list of `(price cache key, score)` tuples. Scores are relative to the current landmark.
+    """
+    now = time.time() if now is None else now
+    landmark = period_start(now)
+    previous = landmark - settings.POPULARITY_HALF_LIFE * PERIOD_HALF_LIVES
+    connection = get_redis_connection('default')
+    ranking_key = f"{settings.POPULARITY_REDIS_KEY}:ranking"
+    # In a transaction, so concurrent rankings do not overwrite each other's temporary set
+    pipe = connection.pipeline(transaction=True)
+    # The weights of the previous period are 2 ** PERIOD_HALF_LIVES times smaller at the new landmark
+    pipe.zunionstore(ranking_key, {period_key(landmark): 1, period_key(previous): 2 ** -PERIOD_HALF_LIVES})
+    pipe.zrevrange(ranking_key, 0, count - 1, withscores=True)
+    pipe.delete(ranking_key)
+    _, ranking, _ = pipe.execute()
+    return [(member.decode(), score) for member, score in ranking]
+
+
+def forget_searches(members, now=None):
+    """
+    The function `forget_searches` removes searches from the ranking, e.g. once their date has passed.
+    """
+    if not members:
+        return
+    now = time.time() if now is None else now
+    landmark = period_start(now)
+    previous = landmark - settings.POPULARITY_HALF_LIFE * PERIOD_HALF_LIVES
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for key in (period_key(landmark), period_key(previous)):
+        pipe.zrem(key, *members)
+    pipe.execute()
+
+
+def needs_warming(entry, lead):
+    """
+    The function `needs_warming` checks whether a cached price is missing or within `lead` seconds of
+    going stale. Negative entries are left to expire, warming them would only find no offer again.
+    """
+    if entry is None:
+        return True
+    if 'data' not in entry:
+        return False
+    return time.time() - entry['fetched_at'] >= settings.PRICE_CACHE_SOFT_TTL - lead
+
+
+def warm_popular_prices(top, budget, concurrency, lead):
+    """
+    The function `warm_popular_prices` refreshes the prices of the `top` most popular searches that
+    are missing from the cache or about to go stale, most popular first. At most `budget` searches are
+    fetched, `concurrency` at a time. Searches whose date has passed are dropped from the ranking.
+
+    :return: A `Counter` with the number of searches `ranked`, `due`, `warmed`, `failed`, `skipped`
+    (refreshed by another process at the same time), `over_budget` and `expired`.
+    """
+    stats = Counter()
+    today = datetime.date.today().isoformat()
+    searches, expired = {}, []
+    for member, _ in top_searches(top):
+        search = parse_price_cache_key(member)
+        if search is None or search[2] < today:
+            expired.append(member)
+        else:
+            searches[member] = search
+    forget_searches(expired)
+    stats['ranked'] = len(searches)
+    stats['expired'] = len(expired)
+
+    entries = price_cache.get_many(list(searches))
+    # Each search is warmed with the offers it holds, searches that were filtered keep their offer window
+    due = [
+        (search, bool(entries.get(key)) and has_offer_window(entries[key]))
+        for key, search in searches.items() if needs_warming(entries.get(key), lead)
+    ]
+    stats['due'] = len(due)
+    stats['over_budget'] = max(0, len(due) - budget)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='price-warm') as executor:
+        for result in executor.map(lambda item: refresh_price(*item[0], with_offers=item[1]), due[:budget]):
+            if result is None:
+                stats['skipped'] += 1
+            elif result[1]:
+                stats['failed'] += 1
+            else:
+                stats['warmed'] += 1
+    return stats
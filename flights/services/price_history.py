@@ -0,0 +1,155 @@
+# The `price_history` module writes every price fetched from the Amadeus API to the
+# `PriceObservation` table, and reads back the most recent one of a search once its cache entries have
+# expired.
+#
+# Prices are only appended to an in-memory buffer on the request path. A background thread writes the
+# buffer with one `bulk_create` every `PRICE_HISTORY_FLUSH_INTERVAL` seconds, or as soon as
+# `PRICE_HISTORY_BATCH_SIZE` prices are waiting, so recording a price costs no database round trip.
+import datetime
+import logging
+import threading
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from ..models import DEFAULT_CURRENCY_MARKER, PriceObservation
+
+
+logger = logging.getLogger(__name__)
+
+
+def split_price(data):
+    """
+    The function `split_price` splits the `price` field of serialized price data, formatted as
+    `<total> <currency>`.
+    :return: An `(amount, currency)` tuple. `amount` is a `Decimal`, or `None` if it cannot be read.
+    """
+    total, _, currency = str(data.get('price', '')).partition(' ')
+    try:
+        return Decimal(total), currency[:3]
+    except InvalidOperation:
+        return None, currency[:3]
+
+
+class PriceHistoryWriter:
+    """
+    The `PriceHistoryWriter` class buffers the prices fetched by this process and writes them to the
+    database in batches.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake = threading.Event()
+        self._flusher = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, origin, destination, date, adults, currency, data, fetched_at):
+        """
+        The function `record` queues one price for writing.
+        :param date: The departure date, as a `YYYY-MM-DD` string.
+        :param currency: The currency the search asked for, or `None` for the Amadeus default.
+        :param data: The serialized flight offer.
+        :param fetched_at: The time the price was fetched, as a Unix timestamp.
+        """
+        try:
+            departure_date = datetime.date.fromisoformat(date)
+        except ValueError:
+            # Only dates Amadeus accepted get a price, but a bad row would fail the whole batch
+            return
+        observation = (origin, destination, departure_date, adults, currency or DEFAULT_CURRENCY_MARKER, data, fetched_at)
+        with self._lock:
+            if len(self._pending) >= settings.PRICE_HISTORY_MAX_PENDING:
+                self.dropped += 1
+                return
+            self._pending.append(observation)
+            full = len(self._pending) >= settings.PRICE_HISTORY_BATCH_SIZE
+        self._ensure_flusher()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """
+        The function `flush` writes the buffered prices to the database. If the database is unavailable
+        they are dropped, the history is kept on a best effort basis.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        observations = []
+        for origin, destination, departure_date, adults, requested_currency, data, fetched_at in pending:
+            price, currency = split_price(data)
+            observations.append(PriceObservation(
+                origin=origin, destination=destination, departure_date=departure_date, adults=adults,
+                price=price, currency=currency, requested_currency=requested_currency, data=data,
+                observed_at=datetime.datetime.fromtimestamp(fetched_at, tz=datetime.timezone.utc),
+            ))
+        # The thread keeps its connection between flushes, drop it if it broke or outlived CONN_MAX_AGE
+        close_old_connections()
+        try:
+            PriceObservation.objects.bulk_create(observations, batch_size=settings.PRICE_HISTORY_BATCH_SIZE)
+        except Exception as e:
+            with self._lock:
+                self.dropped += len(observations)
+            logger.warning("Failed to write %d prices to the price history: %s", len(observations), e)
+            return
+        with self._lock:
+            self.written += len(observations)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'written': self.written, 'dropped': self.dropped}
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, name='price-history-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            self._wake.wait(settings.PRICE_HISTORY_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+
+# The price history buffer of this process
+price_history = PriceHistoryWriter()
+
+
+def search_observations(origin, destination, date, adults=1, currency=None):
+    # The observations of one search, most recent first. A search in the default currency only matches
+    # prices fetched in the default currency, never those another client asked in its own currency
+    return PriceObservation.objects.filter(
+        origin=origin, destination=destination, departure_date=date, adults=adults,
+        requested_currency=currency or DEFAULT_CURRENCY_MARKER,
+    ).order_by('-observed_at').only('data', 'observed_at')
+
+
+def latest_observation(origin, destination, date, adults=1, currency=None):
+    """
+    The function `latest_observation` reads the most recent price kept for a search, fetched in
+    `currency`, or in the Amadeus default currency if it is `None`.
+    :return: A `PriceObservation` with `data` and `observed_at`, or `None` if there is none or the
+    database cannot be read.
+    """
+    try:
+        return search_observations(origin, destination, date, adults, currency).first()
+    except Exception as e:
+        logger.warning("Failed to read the price history: %s", e)
+        return None
+
+
+async def alatest_observation(origin, destination, date, adults=1, currency=None):
+    """
+    The function `alatest_observation` is the async version of `latest_observation`.
+    """
+    try:
+        return await search_observations(origin, destination, date, adults, currency).afirst()
+    except Exception as e:
+        logger.warning("Failed to read the price history: %s", e)
+        return None
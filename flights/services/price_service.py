@@ -0,0 +1,701 @@
+# The `price_service` module holds the fetch-and-cache logic for flight prices, so every endpoint that
+# needs a price for a route and date reads and fills the same cache entries.
+#
+# Each cache entry is a dict with the serialized cheapest offer as `data`, the rendered response
+# `body`, the `etag` of that body, the offers of the search in compact form as `offers`, the number of
+# offers Amadeus was asked for as `window` and the `fetched_at` timestamp. Most searches only ask for
+# the cheapest offer. Once a client filters or sorts the offers of a search, it is fetched again with
+# a window of `AMADEUS_OFFERS_WINDOW` offers, which later refreshes keep.
+#
+# Entries are fresh for `PRICE_CACHE_SOFT_TTL` seconds, after which they are served stale while one
+# background refresh runs, and they are evicted from Redis after `PRICE_CACHE_HARD_TTL` seconds. Hot
+# entries are also kept in an in-process L1 for at most `PRICE_L1_TTL` seconds.
+#
+# Searches that Amadeus answered without an offer are cached as negative entries, with an `error`
+# instead of `data`, for `PRICE_NEGATIVE_CACHE_TTL` seconds. Every price fetched is also kept as the
+# last known good price for `PRICE_LAST_GOOD_TTL` seconds, which is served while the circuit breaker
+# keeps Amadeus from being called, and written to the price history table, which outlives the cache.
+#
+# A lookup that misses the cache waits at most `PRICE_REQUEST_DEADLINE` seconds for Amadeus. If the
+# price is late, the last known one is served, from Redis or else from the price history, while the
+# fetch completes in the background and fills the cache.
+import asyncio
+import contextvars
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from decimal import Decimal, InvalidOperation
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import async_cache
+from .amadeus_service import (
+    AmadeusAPI, CIRCUIT_OPEN_ERROR, DEADLINE_ERROR, FETCH_ERROR, INVALID_SEARCH_ERROR, NO_FLIGHT_DATA_ERROR,
+    NO_FLIGHTS_ERROR,
+)
+from .coalescing import SingleFlight
+from .local_cache import LocalCache, TwoTierCache
+from .metrics import timed
+from .offers import compact_offers
+from .price_history import alatest_observation, latest_observation, price_history
+from .rendering import render_data
+from ..serializers import flight_offer_summary
+
+
+logger = logging.getLogger(__name__)
+
+# Serves hot price entries from memory, in front of Redis
+price_cache = TwoTierCache(
+    'price',
+    LocalCache(max_entries=settings.PRICE_L1_MAX_ENTRIES, max_bytes=settings.PRICE_L1_MAX_BYTES),
+    local_ttl=settings.PRICE_L1_TTL,
+)
+
+# Coalesces concurrent price lookups for the same cache key within and across processes
+price_single_flight = SingleFlight('price')
+
+# The errors that only depend on the search and not on the health of Amadeus, so they can be cached
+NEGATIVE_CACHE_ERRORS = {NO_FLIGHT_DATA_ERROR, NO_FLIGHTS_ERROR, INVALID_SEARCH_ERROR}
+
+# Runs stale-while-revalidate refreshes off the request thread. `_refreshing` holds the keys that
+# already have a refresh queued in this process, so each key is refreshed at most once at a time.
+_refresh_executor = ThreadPoolExecutor(max_workers=settings.PRICE_REFRESH_WORKERS, thread_name_prefix='price-refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Fetches the cache misses of batch and date range lookups concurrently, bounded so a large lookup
+# cannot open more upstream connections than the HTTP pool holds
+_fanout_executor = ThreadPoolExecutor(max_workers=settings.PRICE_FANOUT_WORKERS, thread_name_prefix='price-fanout')
+
+# Runs the fetches of the single price endpoint, so a request can stop waiting at its deadline while
+# the fetch goes on. At most `PRICE_DEADLINE_MAX_PENDING` fetches are running or queued: while Amadeus
+# is down every fetch outlives its request, and an unbounded queue would keep calling it long after
+# the clients are gone. Requests beyond the bound get the last known price right away.
+_deadline_executor = ThreadPoolExecutor(max_workers=settings.PRICE_DEADLINE_WORKERS, thread_name_prefix='price-deadline')
+
+# Holds the async fetches that outlived their request, so they are not garbage collected. Like the
+# thread pool, it holds at most `PRICE_DEADLINE_MAX_PENDING` of them
+_background_fetches = set()
+
+_deadline_counters = {'pending': 0, 'rejected': 0, 'abandoned': 0}
+_deadline_lock = threading.Lock()
+
+
+def price_cache_key(origin, destination, date, adults=1, currency=None):
+    """
+    The function `price_cache_key` builds the cache key for a route, departure date, number of adults
+    and currency. Searches for one adult in the default currency keep the original key format.
+    :return: The cache key, e.g. `JFK_LAX_2024-12-01`, `JFK_LAX_2024-12-01_2` or
+    `JFK_LAX_2024-12-01_1_USD`.
+    """
+    if currency:
+        return f"{origin}_{destination}_{date}_{adults}_{currency}"
+    if adults == 1:
+        return f"{origin}_{destination}_{date}"
+    return f"{origin}_{destination}_{date}_{adults}"
+
+
+def parse_price_cache_key(key):
+    """
+    The function `parse_price_cache_key` reverses `price_cache_key`.
+    :return: An `(origin, destination, date, adults, currency)` tuple, or `None` if `key` is not a price
+    cache key. `currency` is `None` for the default currency.
+    """
+    parts = key.split('_')
+    if len(parts) not in (3, 4, 5) or (len(parts) > 3 and not parts[3].isdigit()):
+        return None
+    origin, destination, date = parts[:3]
+    return origin, destination, date, int(parts[3]) if len(parts) > 3 else 1, parts[4] if len(parts) == 5 else None
+
+
+def last_good_key(key):
+    """
+    The function `last_good_key` builds the key of the last known good copy of a price entry.
+    """
+    return f"price:lkg:{key}"
+
+
+def read_price_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `read_price_entry` reads a price entry from the cache, whether fresh or stale.
+    :return: The cache entry dict with `data` (or `error` for a negative entry) and `fetched_at`, or
+    `None` if it is not cached.
+    """
+    with timed('cache'):
+        return price_cache.get(price_cache_key(origin, destination, date, adults, currency))
+
+
+def invalidate_price(origin, destination, date, adults=1, currency=None):
+    """
+    The function `invalidate_price` drops a price entry from the L1 cache of every worker, e.g. when a
+    client bypasses the cache with `nocache=1`. The entry in Redis is replaced once the fresh price
+    has been fetched.
+    """
+    price_cache.invalidate(price_cache_key(origin, destination, date, adults, currency))
+
+
+def read_last_good_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `read_last_good_entry` reads the last price fetched for a search, however old it is.
+    :return: The cache entry dict with `data` and `fetched_at`, or `None` if no price was kept.
+    """
+    return cache.get(last_good_key(price_cache_key(origin, destination, date, adults, currency)))
+
+
+def observation_entry(observation):
+    """
+    The function `observation_entry` turns a `PriceObservation` from the price history into a price
+    entry like the cached ones.
+    """
+    body = render_data(observation.data)
+    return {
+        'data': observation.data, 'body': body, 'etag': content_etag(body),
+        'fetched_at': observation.observed_at.timestamp(),
+    }
+
+
+def read_fallback_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `read_fallback_entry` reads the last known price of a search, to serve when Amadeus
+    cannot answer in time. The last known good entry in Redis is tried first, then the price history.
+    :return: The entry dict with `data` and `fetched_at`, or `None` if no price was ever kept.
+    """
+    entry = read_last_good_entry(origin, destination, date, adults, currency)
+    if entry:
+        return entry
+    observation = latest_observation(origin, destination, date, adults, currency)
+    return observation_entry(observation) if observation else None
+
+
+def entry_result(entry):
+    """
+    The function `entry_result` turns a cache entry into the `(data, error)` tuple the callers return.
+    """
+    return entry.get('data'), entry.get('error')
+
+
+def entry_body(entry):
+    """
+    The function `entry_body` returns the pre-rendered `{"data": ...}` response body of a price entry.
+    Entries cached before bodies were stored are rendered on the fly.
+    """
+    return entry.get('body') or render_data(entry['data'])
+
+
+def content_etag(body):
+    """
+    The function `content_etag` builds the strong ETag of a response body from a hash of its bytes, so
+    every worker gives the same body the same ETag.
+    :return: The quoted ETag, e.g. `"0f3c..."`.
+    """
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def entry_etag(entry):
+    """
+    The function `entry_etag` returns the ETag of the response body of a price entry. Entries cached
+    before ETags were stored get one computed from their body.
+    """
+    return entry.get('etag') or content_etag(entry_body(entry))
+
+
+def entry_age(entry):
+    """
+    The function `entry_age` returns how many seconds ago a cache entry was fetched.
+    """
+    return max(0, int(time.time() - entry['fetched_at']))
+
+
+def is_fresh(entry):
+    """
+    The function `is_fresh` checks whether a cache entry is still inside its soft TTL.
+    """
+    return entry_age(entry) < settings.PRICE_CACHE_SOFT_TTL
+
+
+def has_offer_window(entry):
+    """
+    The function `has_offer_window` checks whether a price entry holds the offers of a search for
+    `AMADEUS_OFFERS_WINDOW` offers, which filters and sort orders can be applied to. Entries cached
+    before the window was stored hold it if they hold offers.
+    """
+    return 'offers' in entry and entry.get('window', settings.AMADEUS_OFFERS_WINDOW) > 1
+
+
+def offer_window(with_offers):
+    """
+    The function `offer_window` returns how many offers a search asks Amadeus for.
+    :param with_offers: Whether the offers of the search are filtered and sorted, or only the cheapest
+    one is needed.
+    """
+    return settings.AMADEUS_OFFERS_WINDOW if with_offers else 1
+
+
+def is_answered(entry, with_offers):
+    # Whether a cached entry answers a search, i.e. it is not missing the offer window it needs.
+    # Negative entries answer every search
+    return not with_offers or 'data' not in entry or has_offer_window(entry)
+
+
+def read_fresh_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `read_fresh_price` reads a price from the cache, ignoring stale entries.
+    :param with_offers: Whether the entry must hold the offer window, see `has_offer_window`.
+    :return: A `(data, error)` tuple with the cached price data, or `None` if no fresh entry is cached.
+    """
+    entry = read_price_entry(origin, destination, date, adults, currency)
+    if entry and is_fresh(entry) and is_answered(entry, with_offers):
+        return entry_result(entry)
+    return None
+
+
+def fetch_price_entry(amadeus, origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `fetch_price_entry` fetches the cheapest flight offer from the Amadeus API and builds
+    the cache entry for it, without writing it to the cache.
+    :param amadeus: The `AmadeusAPI` instance used for the call. It can be shared between threads.
+    :param with_offers: Whether to fetch the offer window, so the offers can be filtered and sorted.
+    :return: The entry dict, as returned by `build_price_entry`.
+    """
+    # Fetch flight offers from the Amadeus API
+    window = offer_window(with_offers)
+    flight_data = amadeus.fetch_flight_offers(origin, destination, date, adults=adults, currency=currency, max_offers=window)
+    return build_price_entry(flight_data, window)
+
+
+def build_price_entry(flight_data, window=1):
+    """
+    The function `build_price_entry` builds the cache entry for the flight offers returned by
+    `AmadeusAPI.fetch_flight_offers` or `AmadeusAPI.afetch_flight_offers`.
+    :param window: The number of offers Amadeus was asked for.
+    :return: A dict with either the serialized cheapest offer as `data`, its rendered response `body`,
+    the offers as a list of `CompactOffer`s in `offers` and the `window`, or the `error` message, and
+    the `fetched_at` timestamp. Use `is_cacheable` to check whether it may be written to the cache.
+    """
+    # Check if there was an error fetching flight offers
+    if "error" in flight_data:
+        return {'error': flight_data['error'], 'fetched_at': time.time()}
+
+    # Check if the response is a list and if there are flight offers available
+    if isinstance(flight_data, list) and len(flight_data) > 0:
+        flight_offer = flight_data[0]
+        with timed('serialize'):
+            # Extract the fields of the flight offer, like FlightOfferSerializer does
+            data = flight_offer_summary(flight_offer)
+            # Keep the serialized flight offer and its response body along with its ETag and the time
+            # it was fetched, so cache hits return the body as is and revalidations never read it
+            body = render_data(data)
+            # Keep the offers in compact form too, to filter and sort without another fetch
+            offers = compact_offers(flight_data, settings.AMADEUS_OFFERS_MAX)
+            return {
+                'data': data, 'body': body, 'etag': content_etag(body), 'offers': offers, 'window': window,
+                'fetched_at': time.time(),
+            }
+
+    # If the response is not a list or there are no flight offers available, return an error
+    return {'error': "Unexpected response format from API.", 'fetched_at': time.time()}
+
+
+def is_cacheable(entry):
+    """
+    The function `is_cacheable` checks whether an entry built by `build_price_entry` may be cached.
+    Prices are, and so are the errors in `NEGATIVE_CACHE_ERRORS`. Failures are not, the next request
+    should try again.
+    """
+    return 'data' in entry or entry['error'] in NEGATIVE_CACHE_ERRORS
+
+
+def store_price_entries(entries):
+    """
+    The function `store_price_entries` writes the cacheable entries built by `build_price_entry`:
+    prices until their hard TTL along with their last known good copy, and negative entries for
+    `PRICE_NEGATIVE_CACHE_TTL` seconds.
+    :param entries: A dict mapping cache keys to entries.
+    """
+    prices = {key: entry for key, entry in entries.items() if 'data' in entry}
+    negatives = {key: entry for key, entry in entries.items() if 'data' not in entry and is_cacheable(entry)}
+    if prices:
+        price_cache.set_many(prices, timeout=settings.PRICE_CACHE_HARD_TTL)
+        cache.set_many({last_good_key(key): entry for key, entry in prices.items()}, timeout=settings.PRICE_LAST_GOOD_TTL)
+        record_price_history(prices)
+    if negatives:
+        price_cache.set_many(negatives, timeout=settings.PRICE_NEGATIVE_CACHE_TTL)
+
+
+def record_price_history(prices):
+    """
+    The function `record_price_history` queues the prices just fetched for the price history table.
+    :param prices: A dict mapping cache keys to price entries.
+    """
+    for key, entry in prices.items():
+        search = parse_price_cache_key(key)
+        if search:
+            price_history.record(*search, entry['data'], entry['fetched_at'])
+
+
+async def astore_price_entry(key, entry):
+    """
+    The function `astore_price_entry` is the async version of `store_price_entries`, for one entry.
+    """
+    if 'data' in entry:
+        await price_cache.aset(key, entry, timeout=settings.PRICE_CACHE_HARD_TTL)
+        await async_cache.set(last_good_key(key), entry, timeout=settings.PRICE_LAST_GOOD_TTL)
+        record_price_history({key: entry})
+    elif is_cacheable(entry):
+        await price_cache.aset(key, entry, timeout=settings.PRICE_NEGATIVE_CACHE_TTL)
+
+
+def fetch_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `fetch_price` fetches the cheapest flight offer from the Amadeus API, serializes it
+    and caches it until its hard TTL. Searches without an offer are cached as negative entries.
+    :param with_offers: Whether to fetch and cache the offer window, see `has_offer_window`.
+    :return: A `(data, error)` tuple. `data` is the serialized flight offer, or `None` if there was an
+    error, in which case `error` holds the error message.
+    """
+    entry = fetch_price_entry(AmadeusAPI(), origin, destination, date, adults, currency, with_offers)
+    store_price_entries({price_cache_key(origin, destination, date, adults, currency): entry})
+    return entry_result(entry)
+
+
+def single_flight_key(key, with_offers):
+    # Lookups for the offer window are coalesced apart, a lookup for the cheapest offer only would not
+    # leave them the offers they need
+    return f"{key}:offers" if with_offers else key
+
+
+def get_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `get_price` fetches a price that is not in the cache. Identical concurrent lookups are
+    coalesced, so only one of them calls the Amadeus API and the others share its result.
+    :return: A `(data, error)` tuple, as returned by `fetch_price`.
+    """
+    result = price_single_flight.do(
+        single_flight_key(price_cache_key(origin, destination, date, adults, currency), with_offers),
+        lambda: fetch_price(origin, destination, date, adults, currency, with_offers),
+        lambda: read_fresh_price(origin, destination, date, adults, currency, with_offers),
+    )
+    # The leader can only leave no result if its fetch raised, report it like any other failure
+    return result or (None, FETCH_ERROR)
+
+
+def get_price_within_deadline(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `get_price_within_deadline` is `get_price` bounded by `PRICE_REQUEST_DEADLINE`. A
+    fetch that takes longer is not cancelled, it completes in the background and caches the price.
+    :return: A `(data, error)` tuple, as returned by `get_price`. `error` is `DEADLINE_ERROR` if the
+    price was not fetched in time.
+    """
+    if settings.PRICE_REQUEST_DEADLINE <= 0:
+        return get_price(origin, destination, date, adults, currency, with_offers)
+    with _deadline_lock:
+        if _deadline_counters['pending'] >= settings.PRICE_DEADLINE_MAX_PENDING:
+            _deadline_counters['rejected'] += 1
+            return None, DEADLINE_ERROR
+        _deadline_counters['pending'] += 1
+    # Run in a copy of the request's context, so the stage timings still reach its Server-Timing header
+    try:
+        future = _deadline_executor.submit(
+            contextvars.copy_context().run, get_price, origin, destination, date, adults, currency, with_offers,
+        )
+    except RuntimeError:
+        # The pool is shutting down
+        _finish_deadline_fetch(None)
+        raise
+    future.add_done_callback(_finish_deadline_fetch)
+    try:
+        return future.result(timeout=settings.PRICE_REQUEST_DEADLINE)
+    except TimeoutError:
+        return None, DEADLINE_ERROR
+
+
+def _finish_deadline_fetch(future):
+    with _deadline_lock:
+        _deadline_counters['pending'] -= 1
+
+
+def refresh_price_in_background(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `refresh_price_in_background` queues a refresh of a stale price entry. A key is only
+    refreshed once at a time: within this process through `_refreshing`, and across processes through
+    a short Redis lease.
+    :param with_offers: Whether the entry holds the offer window, which the refresh then keeps.
+    """
+    key = price_cache_key(origin, destination, date, adults, currency)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    try:
+        _refresh_executor.submit(_refresh_price, key, origin, destination, date, adults, currency, with_offers)
+    except RuntimeError:
+        # The executor is shutting down with the process, the next request will try again
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def refresh_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `refresh_price` fetches and caches a price unless another process is already
+    refreshing it, which is checked with a short Redis lease.
+    :return: A `(data, error)` tuple, as returned by `fetch_price`, or `None` if the refresh was
+    skipped.
+    """
+    lease_key = f"price:refresh:{price_cache_key(origin, destination, date, adults, currency)}"
+    if not cache.add(lease_key, 1, timeout=settings.SINGLE_FLIGHT_LEASE_TIMEOUT):
+        return None
+    try:
+        return fetch_price(origin, destination, date, adults, currency, with_offers)
+    finally:
+        cache.delete(lease_key)
+
+
+def _refresh_price(key, origin, destination, date, adults, currency, with_offers):
+    try:
+        result = refresh_price(origin, destination, date, adults, currency, with_offers)
+        if result and result[1]:
+            logger.warning("Failed to refresh %s: %s", key, result[1])
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+async def aread_price_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `aread_price_entry` is the async version of `read_price_entry`.
+    """
+    with timed('cache'):
+        return await price_cache.aget(price_cache_key(origin, destination, date, adults, currency))
+
+
+async def ainvalidate_price(origin, destination, date, adults=1, currency=None):
+    """
+    The function `ainvalidate_price` is the async version of `invalidate_price`.
+    """
+    await price_cache.ainvalidate(price_cache_key(origin, destination, date, adults, currency))
+
+
+async def aread_fresh_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `aread_fresh_price` is the async version of `read_fresh_price`.
+    """
+    entry = await aread_price_entry(origin, destination, date, adults, currency)
+    if entry and is_fresh(entry) and is_answered(entry, with_offers):
+        return entry_result(entry)
+    return None
+
+
+async def afetch_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `afetch_price` is the async version of `fetch_price`.
+    """
+    window = offer_window(with_offers)
+    flight_data = await AmadeusAPI().afetch_flight_offers(
+        origin, destination, date, adults=adults, currency=currency, max_offers=window,
+    )
+    entry = build_price_entry(flight_data, window)
+    await astore_price_entry(price_cache_key(origin, destination, date, adults, currency), entry)
+    return entry_result(entry)
+
+
+async def aread_last_good_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `aread_last_good_entry` is the async version of `read_last_good_entry`.
+    """
+    return await async_cache.get(last_good_key(price_cache_key(origin, destination, date, adults, currency)))
+
+
+async def aread_fallback_entry(origin, destination, date, adults=1, currency=None):
+    """
+    The function `aread_fallback_entry` is the async version of `read_fallback_entry`.
+    """
+    entry = await aread_last_good_entry(origin, destination, date, adults, currency)
+    if entry:
+        return entry
+    observation = await alatest_observation(origin, destination, date, adults, currency)
+    return observation_entry(observation) if observation else None
+
+
+async def aget_price(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `aget_price` is the async version of `get_price`. It shares the Redis lease with the
+    sync path, so sync and async workers coalesce onto each other.
+    """
+    result = await price_single_flight.ado(
+        single_flight_key(price_cache_key(origin, destination, date, adults, currency), with_offers),
+        lambda: afetch_price(origin, destination, date, adults, currency, with_offers),
+        lambda: aread_fresh_price(origin, destination, date, adults, currency, with_offers),
+    )
+    return result or (None, FETCH_ERROR)
+
+
+async def aget_price_within_deadline(origin, destination, date, adults=1, currency=None, with_offers=False):
+    """
+    The function `aget_price_within_deadline` is the async version of `get_price_within_deadline`.
+    """
+    if settings.PRICE_REQUEST_DEADLINE <= 0:
+        return await aget_price(origin, destination, date, adults, currency, with_offers)
+    task = asyncio.ensure_future(aget_price(origin, destination, date, adults, currency, with_offers))
+    try:
+        # Shielded, so the fetch is not cancelled at the deadline
+        return await asyncio.wait_for(asyncio.shield(task), settings.PRICE_REQUEST_DEADLINE)
+    except asyncio.TimeoutError:
+        if len(_background_fetches) >= settings.PRICE_DEADLINE_MAX_PENDING:
+            # Too many fetches already outlived their request, drop this one
+            with _deadline_lock:
+                _deadline_counters['abandoned'] += 1
+            task.cancel()
+        else:
+            _background_fetches.add(task)
+            task.add_done_callback(_finish_background_fetch)
+        return None, DEADLINE_ERROR
+
+
+def _finish_background_fetch(task):
+    _background_fetches.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Failed to fetch a price in the background: %s", task.exception())
+
+
+def deadline_stats():
+    """
+    The function `deadline_stats` returns how many deadline-bound fetches of this process are pending,
+    and how many were refused or dropped because `PRICE_DEADLINE_MAX_PENDING` were already pending.
+    """
+    with _deadline_lock:
+        return dict(_deadline_counters, pending=_deadline_counters['pending'] + len(_background_fetches))
+
+
+def get_prices(items, deadline):
+    """
+    The function `get_prices` looks up the prices for many searches at once. All cache entries missing
+    from L1 are read with one MGET, and only the misses are fetched through a bounded worker pool. Each
+    miss goes through `get_price`, so it is coalesced with identical lookups of other requests and
+    workers, and caches its entry as soon as it is fetched.
+
+    :param items: A list of `(origin, destination, date, adults)` tuples.
+    :param deadline: The number of seconds the whole lookup may take. Fetches that have not finished
+    by then are reported as errors, and are cached when they complete.
+    :return: A list of `(data, error)` tuples, in the same order as `items`. While the circuit breaker
+    is open, the last known good price is returned for the searches that have one.
+    """
+    started = time.monotonic()
+    keys = [price_cache_key(*item) for item in items]
+    # Read every entry from L1, and every L1 miss from Redis in one MGET
+    with timed('cache'):
+        entries = price_cache.get_many(keys)
+
+    results = {}
+    misses = {}
+    for key, item in zip(keys, items):
+        entry = entries.get(key)
+        if entry:
+            # Stale entries are served like in the single price endpoint and refreshed in the background
+            if not is_fresh(entry):
+                refresh_price_in_background(*item, with_offers=has_offer_window(entry))
+            results[key] = entry_result(entry)
+        elif key not in misses:
+            misses[key] = item
+
+    # Fetch only the misses, concurrently
+    futures = {_fanout_executor.submit(get_price, *item): key for key, item in misses.items()}
+    done, not_done = wait(futures, timeout=max(0, deadline - (time.monotonic() - started)))
+
+    for future in done:
+        key = futures[future]
+        # A fetch that raised only fails its own search, not the whole batch
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            logger.warning("Failed to fetch %s: %s", key, e)
+            results[key] = (None, FETCH_ERROR)
+    for future in not_done:
+        results[futures[future]] = (None, DEADLINE_ERROR)
+        # The fetch goes on and caches the entry once it completes, only its failure is left to report
+        future.add_done_callback(partial(_finish_late_fetch, futures[future]))
+
+    # Serve the last known good prices of the searches that failed fast on the open circuit
+    unavailable = [key for key in results if results[key][1] == CIRCUIT_OPEN_ERROR]
+    if unavailable:
+        last_good = cache.get_many([last_good_key(key) for key in unavailable])
+        for key in unavailable:
+            entry = last_good.get(last_good_key(key))
+            if entry:
+                results[key] = entry_result(entry)
+    return [results[key] for key in keys]
+
+
+def _finish_late_fetch(key, future):
+    if future.exception() is not None:
+        logger.warning("Failed to fetch %s after the deadline: %s", key, future.exception())
+
+
+def iter_price_range(origin, destination, dates, adults=1):
+    """
+    The function `iter_price_range` looks up the prices of one route over several departure dates and
+    yields each result as soon as it is available. Cached days are read with one MGET and yielded
+    first, then the uncached days are fetched in parallel, at most `PRICE_RANGE_MAX_CONCURRENCY` at a
+    time, and yielded in the order they finish. Fetches go through `get_price`, so they share the
+    per-day cache entries and coalescing of the single price endpoint. While the circuit breaker is
+    open, the last known good price is yielded for the days that have one.
+
+    :param dates: The departure dates to look up, as `YYYY-MM-DD` strings.
+    :return: A generator of `(date, data, error)` tuples.
+    """
+    keys = [price_cache_key(origin, destination, date, adults) for date in dates]
+    with timed('cache'):
+        entries = price_cache.get_many(keys)
+
+    pending = []
+    for key, date in zip(keys, dates):
+        entry = entries.get(key)
+        if entry:
+            if not is_fresh(entry):
+                refresh_price_in_background(origin, destination, date, adults, with_offers=has_offer_window(entry))
+            yield date, *entry_result(entry)
+        else:
+            pending.append(date)
+
+    # Keep at most the configured number of fetches running, starting the next one as each finishes
+    pending = iter(pending)
+    running = {}
+
+    def submit_next():
+        date = next(pending, None)
+        if date is not None:
+            running[_fanout_executor.submit(get_price, origin, destination, date, adults)] = date
+
+    for _ in range(settings.PRICE_RANGE_MAX_CONCURRENCY):
+        submit_next()
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            date = running.pop(future)
+            submit_next()
+            # A fetch that raised only fails its own day, the rest of the window is still streamed
+            try:
+                response_data, error = future.result()
+            except Exception as e:
+                logger.warning("Failed to fetch %s: %s", price_cache_key(origin, destination, date, adults), e)
+                response_data, error = None, FETCH_ERROR
+            if error == CIRCUIT_OPEN_ERROR:
+                entry = read_last_good_entry(origin, destination, date, adults)
+                if entry:
+                    response_data, error = entry_result(entry)
+            yield date, response_data, error
+
+
+def price_amount(data):
+    """
+    The function `price_amount` extracts the numeric amount from serialized price data, whose `price`
+    field is formatted as `<total> <currency>`.
+    :return: The amount as a `Decimal`, or `None` if the price is not available.
+    """
+    try:
+        return Decimal(data['price'].split(' ')[0])
+    except (KeyError, AttributeError, InvalidOperation):
+        return None
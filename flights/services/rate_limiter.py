@@ -0,0 +1,239 @@
+# The `UpstreamLimiter` class keeps outbound calls within the Amadeus transaction quota. A token bucket
+# in Redis limits the request rate across the whole cluster, and each process adapts how many calls it
+# keeps in flight: it halves its concurrency on a 429 and ramps back up one call at a time on success.
+# Callers queue for a bounded time instead of failing as soon as the quota is reached.
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import async_cache
+
+
+# Refills the bucket for the time elapsed since the last call, then takes one token. Returns the
+# number of seconds to wait before trying again (as a string, Redis would truncate a Lua float),
+# or "0" if a token was taken. While the pause key set after a 429 exists, no tokens are handed out.
+TOKEN_BUCKET_SCRIPT = """
+local pause = redis.call('PTTL', KEYS[2])
+if pause > 0 then
+    return tostring(pause / 1000)
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+def parse_retry_after(value):
+    """
+    The function `parse_retry_after` reads the number of seconds from a `Retry-After` header.
+    :return: The delay in seconds, or `None` if the header is missing or not a number of seconds.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamLimiter:
+    """
+    The `UpstreamLimiter` class combines the cluster-wide token bucket with the per-process adaptive
+    concurrency limit, and records queue depth and wait time for the stats endpoint.
+    """
+    def __init__(self, name):
+        self.bucket_key = f"flights:ratelimit:{name}:bucket"
+        self.pause_key = f"flights:ratelimit:{name}:pause"
+        self.max_concurrency = settings.AMADEUS_MAX_CONCURRENCY
+        # The concurrency limit is a float so it can grow by fractions of a call on each success
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._script = None
+        self._counters = {
+            'acquired': 0,
+            'timed_out': 0,
+            'throttled': 0,
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'wait_seconds_total': 0.0,
+            'max_wait_seconds': 0.0,
+        }
+
+    def _take_token(self):
+        # Returns the number of seconds to wait for the next token, or 0 if one was taken
+        if self._script is None:
+            self._script = get_redis_connection('default').register_script(TOKEN_BUCKET_SCRIPT)
+        wait = self._script(
+            keys=[self.bucket_key, self.pause_key],
+            args=[settings.AMADEUS_RATE_LIMIT_PER_SECOND, settings.AMADEUS_RATE_LIMIT_BURST],
+        )
+        return float(wait)
+
+    async def _atake_token(self):
+        wait = await async_cache.get_client().eval(
+            TOKEN_BUCKET_SCRIPT, 2, self.bucket_key, self.pause_key,
+            settings.AMADEUS_RATE_LIMIT_PER_SECOND, settings.AMADEUS_RATE_LIMIT_BURST,
+        )
+        return float(wait)
+
+    def _try_slot(self):
+        # Must be called with the condition held
+        if self.in_flight < max(1, int(self.limit)):
+            self.in_flight += 1
+            return True
+        return False
+
+    def _record_wait(self, started, acquired):
+        waited = time.monotonic() - started
+        with self._condition:
+            self._counters['queue_depth'] -= 1
+            self._counters['acquired' if acquired else 'timed_out'] += 1
+            self._counters['wait_seconds_total'] += waited
+            self._counters['max_wait_seconds'] = max(self._counters['max_wait_seconds'], waited)
+
+    def _enter_queue(self):
+        with self._condition:
+            self._counters['queue_depth'] += 1
+            self._counters['max_queue_depth'] = max(self._counters['max_queue_depth'], self._counters['queue_depth'])
+
+    def acquire(self, deadline):
+        """
+        The function `acquire` waits, at most until `deadline`, until this process has a free
+        concurrency slot and the cluster-wide bucket hands out a token.
+        :param deadline: The `time.monotonic()` value after which the caller gives up.
+        :return: `True` if the caller may send its request and must call `release` afterwards, or
+        `False` if the wait timed out.
+        """
+        started = time.monotonic()
+        self._enter_queue()
+        with self._condition:
+            got_slot = self._try_slot()
+            while not got_slot:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+                got_slot = self._try_slot()
+        if not got_slot:
+            self._record_wait(started, False)
+            return False
+        # The caller holds a slot from here on, give it back if the wait for a token fails
+        try:
+            while True:
+                wait = self._take_token()
+                if wait <= 0:
+                    self._record_wait(started, True)
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._release_slot()
+                    self._record_wait(started, False)
+                    return False
+                time.sleep(min(wait, remaining))
+        except BaseException:
+            self._release_slot()
+            self._record_wait(started, False)
+            raise
+
+    async def aacquire(self, deadline):
+        """
+        The function `aacquire` is the async version of `acquire`. It polls for a concurrency slot
+        instead of blocking the event loop on the condition. A caller cancelled while it waits, e.g.
+        by a request deadline, leaves the queue and gives its slot back.
+        """
+        started = time.monotonic()
+        self._enter_queue()
+        try:
+            while True:
+                with self._condition:
+                    if self._try_slot():
+                        break
+                if time.monotonic() >= deadline:
+                    self._record_wait(started, False)
+                    return False
+                await asyncio.sleep(0.01)
+        except BaseException:
+            self._record_wait(started, False)
+            raise
+        try:
+            while True:
+                wait = await self._atake_token()
+                if wait <= 0:
+                    self._record_wait(started, True)
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._release_slot()
+                    self._record_wait(started, False)
+                    return False
+                await asyncio.sleep(min(wait, remaining))
+        except BaseException:
+            self._release_slot()
+            self._record_wait(started, False)
+            raise
+
+    def _release_slot(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def release(self, status_code=None, retry_after=None):
+        """
+        The function `release` frees the caller's concurrency slot and adapts the limit to the outcome
+        of the request. On a 429 the limit is halved and the whole cluster pauses for the `Retry-After`
+        delay, on any other response the limit grows back by one call per window of calls.
+
+        :param status_code: The HTTP status of the response, or `None` if the request failed.
+        :param retry_after: The value of the `Retry-After` header of the response, if any.
+        """
+        pause = self._adapt(status_code, retry_after)
+        if pause:
+            # Stop the bucket from handing out tokens to any worker until the delay has passed
+            get_redis_connection('default').set(self.pause_key, 1, px=pause)
+
+    async def arelease(self, status_code=None, retry_after=None):
+        """
+        The function `arelease` is the async version of `release`.
+        """
+        pause = self._adapt(status_code, retry_after)
+        if pause:
+            await async_cache.get_client().set(self.pause_key, 1, px=pause)
+
+    def _adapt(self, status_code, retry_after):
+        # Frees the slot and adapts the limit, returns how many milliseconds to pause after a 429
+        with self._condition:
+            self.in_flight -= 1
+            if status_code == 429:
+                self._counters['throttled'] += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif status_code is not None:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+        if status_code != 429:
+            return 0
+        delay = parse_retry_after(retry_after) or settings.AMADEUS_RATE_LIMIT_DEFAULT_BACKOFF
+        return max(1, int(delay * 1000))
+
+    def stats(self):
+        """
+        The function `stats` returns the limiter counters, the current concurrency limit and the number
+        of calls in flight for this process.
+        """
+        with self._condition:
+            return dict(self._counters, limit=round(self.limit, 2), in_flight=self.in_flight)
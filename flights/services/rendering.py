@@ -0,0 +1,24 @@
+# The `rendering` module renders JSON response bodies with orjson. The bodies are byte-for-byte the
+# same as those of DRF's `JSONRenderer` with its default settings (compact separators, non-ASCII
+# characters left as UTF-8, U+2028 and U+2029 escaped), so views can return pre-rendered bytes from
+# the cache without the DRF `Response` machinery.
+import orjson
+
+
+def render_json(payload):
+    """
+    The function `render_json` renders a payload the way DRF's `JSONRenderer` does.
+    :return: The JSON body as UTF-8 bytes.
+    """
+    body = orjson.dumps(payload)
+    # DRF escapes the two line terminators that are valid in JSON but not in JavaScript strings
+    if b'\xe2\x80\xa8' in body or b'\xe2\x80\xa9' in body:
+        body = body.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return body
+
+
+def render_data(data):
+    """
+    The function `render_data` renders the `{"data": ...}` body of a successful price response.
+    """
+    return render_json({'data': data})
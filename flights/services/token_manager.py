@@ -0,0 +1,331 @@
+# The `TokenManager` class keeps the Amadeus OAuth access token fresh. It honors the `expires_in`
+# returned by the server, refreshes the token shortly before it expires, and makes sure only one
+# refresh runs at a time across all workers by coordinating through a Redis lock. A refresh ahead of
+# expiry runs on a background thread or task, so the request that notices it keeps the current token.
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+from redis.exceptions import LockError
+from requests.exceptions import RequestException, Timeout, HTTPError
+from django.conf import settings
+from django.core.cache import cache
+
+from . import async_cache
+from .http_client import get_async_client, get_session, get_timeout
+from .local_cache import LocalCache
+
+
+logger = logging.getLogger(__name__)
+
+# Holds the in-memory copy of each token, there is one entry per set of client credentials
+token_local_cache = LocalCache(max_entries=64, max_bytes=64 * 1024)
+
+
+def credential_label(client_id):
+    """
+    The function `credential_label` identifies a set of client credentials in Redis keys, stats and logs
+    without disclosing the client ID.
+    :return: A short hex digest of the client ID.
+    """
+    return hashlib.blake2b(client_id.encode(), digest_size=4).hexdigest()
+
+
+class TokenManager:
+    """
+    The `TokenManager` class owns the access token for one set of client credentials. The token is
+    stored in Redis so every worker shares it, and a per-process copy is kept in memory so hot
+    requests do not need a Redis round trip.
+    """
+    def __init__(self, client_id, client_secret, token_url):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.label = credential_label(client_id)
+        self.cache_key = f"amadeus_token:{self.label}"
+        self.lock_key = f"{self.cache_key}:lock"
+        self.session = get_session()
+        self._local_lock = threading.Lock()
+        # The thread running a refresh ahead of expiry, if any
+        self._refresh_thread = None
+        self._refresh_thread_lock = threading.Lock()
+        # The async path serializes refreshes with one asyncio lock per event loop, and runs refreshes
+        # ahead of expiry as one task per event loop. The tasks are kept here so they are not garbage
+        # collected while they run
+        self._async_locks = weakref.WeakKeyDictionary()
+        self._refresh_tasks = weakref.WeakKeyDictionary()
+
+    def _get_local(self):
+        # The in-memory copy is a dict with the `access_token` and its absolute `expires_at`
+        return token_local_cache.get(self.cache_key)
+
+    def _set_local(self, entry):
+        # Keep the in-memory copy until the token is treated as expired
+        ttl = entry['expires_at'] - settings.AMADEUS_TOKEN_EXPIRY_MARGIN - time.time()
+        token_local_cache.set(self.cache_key, entry, ttl)
+
+    def _is_expired(self, entry, now):
+        # Treat the token as expired a safety margin before the server does
+        return now >= entry['expires_at'] - settings.AMADEUS_TOKEN_EXPIRY_MARGIN
+
+    def _needs_refresh(self, entry, now):
+        # Inside the refresh-ahead window the token is still usable, but a new one should be fetched
+        return now >= entry['expires_at'] - settings.AMADEUS_TOKEN_REFRESH_AHEAD
+
+    def get_token(self):
+        """
+        The function `get_token` returns a valid access token, refreshing it first if needed.
+        :return: The access token, or `None` if no token could be retrieved.
+        """
+        now = time.time()
+        entry = self._get_local()
+        # Fall back to the shared copy in Redis when the in-memory copy is missing or expired
+        if entry is None or self._is_expired(entry, now):
+            entry = cache.get(self.cache_key)
+            if entry and not self._is_expired(entry, now):
+                self._set_local(entry)
+        if entry and not self._is_expired(entry, now):
+            # Refresh proactively on a background thread, the current token is still valid
+            if self._needs_refresh(entry, now):
+                self._refresh_in_background()
+            return entry['access_token']
+        entry = self._refresh(blocking=True)
+        return entry['access_token'] if entry else None
+
+    def _refresh_in_background(self):
+        # Starts a refresh ahead of expiry unless one is already running in this process. `_refresh`
+        # gives up if another worker holds the Redis lock
+        with self._refresh_thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._refresh, kwargs={'blocking': False}, name='token-refresh', daemon=True,
+            )
+            self._refresh_thread.start()
+
+    def force_refresh(self, rejected_token):
+        """
+        The function `force_refresh` replaces a token that the API rejected. If another thread or
+        worker has already replaced it, the newer token is returned without another refresh.
+        :param rejected_token: The access token that was rejected with a 401.
+        :return: A new access token, or `None` if no token could be retrieved.
+        """
+        entry = self._refresh(blocking=True, rejected_token=rejected_token)
+        return entry['access_token'] if entry else None
+
+    def _usable(self, entry, now, blocking, rejected_token):
+        # Check whether a token found while refreshing can be used instead of fetching a new one
+        if not entry or entry['access_token'] == rejected_token:
+            return False
+        if blocking:
+            return not self._is_expired(entry, now)
+        return not self._needs_refresh(entry, now)
+
+    def _refresh(self, blocking, rejected_token=None):
+        """
+        The function `_refresh` fetches a new token while holding the in-process lock and the Redis
+        lock, so only one refresh happens at a time across the cluster.
+        :param blocking: When `True` the caller waits for the refresh, otherwise it gives up as soon
+        as another thread or worker is already refreshing.
+        :param rejected_token: A token that must not be returned, because the API rejected it.
+        :return: The new token entry, or `None` if no token could be retrieved.
+        """
+        wait = settings.AMADEUS_TOKEN_LOCK_WAIT
+        if blocking:
+            acquired = self._local_lock.acquire(timeout=wait)
+        else:
+            acquired = self._local_lock.acquire(blocking=False)
+        if not acquired:
+            return None
+        try:
+            # Another thread or worker may have refreshed the token while we were waiting
+            entry = cache.get(self.cache_key)
+            if self._usable(entry, time.time(), blocking, rejected_token):
+                self._set_local(entry)
+                return entry
+
+            lock = cache.lock(self.lock_key, timeout=settings.AMADEUS_TOKEN_LOCK_TIMEOUT, blocking_timeout=wait)
+            if not lock.acquire(blocking=blocking):
+                if not blocking:
+                    return None
+                # The lock holder did not finish in time, use its token if it appeared meanwhile
+                entry = cache.get(self.cache_key)
+                if self._usable(entry, time.time(), blocking, rejected_token):
+                    self._set_local(entry)
+                    return entry
+                return self._fetch()
+            try:
+                # Check once more now that we hold the cluster-wide lock
+                entry = cache.get(self.cache_key)
+                if self._usable(entry, time.time(), blocking, rejected_token):
+                    self._set_local(entry)
+                    return entry
+                return self._fetch()
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    # The lock expired before we released it, nothing left to clean up
+                    pass
+        finally:
+            self._local_lock.release()
+
+    def _fetch(self):
+        """
+        The function `_fetch` requests a new token from the OAuth endpoint and stores it in Redis for
+        as long as the server says it is valid.
+        :return: The new token entry, or `None` if there's an error fetching the token.
+        """
+        # Create the payload for the token request
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+        try:
+            response = self.session.post(self.token_url, data=payload, timeout=get_timeout())
+            response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
+            data = response.json()
+        except (RequestException, Timeout, HTTPError, ValueError) as e:
+            logger.warning("Failed to retrieve access token: %s", e)
+            return None
+        entry = self._make_entry(data)
+        if entry:
+            # Keep the token in Redis exactly as long as the server says it is valid
+            cache.set(self.cache_key, entry, timeout=max(1, int(entry['expires_at'] - time.time())))
+            self._set_local(entry)
+        return entry
+
+    def _make_entry(self, data):
+        # Build the token entry from the OAuth response, with an absolute expiry time
+        access_token = data.get('access_token')
+        if not access_token:
+            logger.warning("Failed to retrieve access token: no access_token in response")
+            return None
+        expires_in = int(data.get('expires_in', settings.AMADEUS_TOKEN_DEFAULT_EXPIRES_IN))
+        return {'access_token': access_token, 'expires_at': time.time() + expires_in}
+
+    async def aget_token(self):
+        """
+        The function `aget_token` is the async version of `get_token`, for use on the ASGI request path.
+        :return: The access token, or `None` if no token could be retrieved.
+        """
+        now = time.time()
+        entry = self._get_local()
+        if entry is None or self._is_expired(entry, now):
+            entry = await async_cache.get(self.cache_key)
+            if entry and not self._is_expired(entry, now):
+                self._set_local(entry)
+        if entry and not self._is_expired(entry, now):
+            if self._needs_refresh(entry, now):
+                self._arefresh_in_background()
+            return entry['access_token']
+        entry = await self._arefresh(blocking=True)
+        return entry['access_token'] if entry else None
+
+    def _arefresh_in_background(self):
+        # The async version of `_refresh_in_background`, it runs the refresh as a task of the running
+        # event loop
+        loop = asyncio.get_running_loop()
+        task = self._refresh_tasks.get(loop)
+        if task is None or task.done():
+            self._refresh_tasks[loop] = loop.create_task(self._arefresh(blocking=False))
+
+    async def aforce_refresh(self, rejected_token):
+        """
+        The function `aforce_refresh` is the async version of `force_refresh`.
+        """
+        entry = await self._arefresh(blocking=True, rejected_token=rejected_token)
+        return entry['access_token'] if entry else None
+
+    async def _arefresh(self, blocking, rejected_token=None):
+        """
+        The function `_arefresh` is the async version of `_refresh`. It takes the same Redis lock, so
+        sync and async workers never refresh at the same time.
+        """
+        wait = settings.AMADEUS_TOKEN_LOCK_WAIT
+        loop = asyncio.get_running_loop()
+        local_lock = self._async_locks.get(loop)
+        if local_lock is None:
+            local_lock = self._async_locks[loop] = asyncio.Lock()
+        if not blocking and local_lock.locked():
+            return None
+        try:
+            await asyncio.wait_for(local_lock.acquire(), timeout=wait)
+        except asyncio.TimeoutError:
+            return None
+        try:
+            entry = await async_cache.get(self.cache_key)
+            if self._usable(entry, time.time(), blocking, rejected_token):
+                self._set_local(entry)
+                return entry
+
+            lock = async_cache.lock(self.lock_key, timeout=settings.AMADEUS_TOKEN_LOCK_TIMEOUT, blocking_timeout=wait)
+            if not await lock.acquire(blocking=blocking):
+                if not blocking:
+                    return None
+                entry = await async_cache.get(self.cache_key)
+                if self._usable(entry, time.time(), blocking, rejected_token):
+                    self._set_local(entry)
+                    return entry
+                return await self._afetch()
+            try:
+                entry = await async_cache.get(self.cache_key)
+                if self._usable(entry, time.time(), blocking, rejected_token):
+                    self._set_local(entry)
+                    return entry
+                return await self._afetch()
+            finally:
+                try:
+                    await lock.release()
+                except LockError:
+                    pass
+        finally:
+            local_lock.release()
+
+    async def _afetch(self):
+        """
+        The function `_afetch` is the async version of `_fetch`.
+        """
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+        try:
+            response = await get_async_client().post(self.token_url, data=payload)
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("Failed to retrieve access token: %s", e)
+            return None
+        entry = self._make_entry(data)
+        if entry:
+            await async_cache.set(self.cache_key, entry, timeout=max(1, int(entry['expires_at'] - time.time())))
+            self._set_local(entry)
+        return entry
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(client_id, client_secret, token_url):
+    """
+    The function `get_token_manager` returns the process-wide token manager for a set of client
+    credentials, so the in-memory token copy is shared by every request in the process.
+    :return: The `TokenManager` for the given credentials.
+    """
+    key = (client_id, token_url)
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                manager = TokenManager(client_id, client_secret, token_url)
+                _managers[key] = manager
+    return manager
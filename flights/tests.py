@@ -1,3 +1,1380 @@
-from django.test import TestCase
+# The tests of the flight price service, grouped by feature. Most of them talk to the Redis server at
+# REDIS_URL, like the app does, so run them with Redis up, e.g.
+# `docker-compose up -d redis && python manage.py test flights`. Each test uses its own keys and
+# removes them afterwards, it never flushes the database.
+import asyncio
+import datetime
+import gzip
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.http import http_date
+from django_redis import get_redis_connection
+from rest_framework.renderers import JSONRenderer
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, ReadTimeoutError
+
+from .models import DEFAULT_CURRENCY_MARKER, PriceObservation
+from .services import http_client, local_cache, price_service
+from .services.amadeus_service import (
+    CIRCUIT_OPEN_ERROR, DEADLINE_ERROR, FETCH_ERROR, NO_FLIGHTS_ERROR, RATE_LIMITED_ERROR, AmadeusAPI,
+)
+from .services.circuit_breaker import CLOSED, PROBE, CircuitBreaker
+from .services.coalescing import SingleFlight
+from .services.credentials import Credential, CredentialPool
+from .services.http_client import BudgetRetry, get_retry_budget, get_session
+from .services.local_cache import LocalCache, TwoTierCache
+from .services.locations import LocationIndex, build_index, get_location_index, read_ourairports_csv
+from .services.metrics import metrics
+from .services.offers import SORT_KEYS, CompactOffer, compact_offer, compact_offers, parse_duration, select_offers
+from .services.popularity import (
+    PERIOD_HALF_LIVES, PopularityTracker, forget_searches, needs_warming, period_start, popularity, top_searches,
+    warm_popular_prices,
+)
+from .services.price_history import PriceHistoryWriter, latest_observation, price_history
+from .services.price_service import (
+    build_price_entry, price_cache, price_cache_key, read_price_entry, store_price_entries,
+)
+from .services.rate_limiter import UpstreamLimiter
+from .services.rendering import render_json
+from .services.token_manager import TokenManager
+
+
+def unique_name(prefix):
+    return f"test:{prefix}:{uuid.uuid4().hex}"
+
+
+def wait_until(condition, timeout=2.0):
+    # Polls `condition` until it holds or `timeout` seconds have passed, and returns its last value
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def offer(total, duration='PT6H', stops=0, carrier='AA', currency='EUR', origin='JFK', destination='LAX', date='2030-01-01'):
+    # A flight offer shaped like the Amadeus response, with one itinerary of `stops + 1` segments
+    segments = [
+        {
+            'carrierCode': carrier,
+            'departure': {'iataCode': origin if index == 0 else 'ORD', 'at': f"{date}T0{index}:00:00"},
+            'arrival': {'iataCode': destination if index == stops else 'ORD', 'at': f"{date}T0{index + 1}:00:00"},
+        }
+        for index in range(stops + 1)
+    ]
+    return {
+        'price': {'total': total, 'currency': currency},
+        'itineraries': [{'duration': duration, 'segments': segments}],
+        'numberOfBookableSeats': 9,
+    }
+
+
+# Every endpoint test searches its own departure dates, ten days apart, so the cache keys of each test
+# are its own
+_test_days = itertools.count(step=10)
+
+
+class PriceEndpointTestCase(SimpleTestCase):
+    """
+    The base of the endpoint tests. Amadeus is replaced by `self.amadeus`, a mock of
+    `AmadeusAPI.fetch_flight_offers`, and the price history and popularity buffers are not written.
+    Every key of the test's dates is removed from Redis and from the L1 of this process before and
+    after the test.
+    """
+    def setUp(self):
+        self.date = (datetime.date(2031, 1, 1) + datetime.timedelta(days=next(_test_days))).isoformat()
+        self.forget_date(self.date)
+        self.addCleanup(self.forget_date, self.date)
+        self.amadeus = self.patch(AmadeusAPI, 'fetch_flight_offers', return_value=self.offers('100.00'))
+        self.record_history = self.patch(price_history, 'record')
+        self.record_popularity = self.patch(popularity, 'record')
+
+    def patch(self, target, attribute, **kwargs):
+        patcher = mock.patch.object(target, attribute, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def forget_date(self, date):
+        redis = get_redis_connection('default')
+        for key in redis.scan_iter(match=f"*{date}*"):
+            redis.delete(key)
+            # Cache keys are stored as `<prefix>:<version>:<key>`
+            price_cache.local.delete(key.decode().split(':', 2)[2])
+
+    def offers(self, *totals, date=None):
+        return [offer(total, date=date or self.date) for total in totals]
+
+    def get_price(self, path='/flights/price/', headers=None, **params):
+        return self.client.get(path, {'origin': 'JFK', 'destination': 'LAX', 'date': self.date, **params}, headers=headers)
+
+
+class HttpClientTests(SimpleTestCase):
+    def retry(self, budget=2):
+        return BudgetRetry(total=3, connect=3, read=3, allowed_methods=frozenset(['GET']), budget=budget)
+
+    def test_session_is_shared(self):
+        self.assertIs(get_session(), get_session())
+
+    def test_connect_errors_are_retried_for_posts(self):
+        # The request never reached the server, so the token POST can be sent again
+        retry = self.retry().increment('POST', '/token', error=ConnectTimeoutError())
+        self.assertEqual(retry.connect, 2)
+
+    def test_timed_out_reads_are_not_retried(self):
+        with self.assertRaises(ReadTimeoutError):
+            self.retry().increment('GET', '/offers', error=ReadTimeoutError(None, '/offers', 'timed out'))
+
+    def test_retries_stop_at_the_budget(self):
+        retry = self.retry(budget=2).increment('GET', '/offers', error=ConnectTimeoutError())
+        later = time.monotonic() + 2
+        with mock.patch.object(http_client.time, 'monotonic', return_value=later):
+            with self.assertRaises(MaxRetryError):
+                retry.increment('GET', '/offers', error=ConnectTimeoutError())
+
+    @override_settings(AMADEUS_HTTP_RETRY_BUDGET=5, PRICE_REQUEST_DEADLINE=3)
+    def test_budget_fits_in_the_request_deadline(self):
+        self.assertEqual(get_retry_budget(), 3)
+
+    @override_settings(AMADEUS_HTTP_RETRY_BUDGET=5, PRICE_REQUEST_DEADLINE=0)
+    def test_budget_without_a_deadline(self):
+        self.assertEqual(get_retry_budget(), 5)
+
+
+@override_settings(SINGLE_FLIGHT_LEASE_TIMEOUT=5, SINGLE_FLIGHT_MAX_WAIT=2, SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight(unique_name('single-flight'))
+        self.key = 'JFK_LAX_2030-01-01'
+        self.lease_key = f"{self.single_flight.namespace}:lease:{self.key}"
+
+    def tearDown(self):
+        cache.delete(self.lease_key)
+
+    def test_concurrent_callers_in_one_process_share_one_fetch(self):
+        started = threading.Event()
+        release = threading.Event()
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            started.set()
+            release.wait(2)
+            return 'price'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.single_flight.do(self.key, fetch, lambda: None)))
+        leader.start()
+        started.wait(2)
+        follower = threading.Thread(target=lambda: results.append(self.single_flight.do(self.key, fetch, lambda: None)))
+        follower.start()
+        self.assertTrue(wait_until(lambda: self.single_flight.stats()['coalesced_local'] == 1))
+        release.set()
+        leader.join(2)
+        follower.join(2)
+        self.assertEqual(results, ['price', 'price'])
+        self.assertEqual(len(fetches), 1)
+        # The lease is released once the leader is done
+        self.assertIsNone(cache.get(self.lease_key))
+
+    def test_waits_for_the_lease_holder_and_reads_its_result(self):
+        # Another process holds the lease and fills the cache a little later
+        cache.add(self.lease_key, 'other-process', timeout=5)
+        shared = {}
+
+        def other_process():
+            time.sleep(0.05)
+            shared['result'] = 'price'
+            cache.delete(self.lease_key)
+
+        threading.Thread(target=other_process).start()
+        fetch = mock.Mock(return_value='fetched')
+        self.assertEqual(self.single_flight.do(self.key, fetch, lambda: shared.get('result')), 'price')
+        fetch.assert_not_called()
+        self.assertEqual(self.single_flight.stats()['coalesced_remote'], 1)
+
+    def test_takes_the_lease_when_it_is_released_without_a_result(self):
+        cache.add(self.lease_key, 'other-process', timeout=5)
+        threading.Timer(0.05, cache.delete, args=[self.lease_key]).start()
+        fetch = mock.Mock(return_value='fetched')
+        self.assertEqual(self.single_flight.do(self.key, fetch, lambda: None), 'fetched')
+        fetch.assert_called_once()
+        self.assertEqual(self.single_flight.stats()['retaken'], 1)
+        self.assertEqual(self.single_flight.stats()['fallback'], 0)
+        self.assertIsNone(cache.get(self.lease_key))
+
+    def test_only_one_waiting_process_fetches_when_the_lease_is_released(self):
+        # Two processes wait on the lease of a third one, which fails without a result
+        cache.add(self.lease_key, 'other-process', timeout=5)
+        processes = [SingleFlight(self.single_flight.namespace) for _ in range(2)]
+        shared = {}
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            time.sleep(0.1)
+            shared['result'] = 'price'
+            return 'price'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda process=process: results.append(process.do(self.key, fetch, lambda: shared.get('result'))))
+            for process in processes
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        cache.delete(self.lease_key)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(results, ['price', 'price'])
+        self.assertEqual(len(fetches), 1)
+
+    @override_settings(SINGLE_FLIGHT_MAX_WAIT=0.1)
+    def test_fetches_when_the_lease_holder_takes_too_long(self):
+        cache.add(self.lease_key, 'other-process', timeout=5)
+        fetch = mock.Mock(return_value='fetched')
+        self.assertEqual(self.single_flight.do(self.key, fetch, lambda: None), 'fetched')
+        fetch.assert_called_once()
+        self.assertEqual(self.single_flight.stats()['fallback'], 1)
+        # The lease of the other process is left alone
+        self.assertEqual(cache.get(self.lease_key), 'other-process')
+
+    def test_does_not_release_a_lease_taken_over_by_another_process(self):
+        def fetch():
+            # The lease expired during the fetch and another process took it
+            cache.set(self.lease_key, 'other-process', timeout=5)
+            return 'price'
+
+        self.assertEqual(self.single_flight.do(self.key, fetch, lambda: None), 'price')
+        self.assertEqual(cache.get(self.lease_key), 'other-process')
+
+
+@override_settings(AMADEUS_TOKEN_EXPIRY_MARGIN=30, AMADEUS_TOKEN_REFRESH_AHEAD=300, AMADEUS_TOKEN_LOCK_WAIT=2)
+class TokenManagerTests(SimpleTestCase):
+    def setUp(self):
+        self.manager = TokenManager(unique_name('client'), 'secret', 'http://127.0.0.1:9/token')
+
+    def tearDown(self):
+        cache.delete(self.manager.cache_key)
+        cache.delete(self.manager.lock_key)
+
+    def store(self, access_token, expires_in):
+        entry = {'access_token': access_token, 'expires_at': time.time() + expires_in}
+        cache.set(self.manager.cache_key, entry, timeout=expires_in)
+        return entry
+
+    def fetch_returning(self, access_token, delay=0.0):
+        def fetch():
+            time.sleep(delay)
+            return self.store(access_token, 1800)
+        return mock.patch.object(self.manager, '_fetch', side_effect=fetch)
+
+    def test_fetches_a_token_when_there_is_none(self):
+        with self.fetch_returning('new') as fetch:
+            self.assertEqual(self.manager.get_token(), 'new')
+            self.assertEqual(self.manager.get_token(), 'new')
+        fetch.assert_called_once()
+
+    def test_uses_the_shared_token_of_another_worker(self):
+        self.store('shared', 1800)
+        with self.fetch_returning('new') as fetch:
+            self.assertEqual(self.manager.get_token(), 'shared')
+        fetch.assert_not_called()
+
+    def test_refreshes_ahead_of_expiry_without_making_the_caller_wait(self):
+        self.store('current', 100)
+        with self.fetch_returning('new', delay=0.2) as fetch:
+            started = time.monotonic()
+            self.assertEqual(self.manager.get_token(), 'current')
+            self.assertEqual(self.manager.get_token(), 'current')
+            self.assertLess(time.monotonic() - started, 0.1)
+            self.assertTrue(wait_until(lambda: self.manager.get_token() == 'new'))
+        fetch.assert_called_once()
+
+    def test_force_refresh_replaces_a_rejected_token_once(self):
+        self.store('rejected', 1800)
+        with self.fetch_returning('new') as fetch:
+            self.assertEqual(self.manager.force_refresh('rejected'), 'new')
+            # A second caller holding the same rejected token gets the new one without a fetch
+            self.assertEqual(self.manager.force_refresh('rejected'), 'new')
+        fetch.assert_called_once()
+
+
+class PriceEndpointTests(PriceEndpointTestCase):
+    def test_miss_is_fetched_and_cached(self):
+        response = self.get_price()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json(), {'data': {
+            'origin': 'JFK', 'destination': 'LAX', 'departure_date': self.date, 'price': '100.00 EUR',
+        }})
+        response = self.get_price()
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json()['data']['price'], '100.00 EUR')
+        self.amadeus.assert_called_once()
+
+    def test_codes_are_normalized(self):
+        self.assertEqual(self.get_price(origin=' jfk', destination='lax').status_code, 200)
+        self.assertEqual(self.amadeus.call_args.args[:3], ('JFK', 'LAX', self.date))
+
+    def test_invalid_parameters_are_rejected_without_a_fetch(self):
+        self.assertEqual(self.get_price(origin='JF').status_code, 400)
+        self.assertEqual(self.get_price(date='01-01-2031').status_code, 400)
+        self.assertEqual(self.client.get('/flights/price/', {'origin': 'JFK'}).status_code, 400)
+        self.amadeus.assert_not_called()
+
+    def test_nocache_fetches_again(self):
+        self.get_price()
+        self.amadeus.return_value = self.offers('90.00')
+        response = self.get_price(nocache='1')
+        self.assertEqual(response['X-Cache'], 'BYPASS')
+        self.assertEqual(response.json()['data']['price'], '90.00 EUR')
+        self.assertEqual(self.get_price().json()['data']['price'], '90.00 EUR')
+
+    @override_settings(PRICE_CACHE_SOFT_TTL=0)
+    def test_stale_price_is_served_and_refreshed_in_the_background(self):
+        self.get_price()
+        self.amadeus.return_value = self.offers('90.00')
+        response = self.get_price()
+        self.assertEqual(response['X-Cache'], 'STALE')
+        self.assertEqual(response.json()['data']['price'], '100.00 EUR')
+        self.assertTrue(wait_until(lambda: read_price_entry('JFK', 'LAX', self.date)['data']['price'] == '90.00 EUR'))
+        self.assertEqual(self.amadeus.call_count, 2)
+
+
+class OfferTests(SimpleTestCase):
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('PT5H30M'), 330)
+        self.assertEqual(parse_duration('P1DT2H'), 1560)
+        self.assertEqual(parse_duration('PT45M'), 45)
+        self.assertEqual(parse_duration(None), 0)
+
+    def test_compact_offer(self):
+        compact = compact_offer(offer('250.00', 'PT6H', 1, carrier='B6'))
+        self.assertEqual(compact, CompactOffer(
+            amount=250.0, total='250.00', currency='EUR', duration=360, stops=1,
+            departure_at='2030-01-01T00:00:00', arrival_at='2030-01-01T02:00:00', carriers=('B6',), seats=9,
+        ))
+        self.assertIsNone(compact_offer({'price': {}}))
+
+    def test_select_offers_filters_and_sorts(self):
+        offers = compact_offers([
+            offer('300.00', 'PT5H', 0), offer('100.00', 'PT9H', 2), offer('200.00', 'PT7H', 1), offer('250.00', 'PT6H', 0),
+        ])
+        self.assertEqual([o.amount for o in offers], [100.0, 200.0, 250.0, 300.0])
+        self.assertEqual([o.amount for o in select_offers(offers, 2)], [100.0, 200.0])
+        self.assertEqual([o.amount for o in select_offers(offers, 5, non_stop=True)], [250.0, 300.0])
+        self.assertEqual([o.amount for o in select_offers(offers, 5, max_price=220)], [100.0, 200.0])
+        self.assertEqual([o.amount for o in select_offers(offers, 2, sort='duration')], [300.0, 250.0])
+        self.assertEqual([o.amount for o in select_offers(offers, 5, sort='stops')], [250.0, 300.0, 200.0, 100.0])
+
+    def test_pruned_offers_select_like_all_offers(self):
+        flight_data = [
+            offer(f"{100 + (index * 37) % 400}.00", f"PT{3 + (index * 7) % 11}H", (index * 5) % 3)
+            for index in range(120)
+        ]
+        every_offer = compact_offers(flight_data)
+        kept = compact_offers(flight_data, 5)
+        self.assertLess(len(kept), len(every_offer))
+        for max_price in [None] + sorted({o.amount for o in every_offer}):
+            for non_stop in (False, True):
+                for sort in SORT_KEYS:
+                    for max_offers in (1, 5):
+                        self.assertEqual(
+                            select_offers(kept, max_offers, non_stop, max_price, sort),
+                            select_offers(every_offer, max_offers, non_stop, max_price, sort),
+                        )
+
+
+class OfferEndpointTests(PriceEndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        # Amadeus returns the cheapest offers first
+        self.amadeus.return_value = [
+            offer('100.00', 'PT9H', 2, date=self.date), offer('200.00', 'PT7H', 1, date=self.date),
+            offer('300.00', 'PT5H', 0, date=self.date),
+        ]
+
+    def prices(self, response):
+        return [item['price'] for item in response.json()['data']['offers']]
+
+    def test_plain_search_only_asks_for_the_cheapest_offer(self):
+        self.get_price()
+        self.assertEqual(self.amadeus.call_args.kwargs['max_offers'], 1)
+        self.assertEqual(read_price_entry('JFK', 'LAX', self.date)['window'], 1)
+
+    def test_one_offer_is_answered_by_a_narrow_entry(self):
+        self.get_price()
+        response = self.get_price(max='1')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(self.prices(response), ['100.00 EUR'])
+        self.amadeus.assert_called_once()
+
+    def test_selection_fetches_the_offer_window_once(self):
+        self.get_price()
+        response = self.get_price(max='5')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(self.prices(response), ['100.00 EUR', '200.00 EUR', '300.00 EUR'])
+        self.assertEqual(self.amadeus.call_count, 2)
+        self.assertEqual(self.amadeus.call_args.kwargs['max_offers'], settings.AMADEUS_OFFERS_WINDOW)
+        # Other filters and sort orders are applied to the cached offers
+        response = self.get_price(nonStop='true')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(self.prices(response), ['300.00 EUR'])
+        self.assertEqual(self.prices(self.get_price(maxPrice='250', sort='duration')), ['200.00 EUR', '100.00 EUR'])
+        self.assertEqual(self.prices(self.get_price(max='2', sort='stops')), ['300.00 EUR', '200.00 EUR'])
+        self.assertEqual(self.get_price().json()['data']['price'], '100.00 EUR')
+        self.assertEqual(self.amadeus.call_count, 2)
+
+    def test_invalid_selection_is_rejected_without_a_fetch(self):
+        for params in ({'max': '0'}, {'max': str(settings.AMADEUS_OFFERS_MAX + 1)}, {'max': 'x'},
+                       {'maxPrice': '-1'}, {'sort': 'seats'}):
+            self.assertEqual(self.get_price(**params).status_code, 400, params)
+        self.amadeus.assert_not_called()
+
+    @override_settings(PRICE_CACHE_SOFT_TTL=0)
+    def test_refresh_keeps_the_offer_window(self):
+        self.get_price(sort='duration')
+        self.amadeus.return_value = self.offers('90.00')
+        self.assertEqual(self.get_price()['X-Cache'], 'STALE')
+        self.assertTrue(wait_until(lambda: read_price_entry('JFK', 'LAX', self.date)['data']['price'] == '90.00 EUR'))
+        self.assertEqual(self.amadeus.call_args.kwargs['max_offers'], settings.AMADEUS_OFFERS_WINDOW)
+        self.assertEqual(read_price_entry('JFK', 'LAX', self.date)['window'], settings.AMADEUS_OFFERS_WINDOW)
+
+    async def test_async_selection_matches_the_sync_endpoint(self):
+        aamadeus = self.patch(
+            AmadeusAPI, 'afetch_flight_offers', new_callable=mock.AsyncMock, return_value=self.amadeus.return_value,
+        )
+        response = await self.async_client.get('/flights/price/async/', {
+            'origin': 'JFK', 'destination': 'LAX', 'date': self.date, 'nonStop': 'true',
+        })
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(aamadeus.call_args.kwargs['max_offers'], settings.AMADEUS_OFFERS_WINDOW)
+        sync_response = await sync_to_async(self.get_price)(nonStop='true')
+        self.assertEqual(sync_response['X-Cache'], 'HIT')
+        self.assertEqual(response.content, sync_response.content)
+
+
+class PriceBatchEndpointTests(PriceEndpointTestCase):
+    def post_batch(self, *items):
+        return self.client.post('/flights/price/batch/', {'items': list(items)}, content_type='application/json')
+
+    def item(self, origin='JFK', destination='LAX', **fields):
+        return {'origin': origin, 'destination': destination, 'date': self.date, **fields}
+
+    def test_returns_one_result_per_item_in_order(self):
+        self.get_price()
+        self.amadeus.side_effect = lambda origin, destination, date, **kwargs: [offer('200.00', origin=origin, destination=destination, date=date)]
+        response = self.post_batch(self.item(destination='SFO'), self.item(), self.item(origin='XX'))
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['data']
+        self.assertEqual(results[0]['data']['price'], '200.00 EUR')
+        # The second search was cached by the single price request
+        self.assertEqual(results[1]['data']['price'], '100.00 EUR')
+        self.assertIn('error', results[2])
+        self.assertEqual(self.amadeus.call_count, 2)
+
+    def test_identical_items_are_fetched_once(self):
+        results = self.post_batch(self.item(), self.item()).json()['data']
+        self.assertEqual(results[0], results[1])
+        self.amadeus.assert_called_once()
+
+    def test_a_failing_fetch_only_fails_its_item(self):
+        def fetch(origin, destination, date, **kwargs):
+            if destination == 'SFO':
+                raise RuntimeError("boom")
+            return [offer('100.00', date=date)]
+
+        self.amadeus.side_effect = fetch
+        with self.assertLogs('flights.services.price_service', 'WARNING'):
+            results = self.post_batch(self.item(destination='SFO'), self.item()).json()['data']
+        self.assertEqual(results[0], {'error': FETCH_ERROR})
+        self.assertEqual(results[1]['data']['price'], '100.00 EUR')
+
+    @override_settings(SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+    def test_misses_are_coalesced_with_lookups_in_flight(self):
+        # Another worker is fetching the search, and caches it a little later
+        key = price_cache_key('JFK', 'LAX', self.date)
+        lease_key = f"price:lease:{key}"
+        cache.add(lease_key, 'other-process', timeout=5)
+
+        def other_process():
+            time.sleep(0.05)
+            store_price_entries({key: build_price_entry(self.offers('80.00'))})
+            cache.delete(lease_key)
+
+        threading.Thread(target=other_process).start()
+        results = self.post_batch(self.item()).json()['data']
+        self.assertEqual(results[0]['data']['price'], '80.00 EUR')
+        self.amadeus.assert_not_called()
+
+    @override_settings(PRICE_BATCH_DEADLINE=0.05)
+    def test_late_fetches_are_cached_when_they_complete(self):
+        def slow_fetch(*args, **kwargs):
+            time.sleep(0.2)
+            return self.offers('100.00')
+
+        self.amadeus.side_effect = slow_fetch
+        results = self.post_batch(self.item()).json()['data']
+        self.assertEqual(results[0], {'error': DEADLINE_ERROR})
+        self.assertTrue(wait_until(lambda: read_price_entry('JFK', 'LAX', self.date) is not None))
+
+
+class PriceRangeEndpointTests(PriceEndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        # Three days from the test's date, the second one is the cheapest
+        self.dates = [(datetime.date.fromisoformat(self.date) + datetime.timedelta(days=offset)).isoformat() for offset in range(3)]
+        self.prices = dict(zip(self.dates, ('300.00', '100.00', '200.00')))
+        self.amadeus.side_effect = lambda origin, destination, date, **kwargs: [offer(self.prices[date], date=date)]
+        for date in self.dates[1:]:
+            self.forget_date(date)
+            self.addCleanup(self.forget_date, date)
+
+    def get_range(self, **params):
+        response = self.client.get('/flights/price/range/', {
+            'origin': 'JFK', 'destination': 'LAX', 'start': self.dates[0], 'end': self.dates[-1], **params,
+        })
+        if not response.streaming:
+            return response, None
+        return response, [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_streams_one_line_per_day_and_the_cheapest_day(self):
+        # The first day is cached and streamed first, the others as they are fetched
+        self.get_price(date=self.dates[0])
+        response, lines = self.get_range()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(lines[0]['date'], self.dates[0])
+        self.assertEqual({line['date']: line['data']['price'] for line in lines[:-1]}, {
+            date: f"{price} EUR" for date, price in self.prices.items()
+        })
+        self.assertEqual(lines[-1]['summary']['cheapest']['date'], self.dates[1])
+        self.assertEqual(self.amadeus.call_count, 3)
+
+    def test_a_failing_day_does_not_end_the_stream(self):
+        def fetch(origin, destination, date, **kwargs):
+            if date == self.dates[1]:
+                raise RuntimeError("boom")
+            return [offer(self.prices[date], date=date)]
+
+        self.amadeus.side_effect = fetch
+        with self.assertLogs('flights.services.price_service', 'WARNING'):
+            response, lines = self.get_range()
+        days = {line['date']: line for line in lines[:-1]}
+        self.assertEqual(days[self.dates[1]], {'date': self.dates[1], 'error': FETCH_ERROR})
+        self.assertEqual(lines[-1]['summary']['cheapest']['date'], self.dates[2])
+
+    def test_invalid_windows_are_rejected(self):
+        self.assertEqual(self.get_range(end=self.date, start=self.dates[-1])[0].status_code, 400)
+        with override_settings(PRICE_RANGE_MAX_DAYS=2):
+            self.assertEqual(self.get_range()[0].status_code, 400)
+        self.amadeus.assert_not_called()
+
+
+class AsyncPriceEndpointTests(PriceEndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        self.aamadeus = self.patch(
+            AmadeusAPI, 'afetch_flight_offers', new_callable=mock.AsyncMock, return_value=self.offers('100.00'),
+        )
+
+    async def aget_price(self, **params):
+        return await self.async_client.get('/flights/price/async/', {
+            'origin': 'JFK', 'destination': 'LAX', 'date': self.date, **params,
+        })
+
+    async def test_miss_is_fetched_and_cached(self):
+        response = await self.aget_price()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['data']['price'], '100.00 EUR')
+        response = await self.aget_price()
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.aamadeus.assert_awaited_once()
+        self.amadeus.assert_not_called()
+
+    async def test_matches_the_sync_endpoint(self):
+        response = await self.aget_price()
+        sync_response = await sync_to_async(self.get_price)()
+        self.assertEqual(sync_response['X-Cache'], 'HIT')
+        self.assertEqual(response.content, sync_response.content)
+        self.assertEqual(response['ETag'], sync_response['ETag'])
+
+    async def test_errors_match_the_sync_endpoint(self):
+        response = await self.aget_price(origin='JF')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, (await sync_to_async(self.get_price)(origin='JF')).content)
+
+    @override_settings(PRICE_CACHE_SOFT_TTL=0)
+    async def test_stale_price_is_served_and_refreshed_in_the_background(self):
+        await self.aget_price()
+        # The refresh runs on the sync thread pool
+        self.amadeus.return_value = self.offers('90.00')
+        response = await self.aget_price()
+        self.assertEqual(response['X-Cache'], 'STALE')
+        self.assertEqual(response.json()['data']['price'], '100.00 EUR')
+        refreshed = await sync_to_async(wait_until)(
+            lambda: read_price_entry('JFK', 'LAX', self.date)['data']['price'] == '90.00 EUR'
+        )
+        self.assertTrue(refreshed)
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = TwoTierCache(unique_name('two-tier'), LocalCache(max_entries=100, max_bytes=1024 * 1024), 30)
+        self.key = unique_name('key')
+
+    def tearDown(self):
+        cache.delete(self.key)
+        local_cache._caches.pop(self.cache.name, None)
+
+    def test_reads_through_to_redis_and_fills_l1(self):
+        cache.set(self.key, {'price': 1}, timeout=60)
+        self.assertEqual(self.cache.get(self.key), {'price': 1})
+        cache.delete(self.key)
+        self.assertEqual(self.cache.get(self.key), {'price': 1})
+        self.assertEqual(self.cache.stats()['redis'], {'hits': 1, 'misses': 0})
+
+    def test_l1_copy_does_not_outlive_the_redis_ttl(self):
+        cache.set(self.key, {'error': 'No flight offers found.'}, timeout=1)
+        self.assertEqual(self.cache.get_many([self.key]), {self.key: {'error': 'No flight offers found.'}})
+        cache.delete(self.key)
+        self.assertIsNotNone(self.cache.local.get(self.key))
+        time.sleep(1.05)
+        self.assertIsNone(self.cache.local.get(self.key))
+
+    def test_invalidation_from_another_worker_drops_the_l1_copy(self):
+        # The first read from Redis starts the listener
+        self.cache.get(self.key)
+        self.cache.set(self.key, {'price': 1}, timeout=60)
+        self.assertTrue(wait_until(lambda: local_cache._listener is not None and local_cache._listener.is_alive()))
+        # Give the listener time to subscribe, then publish like another process would
+        time.sleep(0.1)
+        get_redis_connection('default').publish(
+            settings.L1_INVALIDATION_CHANNEL, f"other-process|{self.cache.name}|{self.key}",
+        )
+        self.assertTrue(wait_until(lambda: self.cache.local.get(self.key) is None))
+
+    def test_own_writes_keep_the_l1_copy(self):
+        self.cache.get(self.key)
+        time.sleep(0.1)
+        self.cache.set(self.key, {'price': 2}, timeout=60)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.local.get(self.key), {'price': 2})
+
+    def test_forked_worker_gets_its_own_process_id(self):
+        process_id = local_cache._get_process_id()
+        # Restore the ID of this process afterwards, the running listener ignores messages sent with it
+        with mock.patch.object(local_cache, '_process_id', process_id), \
+                mock.patch.object(local_cache, '_process_id_pid', local_cache._process_id_pid), \
+                mock.patch('flights.services.local_cache.os.getpid', return_value=-1):
+            self.assertNotEqual(local_cache._get_process_id(), process_id)
+        self.assertEqual(local_cache._get_process_id(), process_id)
+
+
+class PriceL1EndpointTests(PriceEndpointTestCase):
+    def test_price_refreshed_by_another_worker_replaces_the_l1_copy(self):
+        self.get_price()
+        key = price_cache_key('JFK', 'LAX', self.date)
+        self.assertIsNotNone(price_cache.local.get(key))
+        # Another worker writes a new price to Redis and publishes the invalidation
+        time.sleep(0.1)
+        cache.set(key, build_price_entry(self.offers('90.00')), timeout=60)
+        get_redis_connection('default').publish(settings.L1_INVALIDATION_CHANNEL, f"other-process|price|{key}")
+        self.assertTrue(wait_until(lambda: price_cache.local.get(key) is None))
+        self.assertEqual(self.get_price().json()['data']['price'], '90.00 EUR')
+        self.amadeus.assert_called_once()
+
+
+@override_settings(
+    AMADEUS_RATE_LIMIT_PER_SECOND=10, AMADEUS_RATE_LIMIT_BURST=2, AMADEUS_RATE_LIMIT_DEFAULT_BACKOFF=1,
+    AMADEUS_MAX_CONCURRENCY=4,
+)
+class UpstreamLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.name = unique_name('limiter')
+        self.limiter = UpstreamLimiter(self.name)
+
+    def tearDown(self):
+        get_redis_connection('default').delete(self.limiter.bucket_key, self.limiter.pause_key)
+
+    def test_bucket_hands_out_its_burst_then_asks_to_wait(self):
+        self.assertEqual(self.limiter._take_token(), 0)
+        self.assertEqual(self.limiter._take_token(), 0)
+        wait = self.limiter._take_token()
+        # One token comes back every 1 / rate seconds
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+    def test_bucket_refills_over_time(self):
+        for _ in range(2):
+            self.limiter._take_token()
+        self.assertGreater(self.limiter._take_token(), 0)
+        time.sleep(0.25)
+        self.assertEqual(self.limiter._take_token(), 0)
+        self.assertEqual(self.limiter._take_token(), 0)
+
+    def test_bucket_is_shared_by_limiters_with_the_same_name(self):
+        other = UpstreamLimiter(self.name)
+        self.limiter._take_token()
+        other._take_token()
+        self.assertGreater(self.limiter._take_token(), 0)
+
+    def test_throttled_response_pauses_the_bucket(self):
+        self.assertTrue(self.limiter.acquire(time.monotonic() + 1))
+        self.limiter.release(429, '2')
+        wait = self.limiter._take_token()
+        self.assertGreater(wait, 1)
+        self.assertLessEqual(wait, 2)
+
+    def test_acquire_times_out_when_the_bucket_is_empty(self):
+        for _ in range(2):
+            self.assertTrue(self.limiter.acquire(time.monotonic() + 1))
+            self.limiter.release(200)
+        self.assertFalse(self.limiter.acquire(time.monotonic() + 0.01))
+        stats = self.limiter.stats()
+        self.assertEqual(stats['timed_out'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_concurrency_halves_on_429_and_grows_back_on_success(self):
+        self.limiter.in_flight = 1
+        self.limiter.release(429, '0')
+        self.assertEqual(self.limiter.limit, 2)
+        # Each success adds 1 / limit, about one call per window of calls
+        self.limiter.in_flight = 1
+        self.limiter.release(200)
+        self.assertEqual(self.limiter.limit, 2.5)
+        for _ in range(10):
+            self.limiter.in_flight = 1
+            self.limiter.release(200)
+        self.assertEqual(self.limiter.limit, 4)
+
+    async def test_cancelled_wait_gives_the_slot_back(self):
+        # Empty the bucket, so the caller gets a slot and then waits for a token
+        self.assertEqual(self.limiter._take_token(), 0)
+        self.assertEqual(self.limiter._take_token(), 0)
+        task = asyncio.ensure_future(self.limiter.aacquire(time.monotonic() + 5))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.limiter.in_flight, 1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        stats = self.limiter.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_failed_token_wait_gives_the_slot_back(self):
+        with mock.patch.object(self.limiter, '_take_token', side_effect=ConnectionError("Redis is down")):
+            with self.assertRaises(ConnectionError):
+                self.limiter.acquire(time.monotonic() + 5)
+        stats = self.limiter.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+
+
+@override_settings(
+    AMADEUS_BREAKER_FAILURE_THRESHOLD=3, AMADEUS_BREAKER_WINDOW=30, AMADEUS_BREAKER_OPEN_SECONDS=30,
+    AMADEUS_BREAKER_PROBE_TIMEOUT=15,
+)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.name = unique_name('breaker')
+        self.breaker = CircuitBreaker(self.name)
+        self.redis = get_redis_connection('default')
+
+    def tearDown(self):
+        breaker = self.breaker
+        self.redis.delete(breaker.open_key, breaker.tripped_key, breaker.failures_key, breaker.probe_key)
+
+    def trip(self):
+        for _ in range(3):
+            self.breaker.record(self.breaker.allow(), False)
+
+    def after_open_period(self):
+        # The open period is over once the time passes the `open` value, whether or not the key expired
+        return mock.patch('flights.services.circuit_breaker.time.time', return_value=time.time() + 31)
+
+    def test_stays_closed_below_the_threshold(self):
+        for _ in range(2):
+            self.breaker.record(self.breaker.allow(), False)
+        # A success while closed does not reset the window, but does not count either
+        self.breaker.record(self.breaker.allow(), True)
+        self.assertEqual(self.breaker.allow(), CLOSED)
+
+    def test_opens_at_the_threshold_and_rejects_calls(self):
+        self.trip()
+        self.assertIsNone(self.breaker.allow())
+        stats = self.breaker.stats()
+        self.assertTrue(stats['open'])
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+    def test_open_state_is_shared_with_other_processes(self):
+        self.trip()
+        # A breaker of another worker only knows the state kept in Redis
+        other = CircuitBreaker(self.name)
+        self.assertIsNone(other.allow())
+
+    def test_lets_a_single_probe_through_after_the_open_period(self):
+        self.trip()
+        with self.after_open_period():
+            self.assertEqual(self.breaker.allow(), PROBE)
+            self.assertIsNone(self.breaker.allow())
+
+    def test_successful_probe_closes_the_circuit(self):
+        self.trip()
+        with self.after_open_period():
+            permit = self.breaker.allow()
+            self.breaker.record(permit, True)
+            self.assertEqual(self.breaker.allow(), CLOSED)
+        self.assertEqual(self.breaker.stats()['recovered'], 1)
+        self.assertFalse(self.redis.exists(self.breaker.tripped_key))
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.trip()
+        with self.after_open_period():
+            self.breaker.record(self.breaker.allow(), False)
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+
+    def test_probe_without_outcome_frees_the_probe(self):
+        self.trip()
+        with self.after_open_period():
+            self.breaker.record(self.breaker.allow(), None)
+            self.assertEqual(self.breaker.allow(), PROBE)
+
+    def test_failure_window_expires(self):
+        self.breaker.record(self.breaker.allow(), False)
+        ttl = self.redis.ttl(self.breaker.failures_key)
+        self.assertTrue(0 < ttl <= 30)
+        # Later failures count in the same window without extending it
+        self.redis.expire(self.breaker.failures_key, 10)
+        self.breaker.record(self.breaker.allow(), False)
+        self.assertEqual(int(self.redis.get(self.breaker.failures_key)), 2)
+        self.assertLessEqual(self.redis.ttl(self.breaker.failures_key), 10)
+
+    def test_async_failures_count_in_the_same_window(self):
+        async def fail():
+            await self.breaker.arecord(await self.breaker.aallow(), False)
+
+        asyncio.run(fail())
+        self.assertTrue(0 < self.redis.ttl(self.breaker.failures_key) <= 30)
+        asyncio.run(fail())
+        self.assertEqual(self.breaker.allow(), CLOSED)
+        asyncio.run(fail())
+        self.assertIsNone(self.breaker.allow())
+
+
+class PriceFailureEndpointTests(PriceEndpointTestCase):
+    def test_search_without_offers_is_cached_as_a_negative_entry(self):
+        self.amadeus.return_value = {'error': NO_FLIGHTS_ERROR}
+        self.assertEqual(self.get_price().status_code, 404)
+        response = self.get_price()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json(), {'error': NO_FLIGHTS_ERROR})
+        self.amadeus.assert_called_once()
+
+    def test_open_circuit_serves_the_last_known_price(self):
+        self.get_price()
+        # Only the last known good copy is left once the cached price has expired
+        key = price_cache_key('JFK', 'LAX', self.date)
+        cache.delete(key)
+        price_cache.local.delete(key)
+        self.amadeus.return_value = {'error': CIRCUIT_OPEN_ERROR}
+        response = self.get_price()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'STALE')
+        self.assertEqual(response.json()['data']['price'], '100.00 EUR')
+
+    def test_open_circuit_without_a_known_price_is_unavailable(self):
+        self.patch(price_service, 'latest_observation', return_value=None)
+        self.amadeus.return_value = {'error': CIRCUIT_OPEN_ERROR}
+        response = self.get_price()
+        self.assertEqual(response.status_code, 503)
+        # Failures are not cached, the next request tries Amadeus again
+        self.get_price()
+        self.assertEqual(self.amadeus.call_count, 2)
+
+
+class RenderingTests(SimpleTestCase):
+    def test_bodies_match_the_drf_renderer(self):
+        payloads = [
+            {'data': {'origin': 'JFK', 'price': '100.00 EUR', 'stops': 0, 'nonStop': True, 'fare': None}},
+            {'data': [{'carrier': 'Lufthansa – Zürich', 'note': 'line\u2028para\u2029end', 'emoji': '✈'}]},
+            {'error': 'No flight offers found for this route and date.'},
+        ]
+        for payload in payloads:
+            self.assertEqual(render_json(payload), JSONRenderer().render(payload))
+
+
+class PreRenderedEndpointTests(PriceEndpointTestCase):
+    def test_cache_hit_body_is_the_body_drf_renders(self):
+        miss = self.get_price()
+        hit = self.get_price()
+        self.assertEqual(hit['X-Cache'], 'HIT')
+        self.assertEqual(hit['Content-Type'], 'application/json')
+        self.assertEqual(hit.content, miss.content)
+        self.assertEqual(hit.content, JSONRenderer().render(miss.json()))
+
+    def test_browsable_api_still_renders_the_price(self):
+        self.get_price()
+        response = self.get_price(headers={'Accept': 'text/html'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertIn('text/html', response['Content-Type'])
+        self.assertIn(b'100.00 EUR', response.content)
+
+
+class LocationIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = LocationIndex(build_index([
+            ('LON', 'LON', 'CITY'), ('LHR', 'LON', 'AIRPORT'), ('JFK', 'NYC', 'AIRPORT'), ('LHR', 'XXX', 'AIRPORT'),
+        ]))
+
+    def test_looks_codes_up(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.get('LHR'), {'iataCode': 'LHR', 'cityCode': 'LON', 'subType': 'AIRPORT'})
+        self.assertEqual(self.index.get('LON')['subType'], 'CITY')
+        self.assertIn('JFK', self.index)
+        for code in ('ZZZ', 'lhr', 'LH', None, 'ÄBC'):
+            self.assertNotIn(code, self.index)
+        self.assertEqual(self.index.get('ZZZ', {}), {})
+
+    def test_bundled_index_holds_every_airport(self):
+        locations = get_location_index()
+        # The curated city codes are kept, and airports outside the curated list are there too
+        self.assertEqual(locations.get('LHR')['cityCode'], 'LON')
+        for code in ('DAY', 'SYR', 'BZN'):
+            self.assertEqual(locations.get(code)['subType'], 'AIRPORT')
+
+    def test_reads_the_open_airports_of_an_ourairports_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'airports.csv.gz')
+            with gzip.open(path, 'wt', newline='', encoding='utf-8') as csv_file:
+                csv_file.write(
+                    'id,ident,type,name,iata_code\n'
+                    '1,KDAY,large_airport,Dayton International,DAY\n'
+                    '2,XDAY,heliport,Dayton Heliport,day\n'
+                    '3,KOLD,closed,Old Field,OLD\n'
+                    '4,XNON,small_airport,No Code,\n'
+                    '5,XBAD,small_airport,Bad Code,0A1\n'
+                    '6,XSEA,seaplane_base,Sea Base,SEA\n'
+                    '7,KSEA,large_airport,Seattle Tacoma,SEA\n'
+                )
+            self.assertEqual(read_ourairports_csv(path), [('DAY', 'Dayton International'), ('SEA', 'Seattle Tacoma')])
+
+
+class LocationEndpointTests(PriceEndpointTestCase):
+    def test_unknown_code_is_rejected_without_a_fetch(self):
+        response = self.get_price(origin='ZZQ')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unknown IATA code: ZZQ.'})
+        response = self.client.post(
+            '/flights/price/batch/', {'items': [{'origin': 'JFK', 'destination': 'ZZQ', 'date': self.date}]},
+            content_type='application/json',
+        )
+        # A batch answers the invalid item on its own
+        self.assertEqual(response.json(), {'data': [{'error': 'Unknown IATA code: ZZQ.'}]})
+        self.amadeus.assert_not_called()
+        self.record_popularity.assert_not_called()
+
+    def test_airport_outside_the_curated_list_is_searched(self):
+        self.amadeus.return_value = [offer('100.00', destination='DAY', date=self.date)]
+        response = self.get_price(destination='DAY')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['destination'], 'DAY')
+
+    def test_destination_is_reported_as_its_city_code(self):
+        self.amadeus.return_value = [offer('100.00', destination='LHR', date=self.date)]
+        self.assertEqual(self.get_price(destination='LHR').json()['data']['destination'], 'LON')
+
+
+class ServerTimingEndpointTests(PriceEndpointTestCase):
+    def stages(self, response):
+        return [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+
+    def test_stages_are_reported_in_server_timing(self):
+        # The miss is fetched on the deadline pool, its stages still reach the request
+        self.assertEqual(self.stages(self.get_price()), ['cache', 'serialize', 'total'])
+        self.assertEqual(self.stages(self.get_price()), ['cache', 'total'])
+
+    def test_streaming_responses_have_no_header(self):
+        response = self.client.get('/flights/price/range/', {
+            'origin': 'JFK', 'destination': 'LAX', 'start': self.date, 'end': self.date,
+        })
+        b''.join(response.streaming_content)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_metrics_render_every_worker_totals(self):
+        key = unique_name('metrics')
+        self.addCleanup(get_redis_connection('default').delete, key)
+        # Leave what the earlier tests counted out of this test's hash
+        metrics.flush()
+        with override_settings(METRICS_REDIS_KEY=key):
+            self.get_price()
+            self.get_price()
+            # Another worker's flushed counters are added to this one's
+            get_redis_connection('default').hincrbyfloat(key, 'count|price_requests|hit', 2)
+            response = self.client.get('/flights/metrics/')
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('flights_price_requests_total{result="hit"} 3', lines)
+        self.assertIn('flights_price_requests_total{result="miss"} 1', lines)
+        self.assertIn('flights_stage_duration_seconds_count{stage="total"} 2', lines)
+
+
+@override_settings(POPULARITY_HALF_LIFE=3600, POPULARITY_MAX_MEMBERS=100)
+class PopularityTests(SimpleTestCase):
+    def setUp(self):
+        self.key = unique_name('popular')
+        settings_override = override_settings(POPULARITY_REDIS_KEY=self.key)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.forget_periods)
+        self.tracker = PopularityTracker()
+        # The start of a period, so the tests control which period each request falls into
+        self.now = period_start(time.time())
+
+    def forget_periods(self):
+        redis = get_redis_connection('default')
+        for key in redis.scan_iter(match=f"{self.key}*"):
+            redis.delete(key)
+
+    def test_recent_requests_outweigh_older_ones(self):
+        for _ in range(3):
+            self.tracker.record('old', now=self.now)
+        self.tracker.record('new', now=self.now + 2 * 3600)
+        self.tracker.record('new', now=self.now + 2 * 3600)
+        self.tracker.flush()
+        ranking = top_searches(10, now=self.now + 2 * 3600)
+        # Two requests two half-lives later weigh 8, three earlier ones 3
+        self.assertEqual(ranking, [('new', 8.0), ('old', 3.0)])
+
+    def test_ranking_carries_the_previous_period_over(self):
+        period = 3600 * PERIOD_HALF_LIVES
+        self.tracker.record('earlier', now=self.now - 1)
+        self.tracker.record('later', now=self.now)
+        self.tracker.flush()
+        ranking = dict(top_searches(10, now=self.now))
+        self.assertEqual(ranking['later'], 1.0)
+        self.assertAlmostEqual(ranking['earlier'], 2 ** ((period - 1) / 3600) * 2 ** -PERIOD_HALF_LIVES)
+        forget_searches(['earlier'], now=self.now)
+        self.assertEqual(top_searches(10, now=self.now), [('later', 1.0)])
+
+    def test_needs_warming(self):
+        with override_settings(PRICE_CACHE_SOFT_TTL=600):
+            self.assertTrue(needs_warming(None, 60))
+            self.assertFalse(needs_warming({'error': NO_FLIGHTS_ERROR, 'fetched_at': 0}, 60))
+            self.assertFalse(needs_warming({'data': {}, 'fetched_at': time.time() - 500}, 60))
+            self.assertTrue(needs_warming({'data': {}, 'fetched_at': time.time() - 550}, 60))
+
+
+class PriceWarmingEndpointTests(PriceEndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        self.key = unique_name('popular')
+        settings_override = override_settings(POPULARITY_REDIS_KEY=self.key)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(PopularityTests.forget_periods, self)
+        self.tracker = PopularityTracker()
+
+    def test_requests_are_counted(self):
+        self.get_price(origin='jfk')
+        self.record_popularity.assert_called_once_with(f"JFK_LAX_{self.date}")
+        # Cache hits are counted too
+        self.get_price()
+        self.assertEqual(self.record_popularity.call_count, 2)
+
+    def test_popular_searches_are_warmed_first(self):
+        self.tracker.record(price_cache_key('JFK', 'LAX', self.date))
+        self.tracker.record(price_cache_key('JFK', 'LAX', self.date))
+        self.tracker.record(price_cache_key('JFK', 'LAX', self.date, currency='USD'))
+        # Past dates are dropped from the ranking
+        self.tracker.record(price_cache_key('JFK', 'LAX', '2020-01-01'))
+        self.tracker.flush()
+        output = io.StringIO()
+        call_command('warm_price_cache', '--top', '10', '--budget', '1', '--lead', '60', stdout=output)
+        self.assertIn("Warmed 1 of 2 due searches", output.getvalue())
+        self.assertIn("1 over budget, 1 expired", output.getvalue())
+        # Only the most popular search fits the budget, and is then served from the cache
+        self.amadeus.assert_called_once()
+        self.assertIsNone(self.amadeus.call_args.kwargs['currency'])
+        self.assertEqual(self.get_price()['X-Cache'], 'HIT')
+        self.assertEqual([member for member, _ in top_searches(10)], [
+            price_cache_key('JFK', 'LAX', self.date), price_cache_key('JFK', 'LAX', self.date, currency='USD'),
+        ])
+
+    def test_fresh_prices_are_not_warmed(self):
+        self.get_price()
+        self.tracker.record(price_cache_key('JFK', 'LAX', self.date))
+        self.tracker.flush()
+        stats = warm_popular_prices(10, 10, 2, 60)
+        self.assertEqual((stats['ranked'], stats['due'], stats['warmed']), (1, 0, 0))
+        self.amadeus.assert_called_once()
+
+
+def upstream_response(status_code, payload=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = json.dumps(payload or {}).encode()
+    return response
+
+
+@override_settings(AMADEUS_CREDENTIAL_THROTTLE_COOLDOWN=30, AMADEUS_CREDENTIAL_AUTH_COOLDOWN=300)
+class CredentialTestCase(SimpleTestCase):
+    """
+    The base of the credential tests, with a pool of two credentials of their own.
+    """
+    def setUp(self):
+        self.credentials = [self.credential() for _ in range(2)]
+        self.pool = CredentialPool(self.credentials)
+
+    def credential(self):
+        credential = Credential(unique_name('client'), 'secret', 'https://auth.example/token')
+        redis = get_redis_connection('default')
+        self.addCleanup(redis.delete, credential.cooldown_key, credential.limiter.bucket_key, credential.limiter.pause_key)
+        return credential
+
+
+class CredentialPoolTests(CredentialTestCase):
+
+    def test_redis_keys_do_not_disclose_the_client_id(self):
+        for credential in self.credentials:
+            keys = (
+                credential.cooldown_key, credential.limiter.bucket_key, credential.limiter.pause_key,
+                credential.token_manager.cache_key, credential.token_manager.lock_key,
+            )
+            for key in keys:
+                self.assertNotIn(credential.client_id, key)
+                self.assertIn(credential.label, key)
+        self.assertEqual(list(self.pool.stats()), [credential.label for credential in self.credentials])
+
+    def test_idle_credentials_take_turns_and_the_least_loaded_is_chosen(self):
+        self.assertEqual({self.pool.choose(), self.pool.choose()}, set(self.credentials))
+        self.credentials[0].limiter.in_flight = 1
+        self.assertIs(self.pool.choose(), self.credentials[1])
+        self.assertIs(self.pool.choose(exclude=[self.credentials[1]]), self.credentials[0])
+        self.assertIsNone(self.pool.choose(exclude=self.credentials))
+
+    def test_throttled_credential_cools_down_in_every_worker(self):
+        first, second = self.credentials
+        first.record(429, '60')
+        self.assertAlmostEqual(first.cooldown_until - time.time(), 60, delta=1)
+        self.assertFalse(self.pool.has_alternative(second))
+        # Another worker reads the cooldown back from Redis
+        other = CredentialPool([Credential(credential.client_id, 'secret', 'https://auth.example/token') for credential in self.credentials])
+        for _ in range(3):
+            self.assertEqual(other.choose().label, second.label)
+        # Once every credential cools down, a new request still gets the one back first
+        second.record(429, None)
+        self.assertIs(self.pool.choose(), second)
+        self.assertIsNone(self.pool.choose(exclude=[second]))
+
+
+
+class CredentialFailoverTests(CredentialTestCase):
+    """
+    Runs a search against two credentials whose upstream answers are scripted per token.
+    """
+    def setUp(self):
+        super().setUp()
+        self.api = AmadeusAPI()
+        self.api.pool = self.pool
+        for credential in self.credentials:
+            patcher = mock.patch.object(credential.token_manager, 'get_token', return_value=f"token-{credential.label}")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.answers = {}
+        patcher = mock.patch.object(self.api.session, 'get', side_effect=self.answer)
+        self.upstream = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def answer(self, url, headers, params, timeout):
+        return self.answers[headers['Authorization'].split('-', 1)[1]]
+
+    def search(self):
+        return self.api.fetch_flight_offers('JFK', 'LAX', '2031-01-01')
+
+    def test_throttled_call_moves_to_another_credential(self):
+        first, second = self.credentials
+        self.answers = {
+            first.label: upstream_response(429, headers={'Retry-After': '5'}),
+            second.label: upstream_response(200, {'data': [offer('100.00')]}),
+        }
+        # Start with the first credential
+        first.limiter.in_flight, second.limiter.in_flight = 0, 1
+        self.assertEqual(self.search(), [offer('100.00')])
+        self.assertTrue(first.is_cooling_down(time.time()))
+        # The throttled credential is left alone until its cooldown ends
+        second.limiter.in_flight = 0
+        self.search()
+        self.assertEqual(self.upstream.call_count, 3)
+        self.assertEqual(self.upstream.call_args.kwargs['headers']['Authorization'], f"Bearer token-{second.label}")
+
+    def test_credential_without_a_token_is_skipped(self):
+        first, second = self.credentials
+        first.token_manager.get_token.return_value = None
+        self.answers = {second.label: upstream_response(200, {'data': [offer('100.00')]})}
+        first.limiter.in_flight, second.limiter.in_flight = 0, 1
+        self.assertEqual(self.search(), [offer('100.00')])
+        self.assertTrue(first.is_cooling_down(time.time()))
+
+    def test_every_credential_throttled_reports_the_rate_limit(self):
+        self.answers = {credential.label: upstream_response(429) for credential in self.credentials}
+        with override_settings(AMADEUS_RATE_LIMIT_MAX_WAIT=0.2):
+            self.assertEqual(self.search(), {'error': RATE_LIMITED_ERROR})
+
+
+@override_settings(PRICE_CACHE_SOFT_TTL=600, PRICE_CACHE_HARD_TTL=3600)
+class ConditionalPriceEndpointTests(PriceEndpointTestCase):
+    def test_prices_carry_validators_and_caching_headers(self):
+        miss = self.get_price()
+        entry = read_price_entry('JFK', 'LAX', self.date)
+        self.assertEqual(miss['ETag'], entry['etag'])
+        self.assertEqual(miss['Last-Modified'], http_date(entry['fetched_at']))
+        self.assertEqual(miss['Cache-Control'], 'public, max-age=600, stale-while-revalidate=3000')
+        self.assertEqual(miss['Vary'], 'Accept')
+        hit = self.get_price()
+        self.assertEqual((hit['ETag'], hit['Last-Modified']), (miss['ETag'], miss['Last-Modified']))
+        # Misses and hits vary on the same headers, so a shared cache keeps one copy of the price
+        self.assertEqual(hit['Vary'], 'Accept')
+
+    def test_client_holding_the_price_gets_a_304(self):
+        etag = self.get_price()['ETag']
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', '*'):
+            response = self.get_price(headers={'If-None-Match': if_none_match})
+            self.assertEqual(response.status_code, 304, if_none_match)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(self.get_price(headers={'If-None-Match': '"other"'}).status_code, 200)
+
+    def test_async_endpoint_answers_a_304(self):
+        etag = self.get_price()['ETag']
+        response = self.get_price('/flights/price/async/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_follows_the_price(self):
+        etag = self.get_price()['ETag']
+        # The same price fetched again keeps its ETag, so clients holding it still get a 304
+        self.assertEqual(self.get_price(nocache='1')['ETag'], etag)
+        self.amadeus.return_value = self.offers('90.00')
+        response = self.get_price(nocache='1')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get_price(headers={'If-None-Match': etag}).status_code, 200)
+
+
+class PriceHistoryTests(TestCase):
+    def setUp(self):
+        self.writer = PriceHistoryWriter()
+
+    def data(self, total, currency='EUR'):
+        return {'origin': 'JFK', 'destination': 'LAX', 'departure_date': '2031-01-01', 'price': f"{total} {currency}"}
+
+    def test_buffered_prices_are_written_in_one_batch(self):
+        self.writer.record('JFK', 'LAX', '2031-01-01', 1, None, self.data('100.00'), 1_900_000_000)
+        self.writer.record('JFK', 'LAX', '2031-01-01', 1, 'USD', self.data('120.00', 'USD'), 1_900_000_060)
+        # A bad row is left out instead of failing the batch
+        self.writer.record('JFK', 'LAX', 'tomorrow', 1, None, self.data('1.00'), 1_900_000_000)
+        self.assertEqual(PriceObservation.objects.count(), 0)
+        with self.assertNumQueries(1):
+            self.writer.flush()
+        self.assertEqual(self.writer.stats(), {'pending': 0, 'written': 2, 'dropped': 0})
+        observation = PriceObservation.objects.get(requested_currency=DEFAULT_CURRENCY_MARKER)
+        self.assertEqual((observation.price, observation.currency), (Decimal('100.00'), 'EUR'))
+        self.assertEqual(observation.observed_at.timestamp(), 1_900_000_000)
+
+    @override_settings(PRICE_HISTORY_MAX_PENDING=1)
+    def test_prices_over_the_buffer_limit_are_dropped(self):
+        for total in ('100.00', '90.00'):
+            self.writer.record('JFK', 'LAX', '2031-01-01', 1, None, self.data(total), 1_900_000_000)
+        self.assertEqual(self.writer.stats(), {'pending': 1, 'written': 0, 'dropped': 1})
+
+    def test_latest_observation_of_the_search_is_read(self):
+        for total, requested_currency, observed_at in (
+            ('100.00', None, 1_900_000_000), ('90.00', None, 1_900_000_060), ('80.00', 'USD', 1_900_000_120),
+        ):
+            self.writer.record('JFK', 'LAX', '2031-01-01', 1, requested_currency, self.data(total), observed_at)
+        self.writer.flush()
+        self.assertEqual(latest_observation('JFK', 'LAX', '2031-01-01').price, Decimal('90.00'))
+        self.assertEqual(latest_observation('JFK', 'LAX', '2031-01-01', currency='USD').price, Decimal('80.00'))
+        self.assertIsNone(latest_observation('JFK', 'LAX', '2031-01-01', adults=2))
+        self.assertIsNone(latest_observation('JFK', 'LAX', '2031-01-01', currency='GBP'))
+
+
+class PriceHistoryEndpointTests(PriceEndpointTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        observed_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+        PriceObservation.objects.create(
+            origin='JFK', destination='LAX', departure_date=self.date, adults=1, price=Decimal('80.00'),
+            currency='EUR', requested_currency=DEFAULT_CURRENCY_MARKER, observed_at=observed_at,
+            data={'origin': 'JFK', 'destination': 'LAX', 'departure_date': self.date, 'price': '80.00 EUR'},
+        )
+
+    def assert_history_price(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'STALE')
+        self.assertEqual(response.json()['data']['price'], '80.00 EUR')
+        self.assertAlmostEqual(int(response['Age']), 2 * 24 * 3600, delta=5)
+
+    def test_open_circuit_serves_the_price_history(self):
+        self.amadeus.return_value = {'error': CIRCUIT_OPEN_ERROR}
+        self.assert_history_price(self.get_price())
+        # The fallback is not cached, the next request asks Amadeus again
+        self.get_price()
+        self.assertEqual(self.amadeus.call_count, 2)
+
+    @override_settings(PRICE_REQUEST_DEADLINE=0.1)
+    def test_late_price_serves_the_price_history_and_is_cached_later(self):
+        def fetch(*args, **kwargs):
+            time.sleep(0.3)
+            return self.offers('100.00')
+
+        self.amadeus.side_effect = fetch
+        self.assert_history_price(self.get_price())
+        self.assertTrue(wait_until(lambda: read_price_entry('JFK', 'LAX', self.date) is not None))
+        self.assertEqual(self.get_price().json()['data']['price'], '100.00 EUR')
+
+    def test_last_known_good_price_is_preferred(self):
+        self.get_price()
+        key = price_cache_key('JFK', 'LAX', self.date)
+        cache.delete(key)
+        price_cache.local.delete(key)
+        self.amadeus.return_value = {'error': CIRCUIT_OPEN_ERROR}
+        self.assertEqual(self.get_price().json()['data']['price'], '100.00 EUR')
+
+    def test_failures_other_than_unavailability_are_reported(self):
+        self.amadeus.return_value = {'error': FETCH_ERROR}
+        response = self.get_price()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': FETCH_ERROR})
+
+    def test_history_of_the_default_currency_is_not_served_for_another(self):
+        self.amadeus.return_value = {'error': CIRCUIT_OPEN_ERROR}
+        self.assertEqual(self.get_price(currency='USD').status_code, 503)
+
+    async def test_async_endpoint_serves_the_price_history(self):
+        self.aamadeus = self.patch(
+            AmadeusAPI, 'afetch_flight_offers', new_callable=mock.AsyncMock, return_value={'error': CIRCUIT_OPEN_ERROR},
+        )
+        self.assert_history_price(await self.async_client.get('/flights/price/async/', {
+            'origin': 'JFK', 'destination': 'LAX', 'date': self.date,
+        }))
@@ -1,8 +1,13 @@
 from django.urls import path
-from .views import FlightPriceView, PingView
+from .views import AsyncFlightPriceView, FlightPriceBatchView, FlightPriceRangeView, FlightPriceView, MetricsView, PingView, StatsView
 
 # API URLs for the Flight Price API
 urlpatterns = [
     path('ping/', PingView.as_view(), name='ping'),  # Ping endpoint for health checks
-    path('price/', FlightPriceView.as_view(), name='flight-price')  # Flight price endpoint
+    path('price/', FlightPriceView.as_view(), name='flight-price'),  # Flight price endpoint
+    path('price/async/', AsyncFlightPriceView.as_view(), name='flight-price-async'),  # Async flight price endpoint for ASGI
+    path('price/batch/', FlightPriceBatchView.as_view(), name='flight-price-batch'),  # Batch flight price endpoint
+    path('price/range/', FlightPriceRangeView.as_view(), name='flight-price-range'),  # Cheapest price per day over a date window
+    path('stats/', StatsView.as_view(), name='stats'),  # Per-process cache and coalescing counters
+    path('metrics/', MetricsView.as_view(), name='metrics'),  # Stage latencies and request counters for Prometheus
 ]
@@ -1,12 +1,31 @@
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
-from django.core.cache import cache
+import datetime
+import json
 import re
+import time
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags
+from django.views import View
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi  
-from .services.amadeus_service import AmadeusAPI
-from .serializers import FlightOfferSerializer
+from .services.amadeus_service import CIRCUIT_OPEN_ERROR, DEADLINE_ERROR, amadeus_breaker, error_status
+from .services.credentials import get_credential_pool
+from .services.price_service import (
+    afetch_price, aget_price_within_deadline, ainvalidate_price, aread_fallback_entry, aread_price_entry, content_etag,
+    deadline_stats, entry_age, fetch_price, entry_body, entry_etag, get_price_within_deadline, get_prices, has_offer_window, invalidate_price, is_fresh,
+    iter_price_range, price_amount, price_cache, price_single_flight, read_fallback_entry, read_price_entry,
+    refresh_price_in_background,
+)
+from .services.locations import get_location_index, normalize_code
+from .services.metrics import metrics
+from .services.offers import SORT_KEYS, offer_representation, select_offers
+from .services.popularity import record_search
+from .services.price_history import price_history
+from .services.rendering import render_data, render_json
+from .services.token_manager import token_local_cache
 
 
 class PingView(APIView):
@@ -17,38 +36,244 @@ class PingView(APIView):
     def get(self, request):
         return Response({"data": "pong"}, status=status.HTTP_200_OK)
 
-class FlightPriceView(APIView):
+def fetched_entry(data):
     """
-    The `FlightPriceView` class is a view that handles requests to fetch flight prices between two
-    specified locations and a given date. It uses the `AmadeusAPI` class to fetch flight offers and
-    the `FlightOfferSerializer` class to serialize the data into a format that can be easily consumed
-    by the client.
+    The function `fetched_entry` wraps a price that was just fetched in an entry like the cached ones,
+    so its response gets the same caching headers.
+    """
+    return {'data': data, 'body': render_data(data), 'fetched_at': time.time()}
+
+
+# The error returned if the offers of a search that was just fetched could not be read back from the cache
+OFFERS_UNAVAILABLE_ERROR = "Failed to read the flight offers, try again."
+
+
+def needs_offer_window(selection):
+    """
+    The function `needs_offer_window` checks whether an offer selection needs the offer window of the
+    search, see `has_offer_window`. Only the cheapest offer is fetched for the others.
+    :param selection: The keyword arguments of `select_offers`, or `None`.
+    """
+    if selection is None:
+        return False
+    return (selection['max_offers'] > 1 or selection['non_stop'] or selection['max_price'] is not None
+            or selection['sort'] != 'price')
+
+
+def answers_selection(entry, selection):
+    """
+    The function `answers_selection` checks whether a price entry can answer an offer selection.
+    Negative entries answer every selection. Entries cached before offers were kept only answer for the
+    cheapest offer, and entries that hold the cheapest offer only can not be filtered or sorted.
+    """
+    if selection is None or 'error' in entry:
+        return True
+    return 'offers' in entry and (not needs_offer_window(selection) or has_offer_window(entry))
+
+
+def selected_entry(entry, selection):
+    """
+    The function `selected_entry` builds the entry of a response that asked for several offers: its
+    `data` holds the route and date of the search and the offers picked by `select_offers` from the
+    cached ones, and its `body` and `etag` are rendered from it.
+    :param selection: The keyword arguments of `select_offers`, or `None` to return `entry` as is.
+    :return: The entry, or `None` if `entry` can not answer the selection, see `answers_selection`.
+    """
+    if selection is None:
+        return entry
+    if not answers_selection(entry, selection):
+        return None
+    data = {field: entry['data'][field] for field in ('origin', 'destination', 'departure_date')}
+    data['offers'] = [offer_representation(offer) for offer in select_offers(entry['offers'], **selection)]
+    body = render_data(data)
+    return {'data': data, 'body': body, 'etag': content_etag(body), 'fetched_at': entry['fetched_at']}
+
+
+class FlightParametersMixin:
+    """
+    The `FlightParametersMixin` class holds the parameter validation shared by the price views.
     """
 
     def validate_parameters(self, origin, destination, date):
         """
         The `validate_parameters` method is a helper function that validates the parameters passed to
-        the `FlightPriceView` view. It checks if the origin and destination IATA codes are in all caps,
-        and if the date is in the correct format. If any of the validations fail, it returns `False`
-        along with an error message.
+        the `FlightPriceView` view. It checks if the origin and destination are IATA codes found in
+        the bundled location index, and if the date is in the correct format. If any of the
+        validations fail, it returns `False` along with an error message.
         
-        :param origin: The `origin` parameter is the IATA code of the origin airport.
-        :param destination: The `destination` parameter is the IATA code of the destination airport.
+        :param origin: The `origin` parameter is the IATA code of the origin airport or city, as
+        returned by `normalize_code`.
+        :param destination: The `destination` parameter is the IATA code of the destination airport or
+        city, as returned by `normalize_code`.
         :param date: The `date` parameter is the date of departure for the flight offers being fetched.
         :return: The `validate_parameters` method returns `True` if all the parameters are valid, along
         with an empty string. If any of the parameters are invalid, it returns `False` along with an
         error message.
         """
-        # Check if the origin and destination IATA codes are in all caps
-        if not (origin.isupper() and destination.isupper()):
-            return False, "Origin and destination IATA codes must be in all caps."
+        # Check if the origin and destination are known IATA codes, so junk codes never reach the
+        # cache or the Amadeus API
+        locations = get_location_index()
+        for code in (origin, destination):
+            if len(code) != 3 or not code.isascii() or not code.isalpha():
+                return False, "Origin and destination must be 3-letter IATA codes."
+            if code not in locations:
+                return False, f"Unknown IATA code: {code}."
         # Check if the date is in the correct format
         date_pattern = r"^\d{4}-\d{2}-\d{2}$"
         if not re.match(date_pattern, date):
             return False, "Date must be in the format YYYY-MM-DD."
 
         return True, ""
-    
+
+    def parse_offer_parameters(self, params):
+        """
+        The `parse_offer_parameters` method reads the optional search parameters of the price
+        endpoints. `currency` changes the prices Amadeus quotes, so each currency has its own cache
+        entry. `max`, `nonStop`, `maxPrice` and `sort` pick offers from the cached ones, so changing
+        them never calls Amadeus again.
+
+        :param params: The query parameters of the request.
+        :return: A `(currency, selection, error)` tuple. `currency` is an ISO 4217 code or `None` for
+        the Amadeus default. `selection` holds the keyword arguments of `select_offers`, or is `None`
+        if the client only asked for the cheapest offer. `error` is an error message, or an empty
+        string if the parameters are valid.
+        """
+        currency = params.get('currency')
+        if currency:
+            currency = currency.upper()
+            if len(currency) != 3 or not currency.isalpha():
+                return None, None, "Currency must be a 3-letter ISO 4217 code."
+        else:
+            currency = None
+        if not any(name in params for name in ('max', 'nonStop', 'maxPrice', 'sort')):
+            return currency, None, ""
+
+        selection = {'max_offers': settings.AMADEUS_OFFERS_MAX, 'non_stop': False, 'max_price': None, 'sort': 'price'}
+        if 'max' in params:
+            try:
+                selection['max_offers'] = int(params['max'])
+            except ValueError:
+                selection['max_offers'] = 0
+            if not 1 <= selection['max_offers'] <= settings.AMADEUS_OFFERS_MAX:
+                return None, None, f"Max must be a number between 1 and {settings.AMADEUS_OFFERS_MAX}."
+        if 'nonStop' in params:
+            if params['nonStop'].lower() not in ('true', 'false'):
+                return None, None, "NonStop must be true or false."
+            selection['non_stop'] = params['nonStop'].lower() == 'true'
+        if 'maxPrice' in params:
+            try:
+                selection['max_price'] = float(params['maxPrice'])
+            except ValueError:
+                selection['max_price'] = 0
+            if not selection['max_price'] > 0:
+                return None, None, "MaxPrice must be a positive number."
+        if 'sort' in params:
+            if params['sort'] not in SORT_KEYS:
+                return None, None, f"Sort must be one of: {', '.join(SORT_KEYS)}."
+            selection['sort'] = params['sort']
+        return currency, selection, ""
+
+    def price_headers(self, entry, x_cache):
+        """
+        The `price_headers` method builds the caching headers of a price response from its cache entry:
+        the `ETag` and `Last-Modified` validators, the `Age` of the entry and a `Cache-Control` that
+        lets clients and CDNs keep it as long as the cache does.
+        :param entry: The price entry, with `body` and `fetched_at`.
+        :param x_cache: The `X-Cache` header, `HIT`, `STALE`, `MISS` or `BYPASS`.
+        :return: A dict of headers.
+        """
+        # Caches subtract `Age` from `max-age`, so the price stays fresh downstream for exactly as long
+        # as the entry is fresh here, then is served stale while it is refreshed until the hard TTL
+        cache_control = (f"public, max-age={settings.PRICE_CACHE_SOFT_TTL}, "
+                         f"stale-while-revalidate={settings.PRICE_CACHE_HARD_TTL - settings.PRICE_CACHE_SOFT_TTL}")
+        return {
+            'Age': str(entry_age(entry)),
+            'Cache-Control': cache_control,
+            'ETag': entry_etag(entry),
+            'Last-Modified': http_date(entry['fetched_at']),
+            # DRF varies its responses on Accept, browsers get the browsable API for the same URL
+            'Vary': 'Accept',
+            'X-Cache': x_cache,
+        }
+
+    def is_not_modified(self, request, headers):
+        """
+        The `is_not_modified` method checks whether the client already holds the price, i.e. the
+        `If-None-Match` header of the request lists its ETag (weak comparison) or is `*`.
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        etags = parse_etags(if_none_match)
+        return '*' in etags or headers['ETag'] in etags or f"W/{headers['ETag']}" in etags
+
+    def count_result(self, response):
+        """
+        The `count_result` method counts a price response by its `X-Cache` header (`hit`, `stale`,
+        `miss` or `bypass`), or as `error` if it was answered without the cache, e.g. invalid
+        parameters or a failed upstream call.
+        :return: The response.
+        """
+        metrics.incr('price_requests', response.get('X-Cache', 'ERROR').lower())
+        return response
+
+
+class FlightPriceView(FlightParametersMixin, APIView):
+    """
+    The `FlightPriceView` class is a view that handles requests to fetch flight prices between two
+    specified locations and a given date. It uses the `AmadeusAPI` class to fetch flight offers and
+    extracts the fields of the cheapest offer into a format that can be easily consumed by the
+    client. Cached prices are returned as the response body that was rendered when they were fetched.
+    With `max`, it returns several of the cached offers instead, filtered and sorted as asked.
+    """
+    # Prices are public, so requests are not authenticated. This keeps the session, and with it
+    # `Vary: Cookie`, out of misses too, so shared caches keep one copy of each price like for hits
+    authentication_classes = []
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+        The `dispatch` method serves cached prices before DRF wraps the request, so a cache hit skips
+        content negotiation, authentication and the renderer. The view allows anonymous access and is
+        not throttled, so nothing is skipped that could change the response. Everything else, and
+        clients that ask for the browsable API, go through DRF as usual.
+        """
+        if request.method == 'GET' and 'text/html' not in request.META.get('HTTP_ACCEPT', ''):
+            response = self.cached_response(request)
+            if response is not None:
+                return self.count_result(response)
+        return self.count_result(super().dispatch(request, *args, **kwargs))
+
+    def cached_response(self, request):
+        """
+        The `cached_response` method returns the pre-rendered body of a cached price, refreshing it in
+        the background if it is stale. Clients that already hold the price get a 304 without it.
+        :return: An `HttpResponse`, or `None` if the request must go through `get`.
+        """
+        params = request.GET
+        origin = normalize_code(params.get('origin'))
+        destination = normalize_code(params.get('destination'))
+        date = params.get('date')
+        if params.get('nocache') == '1' or not origin or not destination or not date:
+            return None
+        if not self.validate_parameters(origin, destination, date)[0]:
+            return None
+        currency, selection, error_message = self.parse_offer_parameters(params)
+        if error_message:
+            return None
+        entry = read_price_entry(origin, destination, date, currency=currency)
+        # Negative entries are answered by `get`, they are not on the hot path
+        if not entry or 'error' in entry:
+            return None
+        response_entry = selected_entry(entry, selection)
+        if response_entry is None:
+            return None
+        record_search(origin, destination, date, currency=currency)
+        headers = self.price_headers(response_entry, 'HIT' if is_fresh(entry) else 'STALE')
+        if headers['X-Cache'] == 'STALE':
+            refresh_price_in_background(origin, destination, date, currency=currency, with_offers=has_offer_window(entry))
+        if self.is_not_modified(request, headers):
+            return HttpResponseNotModified(headers=headers)
+        return HttpResponse(entry_body(response_entry), content_type='application/json', headers=headers)
 
     @swagger_auto_schema(
         operation_description="Get flight prices between origin and destination",
@@ -58,14 +283,19 @@ class FlightPriceView(APIView):
             openapi.Parameter('destination', openapi.IN_QUERY, description="Destination IATA code", type=openapi.TYPE_STRING),
             openapi.Parameter('date', openapi.IN_QUERY, description="Travel date (YYYY-MM-DD)", type=openapi.TYPE_STRING),
             openapi.Parameter('nocache', openapi.IN_QUERY, description="Set to 1 to bypass cache and fetch fresh data", type=openapi.TYPE_INTEGER, required=False),
+            openapi.Parameter('currency', openapi.IN_QUERY, description="ISO 4217 currency of the prices", type=openapi.TYPE_STRING, required=False),
+            openapi.Parameter('max', openapi.IN_QUERY, description="Return up to this many offers instead of the cheapest one", type=openapi.TYPE_INTEGER, required=False),
+            openapi.Parameter('nonStop', openapi.IN_QUERY, description="Set to true to only return offers without a connection", type=openapi.TYPE_BOOLEAN, required=False),
+            openapi.Parameter('maxPrice', openapi.IN_QUERY, description="Only return offers up to this total price", type=openapi.TYPE_NUMBER, required=False),
+            openapi.Parameter('sort', openapi.IN_QUERY, description="Order of the offers: price, duration or stops", type=openapi.TYPE_STRING, required=False),
         ]
     )
     def get(self, request):
         """
         The `get` method is the main entry point for the `FlightPriceView` view. It retrieves the
         origin, destination, and date parameters from the request query parameters, validates them,
-        and then fetches flight offers using the `AmadeusAPI` class. It then serializes the flight
-        offers using the `FlightOfferSerializer` class and returns the response.
+        and then fetches flight offers using the `AmadeusAPI` class. It then extracts the fields of
+        the cheapest offer with `flight_offer_summary` and returns the response.
         
         :param request: The `request` parameter is an instance of the `Request` class, which represents
         an HTTP request made to the server. It contains information about the request, such as the
@@ -73,8 +303,8 @@ class FlightPriceView(APIView):
         :return: The `get` method returns a response containing the serialized flight offers, along with
         an HTTP status code.        
         """
-        origin = request.query_params.get('origin')
-        destination = request.query_params.get('destination')
+        origin = normalize_code(request.query_params.get('origin'))
+        destination = normalize_code(request.query_params.get('destination'))
         date = request.query_params.get('date')
         nocache = request.query_params.get('nocache')
 
@@ -87,35 +317,344 @@ class FlightPriceView(APIView):
         valid, error_message = self.validate_parameters(origin, destination, date)
         if not valid:
             return Response({"error": error_message}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Check if the cache is enabled and if the cache key exists
-        cache_key = f"{origin}_{destination}_{date}"
-        cached_data = cache.get(cache_key)
+        # Validate the optional currency and offer selection parameters
+        currency, selection, error_message = self.parse_offer_parameters(request.query_params)
+        if error_message:
+            return Response({"error": error_message}, status=status.HTTP_400_BAD_REQUEST)
+        # Count the search, so `manage.py warm_price_cache` keeps popular searches warm
+        record_search(origin, destination, date, currency=currency)
 
         # If the cache is enabled and the cache key exists, return the cached data
         if nocache != '1':
-            cached_data = cache.get(cache_key)
-            if cached_data:
-                return Response({ "data": cached_data }, status=status.HTTP_200_OK)
-
-        # Fetch flight offers from the Amadeus API
-        amadeus = AmadeusAPI()
-        flight_data = amadeus.fetch_flight_offers(origin, destination, date)
+            entry = read_price_entry(origin, destination, date, currency=currency)
+            # Entries without the offers a selection needs are fetched again, see `answers_selection`
+            if entry and answers_selection(entry, selection):
+                age = entry_age(entry)
+                # A negative entry, Amadeus recently had no offer for this search
+                if 'error' in entry:
+                    return Response({"error": entry['error']}, status=error_status(entry['error']),
+                                    headers={'Age': str(age), 'X-Cache': 'HIT'})
+                if is_fresh(entry):
+                    return self.price_response(request, selected_entry(entry, selection), 'HIT')
+                # Serve the stale price right away and refresh it in the background, keeping its offers
+                refresh_price_in_background(origin, destination, date, currency=currency,
+                                            with_offers=has_offer_window(entry))
+                return self.price_response(request, selected_entry(entry, selection), 'STALE')
+            # Coalesce concurrent misses for the same route so only one of them calls Amadeus, and wait
+            # for it at most `PRICE_REQUEST_DEADLINE` seconds. Only selections that filter or sort the
+            # offers ask Amadeus for more than the cheapest one
+            response_data, error = get_price_within_deadline(origin, destination, date, currency=currency,
+                                                             with_offers=needs_offer_window(selection))
+        else:
+            # Bypass the cache and fetch fresh data from the Amadeus API, dropping every worker's
+            # in-memory copy so none of them keeps serving the old price
+            invalidate_price(origin, destination, date, currency=currency)
+            response_data, error = fetch_price(origin, destination, date, currency=currency,
+                                               with_offers=needs_offer_window(selection))
 
+        # While Amadeus is unavailable or too slow, serve the last known price if there is one
+        if error in (CIRCUIT_OPEN_ERROR, DEADLINE_ERROR):
+            entry = read_fallback_entry(origin, destination, date, currency=currency)
+            entry = entry and selected_entry(entry, selection)
+            if entry:
+                return self.price_response(request, entry, 'STALE')
         # Check if there was an error fetching flight offers
-        if "error" in flight_data:
-            return Response({"error": flight_data['error']}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        # Check if the response is a list and if there are flight offers available
-        if isinstance(flight_data, list) and len(flight_data) > 0:
-            flight_offer = flight_data[0]
-            # Serialize the flight offer using the FlightOfferSerializer class
-            serializer = FlightOfferSerializer(flight_offer)
-            # Cache the serialized flight offer for 10 minutes
-            response_data = serializer.data
-            cache.set(cache_key, response_data, timeout=60 * 10)
-            # Return the serialized flight offer
-            return Response({"data": response_data}, status=status.HTTP_200_OK)
-        # If the response is not a list or there are no flight offers available, return an error
+        if error:
+            return Response({"error": error}, status=error_status(error))
+        # Return the serialized flight offer, or the offers that were cached along with it
+        x_cache = 'BYPASS' if nocache == '1' else 'MISS'
+        if selection is None:
+            return self.price_response(request, fetched_entry(response_data), x_cache)
+        entry = read_price_entry(origin, destination, date, currency=currency)
+        entry = entry and selected_entry(entry, selection)
+        if not entry:
+            return Response({"error": OFFERS_UNAVAILABLE_ERROR}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return self.price_response(request, entry, x_cache)
+
+    def price_response(self, request, entry, x_cache):
+        """
+        The `price_response` method returns a price as the pre-rendered JSON body of its entry, skipping
+        content negotiation and the DRF renderer, or a 304 if the client already holds it. The body is
+        the same as DRF would render for `{"data": data}`. Clients that ask for HTML still get the
+        browsable API.
+        """
+        headers = self.price_headers(entry, x_cache)
+        if 'text/html' in request.META.get('HTTP_ACCEPT', ''):
+            return Response({"data": entry['data']}, status=status.HTTP_200_OK, headers=headers)
+        if self.is_not_modified(request, headers):
+            return HttpResponseNotModified(headers=headers)
+        return HttpResponse(entry_body(entry), content_type='application/json', headers=headers)
+
+
+class AsyncFlightPriceView(FlightParametersMixin, View):
+    """
+    The `AsyncFlightPriceView` class is the async version of `FlightPriceView`, for deployments that
+    serve the app over ASGI. The Redis and Amadeus calls are awaited instead of blocking a worker
+    thread, so one process can hold many concurrent upstream calls. It takes the same parameters and
+    returns the same response body and headers as `FlightPriceView`.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        return self.count_result(await super().dispatch(request, *args, **kwargs))
+
+    async def get(self, request):
+        """
+        The `get` method follows the same steps as `FlightPriceView.get`, using the async cache client
+        and the async `AmadeusAPI` methods.
+        """
+        origin = normalize_code(request.GET.get('origin'))
+        destination = normalize_code(request.GET.get('destination'))
+        date = request.GET.get('date')
+        nocache = request.GET.get('nocache')
+
+        if not origin or not destination or not date:
+            return self.json_response({"error": "Missing required parameters: origin, destination, or date."},
+                                      status_code=status.HTTP_400_BAD_REQUEST)
+        valid, error_message = self.validate_parameters(origin, destination, date)
+        if not valid:
+            return self.json_response({"error": error_message}, status_code=status.HTTP_400_BAD_REQUEST)
+        currency, selection, error_message = self.parse_offer_parameters(request.GET)
+        if error_message:
+            return self.json_response({"error": error_message}, status_code=status.HTTP_400_BAD_REQUEST)
+        record_search(origin, destination, date, currency=currency)
+
+        if nocache != '1':
+            entry = await aread_price_entry(origin, destination, date, currency=currency)
+            if entry and answers_selection(entry, selection):
+                age = entry_age(entry)
+                if 'error' in entry:
+                    return self.json_response({"error": entry['error']}, status_code=error_status(entry['error']),
+                                              headers={'Age': str(age), 'X-Cache': 'HIT'})
+                if is_fresh(entry):
+                    return self.entry_response(request, selected_entry(entry, selection), 'HIT')
+                # The refresh runs on the background thread pool, queuing it does not block the loop
+                refresh_price_in_background(origin, destination, date, currency=currency,
+                                            with_offers=has_offer_window(entry))
+                return self.entry_response(request, selected_entry(entry, selection), 'STALE')
+            response_data, error = await aget_price_within_deadline(origin, destination, date, currency=currency,
+                                                                    with_offers=needs_offer_window(selection))
         else:
-            return Response({"error": "Unexpected response format from API."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            await ainvalidate_price(origin, destination, date, currency=currency)
+            response_data, error = await afetch_price(origin, destination, date, currency=currency,
+                                                      with_offers=needs_offer_window(selection))
+
+        if error in (CIRCUIT_OPEN_ERROR, DEADLINE_ERROR):
+            entry = await aread_fallback_entry(origin, destination, date, currency=currency)
+            entry = entry and selected_entry(entry, selection)
+            if entry:
+                return self.entry_response(request, entry, 'STALE')
+        if error:
+            return self.json_response({"error": error}, status_code=error_status(error))
+        x_cache = 'BYPASS' if nocache == '1' else 'MISS'
+        if selection is None:
+            return self.entry_response(request, fetched_entry(response_data), x_cache)
+        entry = await aread_price_entry(origin, destination, date, currency=currency)
+        entry = entry and selected_entry(entry, selection)
+        if not entry:
+            return self.json_response({"error": OFFERS_UNAVAILABLE_ERROR},
+                                      status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return self.entry_response(request, entry, x_cache)
+
+    def entry_response(self, request, entry, x_cache):
+        # Returns the body of a price entry, or a 304 if the client already holds it
+        headers = self.price_headers(entry, x_cache)
+        if self.is_not_modified(request, headers):
+            return HttpResponseNotModified(headers=headers)
+        return self.body_response(entry_body(entry), headers=headers)
+
+    def json_response(self, payload, status_code=status.HTTP_200_OK, headers=None):
+        # Render JSON like DRF's JSONRenderer, so both views return the same bytes
+        return self.body_response(render_json(payload), status_code=status_code, headers=headers)
+
+    def body_response(self, body, status_code=status.HTTP_200_OK, headers=None):
+        return HttpResponse(body, status=status_code, content_type='application/json', headers=headers)
+
+
+class FlightPriceBatchView(FlightParametersMixin, APIView):
+    """
+    The `FlightPriceBatchView` class handles requests for the prices of many searches at once. Cached
+    prices are read in one round trip to Redis and only the misses are fetched from the Amadeus API,
+    concurrently.
+    """
+
+    @swagger_auto_schema(
+        operation_description="Get flight prices for a list of searches",
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            required=['items'],
+            properties={
+                'items': openapi.Schema(
+                    type=openapi.TYPE_ARRAY,
+                    items=openapi.Schema(
+                        type=openapi.TYPE_OBJECT,
+                        required=['origin', 'destination', 'date'],
+                        properties={
+                            'origin': openapi.Schema(type=openapi.TYPE_STRING, description="Origin IATA code"),
+                            'destination': openapi.Schema(type=openapi.TYPE_STRING, description="Destination IATA code"),
+                            'date': openapi.Schema(type=openapi.TYPE_STRING, description="Travel date (YYYY-MM-DD)"),
+                            'adults': openapi.Schema(type=openapi.TYPE_INTEGER, description="Number of adults (default 1)"),
+                        },
+                    ),
+                ),
+            },
+        ),
+        responses={200: 'Per-item flight price details or errors returned'},
+    )
+    def post(self, request):
+        """
+        The `post` method validates every search in the batch, looks up the valid ones with
+        `get_prices`, and returns one result per search in the order they were sent. Each result is
+        either `{"data": {...}}` or `{"error": "..."}`.
+
+        :param request: The `request` parameter is an instance of the `Request` class, whose body holds
+        the list of searches under `items`.
+        :return: The `post` method returns a response containing the per-item results, along with an
+        HTTP status code.
+        """
+        items = request.data.get('items') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response({"error": "Request body must contain a non-empty list of items."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.PRICE_BATCH_MAX_SIZE:
+            return Response({"error": f"A batch may contain at most {settings.PRICE_BATCH_MAX_SIZE} items."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Validate every item, invalid items get an error without failing the rest of the batch
+        results = [None] * len(items)
+        searches = []
+        for index, item in enumerate(items):
+            search, error_message = self.parse_item(item)
+            if error_message:
+                results[index] = {"error": error_message}
+            else:
+                searches.append((index, search))
+
+        prices = get_prices([search for _, search in searches], deadline=settings.PRICE_BATCH_DEADLINE)
+        for (index, _), (response_data, error) in zip(searches, prices):
+            results[index] = {"error": error} if error else {"data": response_data}
+        return Response({"data": results}, status=status.HTTP_200_OK)
+
+    def parse_item(self, item):
+        """
+        The `parse_item` method validates one search of the batch.
+        :return: An `(origin, destination, date, adults)` tuple and an empty string, or `None` and an
+        error message if the search is invalid.
+        """
+        if not isinstance(item, dict):
+            return None, "Each item must be an object."
+        origin = normalize_code(item.get('origin'))
+        destination = normalize_code(item.get('destination'))
+        date = item.get('date')
+        if not all(isinstance(value, str) and value for value in (origin, destination, date)):
+            return None, "Missing required parameters: origin, destination, or date."
+        valid, error_message = self.validate_parameters(origin, destination, date)
+        if not valid:
+            return None, error_message
+        adults = item.get('adults', 1)
+        if not isinstance(adults, int) or isinstance(adults, bool) or not 1 <= adults <= 9:
+            return None, "Adults must be an integer between 1 and 9."
+        return (origin, destination, date, adults), ""
+
+
+class FlightPriceRangeView(FlightParametersMixin, APIView):
+    """
+    The `FlightPriceRangeView` class handles requests for the cheapest flight offer on each day of a
+    date window. The per-day results are streamed back as NDJSON as soon as they are available,
+    followed by a summary line with the overall cheapest day.
+    """
+
+    @swagger_auto_schema(
+        operation_description="Stream the cheapest flight price for each day between start and end as NDJSON",
+        responses={200: 'One JSON line per day, followed by a summary line with the cheapest day'},
+        manual_parameters=[
+            openapi.Parameter('origin', openapi.IN_QUERY, description="Origin IATA code", type=openapi.TYPE_STRING),
+            openapi.Parameter('destination', openapi.IN_QUERY, description="Destination IATA code", type=openapi.TYPE_STRING),
+            openapi.Parameter('start', openapi.IN_QUERY, description="First travel date (YYYY-MM-DD)", type=openapi.TYPE_STRING),
+            openapi.Parameter('end', openapi.IN_QUERY, description="Last travel date (YYYY-MM-DD)", type=openapi.TYPE_STRING),
+        ]
+    )
+    def get(self, request):
+        """
+        The `get` method validates the route and date window and streams the per-day prices returned
+        by `iter_price_range`.
+
+        :param request: The `request` parameter is an instance of the `Request` class, which represents
+        an HTTP request made to the server.
+        :return: The `get` method returns a streaming NDJSON response, or an error response if the
+        parameters are invalid.
+        """
+        origin = normalize_code(request.query_params.get('origin'))
+        destination = normalize_code(request.query_params.get('destination'))
+        start = request.query_params.get('start')
+        end = request.query_params.get('end')
+
+        # Check if the origin, destination, start and end parameters are present in the request
+        if not origin or not destination or not start or not end:
+            return Response({"error": "Missing required parameters: origin, destination, start, or end."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Validate the parameters for both ends of the window
+        for date in (start, end):
+            valid, error_message = self.validate_parameters(origin, destination, date)
+            if not valid:
+                return Response({"error": error_message}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            start_date = datetime.date.fromisoformat(start)
+            end_date = datetime.date.fromisoformat(end)
+        except ValueError:
+            return Response({"error": "Date must be a valid calendar date."}, status=status.HTTP_400_BAD_REQUEST)
+        days = (end_date - start_date).days + 1
+        if days < 1:
+            return Response({"error": "End date must not be before start date."}, status=status.HTTP_400_BAD_REQUEST)
+        if days > settings.PRICE_RANGE_MAX_DAYS:
+            return Response({"error": f"The date window may span at most {settings.PRICE_RANGE_MAX_DAYS} days."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        dates = [(start_date + datetime.timedelta(days=offset)).isoformat() for offset in range(days)]
+        return StreamingHttpResponse(self.stream(origin, destination, dates), content_type='application/x-ndjson')
+
+    def stream(self, origin, destination, dates):
+        """
+        The `stream` method yields one NDJSON line per day as results arrive, then a summary line with
+        the cheapest day of the window, or `null` if no day has a price.
+        """
+        separators = (',', ':')
+        cheapest_date, cheapest_data, cheapest_amount = None, None, None
+        for date, response_data, error in iter_price_range(origin, destination, dates):
+            if error:
+                yield json.dumps({"date": date, "error": error}, separators=separators) + "\n"
+                continue
+            yield json.dumps({"date": date, "data": response_data}, separators=separators) + "\n"
+            amount = price_amount(response_data)
+            if amount is not None and (cheapest_amount is None or amount < cheapest_amount):
+                cheapest_date, cheapest_data, cheapest_amount = date, response_data, amount
+
+        cheapest = {"date": cheapest_date, "data": cheapest_data} if cheapest_date else None
+        yield json.dumps({"summary": {"cheapest": cheapest}}, separators=separators) + "\n"
+
+
+class MetricsView(View):
+    """
+    The `MetricsView` class returns the stage latency histograms and the request counters of every
+    worker in the Prometheus text format, for a Prometheus server to scrape.
+    """
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class StatsView(APIView):
+    """
+    The `StatsView` class returns the caching and coalescing counters of the process that serves the
+    request. It is meant for operators checking how well the cache protects the Amadeus quota.
+    """
+    def get(self, request):
+        return Response({
+            "data": {
+                "price_single_flight": price_single_flight.stats(),
+                "price_cache": price_cache.stats(),
+                "token_cache": {"l1": token_local_cache.stats()},
+                "amadeus_credentials": get_credential_pool().stats(),
+                "amadeus_breaker": amadeus_breaker.stats(),
+                "price_history": price_history.stats(),
+                "price_deadline": deadline_stats(),
+            }
+        }, status=status.HTTP_200_OK)